@@ -0,0 +1,108 @@
+"""
+Fork server for plugins running in the default environment (Linux only).
+
+The server imports the worker template, the socket.io client and numpy once,
+then forks a new PluginConnection for every request it receives on a unix
+socket. A request is one line of json with the plugin id, secret and work_dir,
+the file descriptor the plugin should write its output to is passed along
+with it (SCM_RIGHTS). The pid of the plugin is sent back as one line of json.
+"""
+import argparse
+import array
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import traceback
+
+import asyncio
+import janus
+from imjoyWorkerTemplate import PluginConnection
+from imjoyUtils3 import task_worker
+
+# preload modules commonly used by plugins, they will be shared with the forks
+try:
+    import numpy  # noqa: F401
+except ImportError:
+    pass
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('ImJoyForkServer')
+logger.setLevel(logging.INFO)
+
+MAX_REQUEST_SIZE = 65536
+
+def recv_request(conn):
+    fds = array.array('i')
+    msg, ancdata, flags, addr = conn.recvmsg(MAX_REQUEST_SIZE, socket.CMSG_LEN(fds.itemsize))
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    if len(fds) != 1:
+        raise Exception('expected one file descriptor, got {}.'.format(len(fds)))
+    return json.loads(msg.decode('utf-8')), fds[0]
+
+def run_plugin(request, fd, opt):
+    # detach from the fork server like a plugin started by the engine
+    os.setsid()
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    os.environ['WORK_DIR'] = request['work_dir']
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    q = janus.Queue(loop=loop)
+    pc = PluginConnection(request['id'], request['secret'], host=opt.host, port=int(opt.port), work_dir=request['work_dir'], queue=q, loop=loop, worker=task_worker, ipc=opt.ipc)
+    pc.wait_forever()
+
+def serve(opt):
+    if os.path.exists(opt.socket):
+        os.remove(opt.socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(opt.socket)
+    server.listen(16)
+    # the engine does not wait for the forked plugins
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    print('Fork server is listening on {}.'.format(opt.socket))
+    sys.stdout.flush()
+    while True:
+        conn, _ = server.accept()
+        try:
+            request, fd = recv_request(conn)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    server.close()
+                    conn.close()
+                    run_plugin(request, fd, opt)
+                except SystemExit as e:
+                    code = e.code if isinstance(e.code, int) else 1
+                except Exception:
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(code)
+            os.close(fd)
+            conn.sendall((json.dumps({'pid': pid}) + '\n').encode('utf-8'))
+        except Exception:
+            logger.error('failed to fork a plugin: %s', traceback.format_exc())
+        finally:
+            conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', type=str, required=True, help='path of the unix socket to listen on')
+    parser.add_argument('--namespace', type=str, default='/', help='socketio namespace')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='socketio host')
+    parser.add_argument('--port', type=str, default='8080', help='socketio port')
+    parser.add_argument('--ipc', type=str, default=None, help='unix socket of the engine, used instead of socket.io')
+    opt = parser.parse_args()
+    serve(opt)
@@ -0,0 +1,138 @@
+"""
+Unix domain socket channel between the plugin engine and its workers.
+
+A frame is a 4-byte big-endian header length, a json header and the binary
+attachments of the message. The header holds the event name, the message
+with its binary values replaced by placeholders (like socket.io does) and the
+sizes of the attachments:
+
+    {"event": "from_plugin_<secret>", "data": ..., "attachments": [1000000]}
+
+A frame may ask for an acknowledgement with "ack": <id>, which is answered
+with a frame {"reply": <id>, "data": [args]}.
+"""
+import json
+import logging
+import socket
+import struct
+import sys
+import threading
+
+logger = logging.getLogger('ImJoyIPC')
+
+HEADER = struct.Struct('!I')
+
+if sys.version_info >= (3, 0):
+    BINARY_TYPES = (bytes, bytearray, memoryview)
+else:
+    # str is text in python 2
+    BINARY_TYPES = (bytearray, memoryview)
+
+
+def deconstruct(data, attachments):
+    'Replace binary values with placeholders, without modifying `data`'
+    if isinstance(data, BINARY_TYPES):
+        attachments.append(data)
+        return {'_placeholder': True, 'num': len(attachments) - 1}
+    elif isinstance(data, (list, tuple)):
+        return [deconstruct(v, attachments) for v in data]
+    elif isinstance(data, dict):
+        return dict((k, deconstruct(v, attachments)) for k, v in data.items())
+    return data
+
+
+def reconstruct(data, attachments):
+    if isinstance(data, list):
+        return [reconstruct(v, attachments) for v in data]
+    elif isinstance(data, dict):
+        if data.get('_placeholder') is True and 'num' in data:
+            return attachments[data['num']]
+        return dict((k, reconstruct(v, attachments)) for k, v in data.items())
+    return data
+
+
+def pack_frame(header, data):
+    'Return the buffers of a frame, attachments are not copied'
+    attachments = []
+    header = dict(header, data=deconstruct(data, attachments))
+    header['attachments'] = [a.nbytes if hasattr(a, 'nbytes') else len(a) for a in attachments]
+    text = json.dumps(header).encode('utf-8')
+    return [HEADER.pack(len(text)) + text] + attachments
+
+
+def unpack_header(text):
+    return json.loads(text.decode('utf-8'))
+
+
+class IPCClient(object):
+    """
+    Worker side of the channel, with the part of the socket.io client
+    interface used by PluginConnection: on(), emit() and wait()
+    """
+    def __init__(self, path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._handlers = {}
+        self._send_lock = threading.Lock()
+        self._callbacks = {}
+        self._ack_id = 0
+
+    def on(self, event, handler):
+        self._handlers[event] = handler
+
+    def emit(self, event, data, callback=None):
+        header = {'event': event}
+        if callback is not None:
+            with self._send_lock:
+                self._ack_id += 1
+                header['ack'] = self._ack_id
+                self._callbacks[self._ack_id] = callback
+        self._send(pack_frame(header, data))
+
+    def _send(self, buffers):
+        with self._send_lock:
+            for buf in buffers:
+                self._sock.sendall(buf)
+
+    def _recv_exactly(self, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        offset = 0
+        while offset < size:
+            n = self._sock.recv_into(view[offset:], size - offset)
+            if n == 0:
+                raise EOFError('connection closed')
+            offset += n
+        return buf
+
+    def _dispatch(self, header, data):
+        if 'reply' in header:
+            callback = self._callbacks.pop(header['reply'], None)
+            if callback is not None:
+                callback(*data)
+            return
+        handler = self._handlers.get(header['event'])
+        if handler is None:
+            return
+        if 'ack' in header:
+            ack = header['ack']
+            def callback(*args):
+                self._send(pack_frame({'reply': ack}, list(args)))
+            handler(data, callback)
+        else:
+            handler(data)
+
+    def wait(self):
+        'Dispatch the received frames until the engine closes the connection'
+        try:
+            while True:
+                size = HEADER.unpack(bytes(self._recv_exactly(HEADER.size)))[0]
+                header = unpack_header(bytes(self._recv_exactly(size)))
+                attachments = [self._recv_exactly(n) for n in header['attachments']]
+                self._dispatch(header, reconstruct(header['data'], attachments))
+        except (EOFError, socket.error) as e:
+            logger.info('IPC connection closed: %s', e)
+        finally:
+            self._sock.close()
+            if 'disconnect' in self._handlers:
+                self._handlers['disconnect']()
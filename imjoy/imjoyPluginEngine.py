@@ -16,9 +16,15 @@ import argparse
 import uuid
 import shutil
 import webbrowser
+import collections
+import json
+import hashlib
+import socket
+import array
+import tempfile
+import itertools
 from aiohttp import web, hdrs
 from aiohttp import WSCloseCode
-from aiohttp import streamer
 from urllib.parse import urlparse
 from mimetypes import MimeTypes
 try:
@@ -26,6 +32,21 @@ try:
 except Exception as e:
     print("WARNING: a library called 'psutil' can not be imported, this may cause problem when killing processes.")
 
+try:
+    from .imjoyIPC import HEADER, pack_frame, unpack_header, reconstruct
+except ImportError:
+    from imjoyIPC import HEADER, pack_frame, unpack_header, reconstruct
+
+try:
+    from .imjoyTileServer import TileServer
+except ImportError:
+    from imjoyTileServer import TileServer
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
 try:
     from Queue import Queue, Empty
 except ImportError:
@@ -57,6 +78,14 @@ parser.add_argument('--port', type=str, default='8080', help='socketio port')
 parser.add_argument('--force_quit_timeout', type=int, default=5, help='the time (in second) for waiting before kill a plugin process, default: 5 s')
 parser.add_argument('--workspace', type=str, default='~/ImJoyWorkspace', help='workspace folder for plugins')
 parser.add_argument('--freeze', action="store_true", help='disable conda and pip commands')
+parser.add_argument('--max_setup_jobs', type=int, default=4, help='the maximum number of plugin environments being set up at the same time, default: 4')
+parser.add_argument('--cmd_cache', type=str, choices=['show', 'purge'], default=None, help='show or purge the cache of completed env and requirements commands, then exit')
+parser.add_argument('--worker_pool_size', type=int, default=0, help='the number of idle workers kept running for each environment to start plugins instantly, 0 to disable, default: 0')
+parser.add_argument('--fork_server', action="store_true", help='start plugins of the default environment by forking a process with preloaded modules (Linux only)')
+parser.add_argument('--disable_ipc', action="store_true", help='connect plugins through socket.io instead of a unix socket')
+parser.add_argument('--tile_cache_size', type=int, default=1024, help='the size (in MB) of the cache of image tiles served from file urls, default: 1024')
+parser.add_argument('--tile_workers', type=int, default=2, help='the number of processes reading image tiles, default: 2')
+parser.add_argument('--plugin_log_size', type=int, default=1000000, help='the number of bytes of output kept for each plugin, default: 1000000')
 
 opt = parser.parse_args()
 
@@ -67,6 +96,14 @@ if opt.freeze:
     print('WARNING: you are running the plugin engine with `--freeze`, this means you need to handle all the plugin requirements yourself.')
 
 FORCE_QUIT_TIMEOUT = opt.force_quit_timeout
+# the number of directory listings kept by list_dir
+DIR_CACHE_SIZE = 10000
+# inotify watches are shared by all the processes of the user, at most this
+# fraction of /proc/sys/fs/inotify/max_user_watches and DIR_WATCH_LIMIT are used
+DIR_WATCH_FRACTION = 0.1
+DIR_WATCH_LIMIT = 4096
+LIST_DIR_PAGE_SIZE = 1000
+LIST_DIR_CURSOR_TIMEOUT = 600
 WORKSPACE_DIR = os.path.expanduser(opt.workspace)
 if not os.path.exists(WORKSPACE_DIR):
     os.makedirs(WORKSPACE_DIR)
@@ -87,6 +124,99 @@ try:
 except Exception as e:
     logger.error('Falied to save .token file: %s', str(e))
 
+conda_info = None
+
+def getCondaInfo():
+    global conda_info
+    if conda_info is None:
+        try:
+            conda_info = json.loads(subprocess.check_output(['conda', 'info', '--json']).decode('utf-8'))
+        except Exception as e:
+            logger.warning('failed to get conda info: %s', str(e))
+            conda_info = {}
+    return conda_info
+
+def getEnvPath(env_name):
+    """Return the prefix of a conda environment, or None if it does not exist"""
+    if not CONDA_AVAILABLE:
+        return None
+    info = getCondaInfo()
+    if not env_name:
+        return info.get('root_prefix', None)
+    for envs_dir in info.get('envs_dirs', []):
+        env_path = os.path.join(envs_dir, env_name)
+        if os.path.isdir(env_path):
+            return env_path
+    return None
+
+# commands which completed successfully, persisted across engine restarts
+CMD_CACHE_FILE = os.path.join(WORKSPACE_DIR, '.cmd_cache.json')
+
+def loadCmdCache():
+    try:
+        with open(CMD_CACHE_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning('Failed to load the command cache: %s', str(e))
+        return {}
+
+def saveCmdCache():
+    try:
+        tmp_file = CMD_CACHE_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(cmd_cache, f, indent=2)
+        os.replace(tmp_file, CMD_CACHE_FILE)
+    except Exception as e:
+        logger.error('Failed to save the command cache: %s', str(e))
+
+def getCmdKey(env_name, spec, interpreter=None):
+    """Hash a normalized command spec together with the env and the interpreter"""
+    content = json.dumps({'env': env_name, 'spec': spec, 'interpreter': interpreter}, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def getEnvInode(env_path):
+    try:
+        return os.stat(env_path).st_ino
+    except OSError:
+        return None
+
+def isCmdCacheValid(entry):
+    # the entry is stale if the env was deleted or created again
+    if entry.get('env_path') is None:
+        return True
+    return getEnvInode(entry['env_path']) == entry.get('env_inode')
+
+def isCmdCached(key):
+    if key not in cmd_cache:
+        return False
+    if not isCmdCacheValid(cmd_cache[key]):
+        logger.info('environment %s has changed, removing cached command: %s', cmd_cache[key]['env'], cmd_cache[key]['cmd'])
+        del cmd_cache[key]
+        saveCmdCache()
+        return False
+    return True
+
+def addCmdCache(key, cmd, env_name):
+    env_path = getEnvPath(env_name)
+    cmd_cache[key] = {'cmd': cmd, 'env': env_name, 'env_path': env_path, 'env_inode': getEnvInode(env_path) if env_path else None, 'time': time.time()}
+    saveCmdCache()
+
+cmd_cache = loadCmdCache()
+
+if opt.cmd_cache == 'show':
+    if len(cmd_cache) == 0:
+        print('The command cache is empty.')
+    for key, entry in sorted(cmd_cache.items(), key=lambda x: x[1].get('time', 0)):
+        print('{} [{}] env={} {}\n    {}'.format(key[:12], 'valid' if isCmdCacheValid(entry) else 'stale', entry['env'] or '(default)', time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.get('time', 0))), entry['cmd']))
+    sys.exit(0)
+elif opt.cmd_cache == 'purge':
+    if os.path.exists(CMD_CACHE_FILE):
+        os.remove(CMD_CACHE_FILE)
+    print('{} cached commands removed.'.format(len(cmd_cache)))
+    sys.exit(0)
+
 def killProcess(pid):
     try:
         cp = psutil.Process(pid)
@@ -111,6 +241,22 @@ try:
 except Exception as e:
     logger.error('Falied to save .pid file: %s', str(e))
 
+# plugins started by this engine share large arrays through files in SHM_DIR
+ENGINE_ID = str(uuid.uuid4())
+SHM_DIR = None
+if sys.platform != "win32":
+    if os.path.isdir('/dev/shm'):
+        SHM_DIR = os.path.join('/dev/shm', 'imjoy-' + ENGINE_ID)
+    else:
+        SHM_DIR = os.path.join(WORKSPACE_DIR, '.shm', ENGINE_ID)
+    try:
+        os.makedirs(SHM_DIR)
+        os.environ['IMJOY_SHM_DIR'] = SHM_DIR
+    except Exception as e:
+        logger.warning('Failed to create the shared memory directory: %s', str(e))
+        SHM_DIR = None
+os.environ['IMJOY_ENGINE_ID'] = ENGINE_ID
+
 WEB_APP_DIR = os.path.join(WORKSPACE_DIR, '__ImJoy__')
 if opt.serve:
     if shutil.which('git') is None:
@@ -135,7 +281,14 @@ if opt.serve:
             print('Failed to download files, please check whether you have internet access.')
             sys.exit(4)
 
+if sys.platform == "win32":
+    # subprocesses are only supported by the proactor event loop on Windows
+    asyncio.set_event_loop(asyncio.ProactorEventLoop())
+
 MAX_ATTEMPTS = 1000
+OUTPUT_CHUNK_SIZE = 2 ** 16
+# seconds the output of a killed plugin can still be read
+PLUGIN_LOG_GRACE_PERIOD = 60
 NAME_SPACE = '/'
 # ALLOWED_ORIGINS = ['http://'+opt.host+':'+opt.port, 'http://imjoy.io', 'https://imjoy.io']
 sio = socketio.AsyncServer()
@@ -188,35 +341,127 @@ app.router.add_get('/about', about)
 
 attempt_count = 0
 
-cmd_history = []
+setup_semaphore = None
+env_locks = {}
+setup_jobs = {}
 default_requirements_py2 = ["requests", "six", "websocket-client", "numpy", "psutil"]
-default_requirements_py3 = ["requests", "six", "websocket-client", "janus", "numpy", "psutil"]
+# aiohttp lets python 3 workers receive messages in their event loop
+default_requirements_py3 = ["requests", "six", "websocket-client", "janus", "numpy", "psutil", "aiohttp"]
 
 script_dir = os.path.dirname(os.path.normpath(__file__))
 template_script = os.path.abspath(os.path.join(script_dir, 'imjoyWorkerTemplate.py'))
-
-if sys.platform == "linux" or sys.platform == "linux2":
-    # linux
-    command_template = '/bin/bash -c "source {}/bin/activate"'
-    conda_activate = command_template.format("$(conda info --json -s | python -c \"import sys, json; print(json.load(sys.stdin)['conda_prefix']);\")")
-elif sys.platform == "darwin":
-    # OS X
-    conda_activate = "source activate"
-elif sys.platform == "win32":
-    # Windows...
-    conda_activate = "activate"
-else:
-    conda_activate = "conda activate"
+fork_server_script = os.path.abspath(os.path.join(script_dir, 'imjoyForkServer.py'))
+fork_server = None
+
+# conda env name -> prefix, python and activation variables
+conda_envs = {}
+
+def getActivationVars(env_path):
+    """Activate a conda env in a shell once and return the variables it changed"""
+    root_prefix = getCondaInfo().get('root_prefix', None)
+    if root_prefix is None:
+        raise Exception('conda root prefix is not available.')
+    dump = '"{}" -c "import os, json; print(json.dumps(dict(os.environ)))"'.format(sys.executable)
+    if sys.platform == "win32":
+        command = 'call "{}" "{}" && {}'.format(os.path.join(root_prefix, 'Scripts', 'activate.bat'), env_path, dump)
+        output = subprocess.check_output(command, shell=True)
+    else:
+        command = 'source "{}" "{}" && {}'.format(os.path.join(root_prefix, 'bin', 'activate'), env_path, dump)
+        output = subprocess.check_output(['/bin/bash', '-c', command])
+    # activation scripts may print messages before the variables
+    activated = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    # skip the variables set by the shell itself
+    return {k: v for k, v in activated.items() if os.environ.get(k) != v and k not in ['_', 'SHLVL', 'PWD', 'OLDPWD']}
+
+def getEnvMtime(env_path):
+    mtime = os.stat(env_path).st_mtime
+    meta_path = os.path.join(env_path, 'conda-meta')
+    if os.path.exists(meta_path):
+        mtime = max(mtime, os.stat(meta_path).st_mtime)
+    return mtime
+
+def getCondaEnv(env_name):
+    """
+    Resolve the prefix, the python and the activation variables of a conda env,
+    the result is cached until the env directory changes
+    """
+    env_path = getEnvPath(env_name)
+    if env_path is None:
+        conda_envs.pop(env_name, None)
+        return None
+    mtime = getEnvMtime(env_path)
+    conda_env = conda_envs.get(env_name, None)
+    if conda_env is not None and conda_env['path'] == env_path and conda_env['mtime'] == mtime:
+        return conda_env
+    if sys.platform == "win32":
+        python = os.path.join(env_path, 'python.exe')
+    else:
+        python = os.path.join(env_path, 'bin', 'python')
+    try:
+        env_vars = getActivationVars(env_path)
+    except Exception:
+        # the env must not be used with the variables of the engine
+        conda_envs.pop(env_name, None)
+        raise
+    conda_env = {'path': env_path, 'mtime': mtime, 'python': python, 'vars': env_vars}
+    conda_envs[env_name] = conda_env
+    logger.info('resolved conda env %s: %s', env_name or '(default)', env_path)
+    return conda_env
+
+class OutputBuffer():
+    """
+    Ring buffer keeping the last `capacity` bytes of a plugin's output,
+    positions are absolute offsets in the output stream so readers can tail it
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._chunks = collections.deque()
+        self._size = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            self._chunks.append(data)
+            self._size += len(data)
+            self._end += len(data)
+            while self._size > self.capacity:
+                extra = self._size - self.capacity
+                if len(self._chunks[0]) <= extra:
+                    self._size -= len(self._chunks.popleft())
+                else:
+                    self._chunks[0] = self._chunks[0][extra:]
+                    self._size -= extra
+
+    def read(self, since=None):
+        with self._lock:
+            start = self._end - self._size
+            data = b''.join(self._chunks)
+            end = self._end
+        if since is not None and since > start:
+            data = data[min(since, end) - start:]
+            start = min(since, end)
+        return data, start, end
 
 plugins = {}
+plugin_logs = {}
 plugin_sessions = {}
 plugin_sids = {}
 plugin_signatures = {}
+plugin_secrets = {}
 clients = {}
 client_sessions = {}
 registered_sessions = {}
-
-def resumePluginSession(pid, session_id, plugin_signature):
+connected_sids = set()
+ipc_socket = None
+ipc_connections = {}
+worker_pools = {}
+pool_workers = {}
+routing_stats = {'messages': 0, 'deliveries_saved': 0, 'bytes_saved': 0}
+# features announced by the clients to the plugins, e.g. 'batch'
+client_features = {}
+
+def resumePluginSession(pid, session_id, plugin_signature, sid=None):
     if pid in plugins:
         if session_id in plugin_sessions:
             plugin_sessions[session_id].append(plugins[pid])
@@ -224,10 +469,114 @@ def resumePluginSession(pid, session_id, plugin_signature):
             plugin_sessions[session_id] = [plugins[pid]]
     if plugin_signature in plugin_signatures:
         secret = plugin_signatures[plugin_signature]
+        if sid is not None and secret in plugin_secrets:
+            addPluginClient(plugin_secrets[secret], sid)
         return secret
     else:
         return None
 
+def addPluginClient(plugin_info, sid):
+    if sid not in plugin_info['client_sids']:
+        plugin_info['client_sids'].append(sid)
+
+def getPayloadSize(obj):
+    if isinstance(obj, (bytes, bytearray, str)):
+        return len(obj)
+    elif isinstance(obj, dict):
+        return sum(len(str(k)) + getPayloadSize(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return sum(getPayloadSize(v) for v in obj)
+    else:
+        return 8
+
+async def emitToPeers(event, data, sids, callback=None):
+    """
+    Emit an event only to the given sids instead of broadcasting it,
+    and count what a broadcast would have cost (bytes only in debug mode)
+    """
+    routing_stats['messages'] += 1
+    # a broadcast would have reached every client
+    skipped = len(registered_sessions) - sum(1 for sid in sids if sid in registered_sessions)
+    if skipped > 0:
+        routing_stats['deliveries_saved'] += skipped
+        if logger.isEnabledFor(logging.DEBUG):
+            # walking the payload is only worth it when debugging
+            routing_stats['bytes_saved'] += skipped * getPayloadSize(data)
+    for sid in sids:
+        if sid in ipc_connections:
+            await ipc_connections[sid].emit(event, data, callback=callback)
+        else:
+            await sio.emit(event, data, room=sid, namespace=NAME_SPACE, callback=callback)
+
+class IPCConnection():
+    """
+    A worker connected through the unix socket, it gets a sid and its events
+    go to the socket.io handlers like the ones of a socket.io client
+    """
+    def __init__(self, reader, writer):
+        self.sid = 'ipc-' + str(uuid.uuid4())
+        self.reader = reader
+        self.writer = writer
+        self._callbacks = {}
+        self._ack_id = 0
+        self._lock = asyncio.Lock()
+
+    async def emit(self, event, data, callback=None):
+        header = {'event': event}
+        if callback is not None:
+            self._ack_id += 1
+            header['ack'] = self._ack_id
+            self._callbacks[self._ack_id] = callback
+        await self.send(header, data)
+
+    async def send(self, header, data):
+        async with self._lock:
+            self.writer.writelines(pack_frame(header, data))
+            await self.writer.drain()
+
+    async def read_frame(self):
+        size = HEADER.unpack(await self.reader.readexactly(HEADER.size))[0]
+        header = unpack_header(await self.reader.readexactly(size))
+        attachments = [await self.reader.readexactly(n) for n in header['attachments']]
+        return header, reconstruct(header['data'], attachments)
+
+async def handle_ipc_connection(reader, writer):
+    conn = IPCConnection(reader, writer)
+    ipc_connections[conn.sid] = conn
+    connected_sids.add(conn.sid)
+    logger.info("connect %s", conn.sid)
+    try:
+        while True:
+            header, data = await conn.read_frame()
+            if 'reply' in header:
+                callback = conn._callbacks.pop(header['reply'], None)
+                if callback is not None:
+                    callback(*data)
+                continue
+            handler = sio.handlers.get(NAME_SPACE, {}).get(header['event'], None)
+            if handler is None:
+                logger.debug('no handler for event %s from %s', header['event'], conn.sid)
+                continue
+            # handled one after the other to keep the messages in order
+            ret = handler(conn.sid, data)
+            if asyncio.iscoroutine(ret):
+                ret = await ret
+            if 'ack' in header:
+                await conn.send({'reply': header['ack']}, [ret])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as e:
+        logger.error('error in connection %s: %s', conn.sid, traceback.format_exc())
+    finally:
+        del ipc_connections[conn.sid]
+        writer.close()
+        await disconnect(conn.sid)
+
+def getIPCArgs():
+    if ipc_socket is None:
+        return ''
+    return ' --ipc="{}"'.format(ipc_socket)
+
 def addClientSession(session_id, client_id, sid):
     if client_id in clients:
         clients[client_id].append(sid)
@@ -240,6 +589,9 @@ def addClientSession(session_id, client_id, sid):
 
 def disconnectClientSession(sid):
     tasks = []
+    for plugin_info in plugins.values():
+        if sid in plugin_info['client_sids']:
+            plugin_info['client_sids'].remove(sid)
     if sid in registered_sessions:
         client_id, session_id = registered_sessions[sid]
         del registered_sessions[sid]
@@ -258,6 +610,7 @@ def addPlugin(plugin_info, sid=None):
     pid = plugin_info['id']
     session_id = plugin_info['session_id']
     plugin_signatures[plugin_info['signature']] = plugin_info['secret']
+    plugin_secrets[plugin_info['secret']] = plugin_info
     plugins[pid] = plugin_info
     if session_id in plugin_sessions:
         plugin_sessions[session_id].append(plugin_info)
@@ -268,6 +621,21 @@ def addPlugin(plugin_info, sid=None):
         plugin_sids[sid] = plugin_info
         plugin_info['sid'] = sid
 
+def addPluginLog(plugin_info, output):
+    plugin_logs[plugin_info['id']] = {'output': output, 'client_id': plugin_info['client_id'], 'session_id': plugin_info['session_id']}
+    return output
+
+def removePluginLog(pid):
+    """Remove the output of a plugin after PLUGIN_LOG_GRACE_PERIOD, the clients may still read why it exited"""
+    entry = plugin_logs.get(pid, None)
+    if entry is None:
+        return
+    def remove():
+        # a new plugin may have been started with the same id
+        if plugin_logs.get(pid, None) is entry:
+            del plugin_logs[pid]
+    asyncio.get_event_loop().call_later(PLUGIN_LOG_GRACE_PERIOD, remove)
+
 def disconnectPlugin(sid):
     tasks = []
     if sid in plugin_sids:
@@ -275,7 +643,9 @@ def disconnectPlugin(sid):
         if pid in plugins:
             if plugins[pid]['signature'] in plugin_signatures:
                 del plugin_signatures[plugins[pid]['signature']]
+            plugin_secrets.pop(plugins[pid]['secret'], None)
             del plugins[pid]
+            removePluginLog(pid)
         del plugin_sids[sid]
         for session_id in plugin_sessions.keys():
             exist = False
@@ -288,12 +658,16 @@ def disconnectPlugin(sid):
     return tasks
 
 def setPluginPID(plugin_id, pid):
-    plugins[plugin_id]['process_id'] = pid
+    if plugin_id in plugins:
+        plugins[plugin_id]['process_id'] = pid
+    elif plugin_id in pool_workers:
+        pool_workers[plugin_id]['process_id'] = pid
 
 def killPlugin(pid):
     if pid in plugins:
         if plugins[pid]['signature'] in plugin_signatures:
             del plugin_signatures[plugins[pid]['signature']]
+        plugin_secrets.pop(plugins[pid]['secret'], None)
         try:
             plugins[pid]['abort'].set()
             killProcess(plugins[pid]['process_id'])
@@ -305,6 +679,7 @@ def killPlugin(pid):
             if plugins[pid]['sid'] in plugin_sids:
                 del plugin_sids[plugins[pid]['sid']]
         del plugins[pid]
+        removePluginLog(pid)
 
 
 def killAllPlugins():
@@ -318,6 +693,7 @@ def killAllPlugins():
 
 @sio.on('connect', namespace=NAME_SPACE)
 def connect(sid, environ):
+    connected_sids.add(sid)
     logger.info("connect %s", sid)
 
 @sio.on('init_plugin', namespace=NAME_SPACE)
@@ -347,7 +723,7 @@ async def on_init_plugin(sid, kwargs):
     plugin_signature = "{}/{}/{}".format(workspace, pname, tag)
 
     if 'single-instance' in flags:
-        secret = resumePluginSession(pid, session_id, plugin_signature)
+        secret = resumePluginSession(pid, session_id, plugin_signature, sid)
         if secret is not None:
             logger.debug('plugin already initialized: %s', pid)
             # await sio.emit('message_from_plugin_'+secret, {"type": "initialized", "dedicatedThread": True})
@@ -394,50 +770,66 @@ async def on_init_plugin(sid, kwargs):
     default_requirements = default_requirements_py2 if is_py2 else default_requirements_py3
 
     requirements_cmd = "pip install " + " ".join(default_requirements) + ' ' + requirements_pip
+    if type(requirements) is list:
+        requirements_spec = sorted(set(default_requirements + requirements))
+    else:
+        requirements_spec = [sorted(default_requirements), requirements.strip()]
+    requirements_key = getCmdKey(env_name, requirements_spec, cmd)
     if opt.freeze:
         print("WARNING: blocked pip command: \n{}\nYou may want to run it yourself.".format(requirements_cmd))
         logger.warning('pip command is blocked due to `--freeze` mode: %s', requirements_cmd)
         requirements_cmd = None
 
-    if not opt.freeze and CONDA_AVAILABLE:
-        # if env_name is not None:
-        requirements_cmd = conda_activate + " "+ env_name + " && " + requirements_cmd
-        # if env_name is not None:
-        cmd = conda_activate + " " + env_name + " && " + cmd
-
     secretKey = str(uuid.uuid4())
     abort = threading.Event()
-    plugin_info = {'secret': secretKey, 'id': pid, 'abort': abort, 'flags': flags, 'session_id': session_id, 'name': config['name'], 'type': config['type'], 'client_id': client_id, 'signature': plugin_signature}
+    plugin_info = {'secret': secretKey, 'id': pid, 'abort': abort, 'flags': flags, 'session_id': session_id, 'name': config['name'], 'type': config['type'], 'client_id': client_id, 'signature': plugin_signature, 'client_sids': [sid]}
+    output = addPluginLog(plugin_info, OutputBuffer(opt.plugin_log_size))
     addPlugin(plugin_info)
 
     @sio.on('from_plugin_'+secretKey, namespace=NAME_SPACE)
     async def message_from_plugin(sid, kwargs):
         # print('forwarding message_'+secretKey, kwargs)
         if kwargs['type'] in ['initialized', 'importSuccess', 'importFailure', 'executeSuccess', 'executeFailure']:
-            await sio.emit('message_from_plugin_'+secretKey,  kwargs)
-            logger.debug('message from %s', pid)
             if kwargs['type'] == 'initialized':
                 addPlugin(plugin_info, sid)
+            await emitToPeers('message_from_plugin_'+secretKey, kwargs, plugin_info['client_sids'])
+            logger.debug('message from %s', pid)
+        elif kwargs['type'] == 'batch':
+            # unpack the batches for the clients which can not dispatch them
+            sids = [s for s in plugin_info['client_sids'] if 'batch' in client_features.get(s, ())]
+            if sids:
+                await emitToPeers('message_from_plugin_'+secretKey, {'type': 'message', 'data': kwargs}, sids)
+            sids = [s for s in plugin_info['client_sids'] if 'batch' not in client_features.get(s, ())]
+            if sids:
+                for msg in kwargs['messages']:
+                    await emitToPeers('message_from_plugin_'+secretKey, {'type': 'message', 'data': msg}, sids)
         else:
-            await sio.emit('message_from_plugin_'+secretKey, {'type': 'message', 'data': kwargs})
+            await emitToPeers('message_from_plugin_'+secretKey, {'type': 'message', 'data': kwargs}, plugin_info['client_sids'])
 
     @sio.on('message_to_plugin_'+secretKey, namespace=NAME_SPACE)
     async def message_to_plugin(sid, kwargs):
         # print('forwarding message_to_plugin_'+secretKey, kwargs)
         if kwargs['type'] == 'message':
-            await sio.emit('to_plugin_'+secretKey, kwargs['data'])
+            if kwargs['data'].get('type', None) == 'features':
+                client_features[sid] = set(kwargs['data'].get('features', []))
+            await emitToPlugin(plugin_info, kwargs['data'])
         logger.debug('message to plugin %s', secretKey)
 
     try:
-        taskThread = threading.Thread(target=launch_plugin, args=[pid, envs, requirements_cmd,
-                                      '{} "{}" --id="{}" --host={} --port={} --secret="{}" --namespace={}'.format(cmd, template_script, pid, opt.host, opt.port, secretKey, NAME_SPACE), work_dir, abort, pid, plugin_env])
-        taskThread.daemon = True
-        taskThread.start()
+        plugin_info['task'] = asyncio.ensure_future(launch_plugin(pid, env_name, envs, requirements_cmd, requirements_key, cmd, secretKey, work_dir, abort, pid, plugin_env, output))
         return {'success': True, 'initialized': False, 'secret': secretKey, 'work_dir': os.path.abspath(work_dir)}
     except Exception as e:
         logger.error(e)
         return {'success': False}
 
+async def emitToPlugin(plugin_info, data, callback=None):
+    if 'sid' in plugin_info:
+        await emitToPeers('to_plugin_'+plugin_info['secret'], data, [plugin_info['sid']], callback=callback)
+    else:
+        # the plugin has not reported its sid yet
+        logger.debug('plugin %s is not connected, broadcasting message.', plugin_info['id'])
+        await sio.emit('to_plugin_'+plugin_info['secret'], data, namespace=NAME_SPACE, callback=callback)
+
 async def force_kill_timeout(t, obj):
     pid = obj['pid']
     for i in range(int(t*10)):
@@ -464,7 +856,7 @@ async def on_kill_plugin(sid, kwargs):
                 logger.info('Plugin %s exited normally.', pid)
                 # kill the plugin now
                 killPlugin(pid)
-            await sio.emit('to_plugin_'+plugins[pid]['secret'], {'type': 'disconnect'}, callback=exited)
+            await emitToPlugin(plugins[pid], {'type': 'disconnect'}, callback=exited)
             await force_kill_timeout(FORCE_QUIT_TIMEOUT, obj)
     return {'success': True}
 
@@ -499,54 +891,244 @@ async def on_register_client(sid, kwargs):
         logger.info("register client: %s", kwargs)
         return {'success': True, 'confirmation': confirmation, 'message': message}
 
-def scandir(path, type=None, recursive=False):
+class DirCache():
+    """
+    The entries of listed directories, as sorted (name, is_dir) tuples.
+
+    A cached listing is used while the modification time of its directory is
+    unchanged. When inotify is available (inotify_simple), up to `max_watches`
+    listings are dropped as soon as their directory changes and no stat is
+    needed, the others keep checking the modification time.
+    """
+    def __init__(self, max_dirs, max_watches):
+        self.max_dirs = max_dirs
+        self.max_watches = max_watches
+        # path -> (mtime, entries, inotify watch descriptor or None)
+        self.dirs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # watch descriptor -> path, and the number of changes seen per path
+        self.watches = {}
+        self.changes = collections.Counter()
+        self.inotify = None
+        self.inotify_started = False
+
+    def startInotify(self):
+        # started on first use, the tile server forks its processes before
+        with self.lock:
+            if self.inotify_started:
+                return
+            self.inotify_started = True
+            if inotify_simple is None:
+                return
+            try:
+                self.inotify = inotify_simple.INotify()
+            except OSError as e:
+                logger.info('inotify is not available: %s', e)
+                return
+        t = threading.Thread(target=self.watch)
+        t.daemon = True
+        t.start()
+
+    def watch(self):
+        while True:
+            for event in self.inotify.read():
+                with self.lock:
+                    path = self.watches.get(event.wd, None)
+                    if path is None:
+                        continue
+                    self.changes[path] += 1
+                    self.dirs.pop(path, None)
+                    self.removeWatch(event.wd)
+
+    def removeWatch(self, wd):
+        if self.watches.pop(wd, None) is not None:
+            try:
+                self.inotify.rm_watch(wd)
+            except OSError:
+                # the directory was removed
+                pass
+
+    def addWatch(self, path):
+        self.startInotify()
+        if self.inotify is None or len(self.watches) >= self.max_watches:
+            return None
+        flags = inotify_simple.flags
+        try:
+            wd = self.inotify.add_watch(path, flags.CREATE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO | flags.DELETE_SELF | flags.MOVE_SELF)
+        except OSError:
+            # e.g. the limit of watches is reached
+            return None
+        with self.lock:
+            self.watches[wd] = path
+        return wd
+
+    def list(self, path):
+        with self.lock:
+            cached = self.dirs.get(path, None)
+            if cached is not None:
+                self.dirs.move_to_end(path)
+            changes = self.changes[path]
+        if cached is not None and (cached[2] is not None or os.stat(path).st_mtime_ns == cached[0]):
+            return cached[1]
+        # watch before listing so no change is missed
+        wd = self.addWatch(path)
+        mtime = os.stat(path).st_mtime_ns
+        entries = sorted((f.name, f.is_dir()) for f in os.scandir(path) if not f.name.startswith('.'))
+        with self.lock:
+            if wd is not None and (self.changes[path] != changes or wd not in self.watches):
+                # changed while being listed, rely on the modification time
+                wd = None
+            self.dirs[path] = (mtime, entries, wd)
+            while len(self.dirs) > self.max_dirs:
+                _, (_, _, old_wd) = self.dirs.popitem(last=False)
+                if old_wd is not None:
+                    self.removeWatch(old_wd)
+        return entries
+
+def getMaxWatches():
+    try:
+        with open('/proc/sys/fs/inotify/max_user_watches') as f:
+            max_user_watches = int(f.read())
+    except (OSError, ValueError):
+        return DIR_WATCH_LIMIT
+    return min(DIR_WATCH_LIMIT, int(max_user_watches * DIR_WATCH_FRACTION))
+
+dir_cache = DirCache(DIR_CACHE_SIZE, getMaxWatches())
+
+def scandir(path, type=None, recursive=False, depth=None):
+    """
+    List a directory as a tree, `depth` limits the number of levels listed
+    when `recursive` is set.
+    """
+    if not recursive:
+        depth = 1
     file_list = []
-    for f in os.scandir(path):
-        if f.name.startswith('.'):
-            continue
-        if type is None or type == 'file':
-            if os.path.isdir(f.path):
-                if recursive:
-                    file_list.append({'name': f.name, 'type': 'dir', 'children': scandir(f.path, type, recursive)})
-                else:
-                    file_list.append({'name': f.name, 'type': 'dir'})
+    for name, is_dir in dir_cache.list(path):
+        if type == 'directory':
+            if is_dir:
+                file_list.append({'name': name})
+        elif is_dir:
+            if depth is None or depth > 1:
+                file_list.append({'name': name, 'type': 'dir', 'children': scandir(os.path.join(path, name), type, True, None if depth is None else depth - 1)})
             else:
-                file_list.append({'name': f.name, 'type': 'file'})
-        elif type == 'directory':
-            if os.path.isdir(f.path):
-                file_list.append({'name': f.name})
+                file_list.append({'name': name, 'type': 'dir'})
+        else:
+            file_list.append({'name': name, 'type': 'file'})
     return file_list
 
+def walkDir(root, type=None, depth=None, rel=''):
+    """
+    Yield the entries below `root` depth first, with their path relative to
+    `root`. Unreadable sub-directories are listed without their content.
+    """
+    try:
+        entries = dir_cache.list(os.path.join(root, rel) if rel else root)
+    except OSError:
+        if rel == '':
+            raise
+        return
+    for name, is_dir in entries:
+        path = rel + '/' + name if rel else name
+        if is_dir:
+            yield {'name': name, 'path': path, 'type': 'dir'}
+            if depth is None or depth > 1:
+                for entry in walkDir(root, type, None if depth is None else depth - 1, path):
+                    yield entry
+        elif type != 'directory':
+            yield {'name': name, 'path': path, 'type': 'file'}
+
+list_dir_cursors = {}
+
+async def next_dir_page(cursor_id, page_size):
+    cursor = list_dir_cursors[cursor_id]
+    async with cursor['lock']:
+        cursor['time'] = time.time()
+        page = await asyncio.get_event_loop().run_in_executor(None, lambda: list(itertools.islice(cursor['entries'], page_size)))
+    if len(page) < page_size:
+        list_dir_cursors.pop(cursor_id, None)
+        cursor_id = None
+    return page, cursor_id
+
+async def stream_dir(sid, stream_id, cursor_id, page_size):
+    try:
+        while cursor_id is not None and sid in registered_sessions:
+            page, cursor_id = await next_dir_page(cursor_id, page_size)
+            await sio.emit('list_dir_page', {'id': stream_id, 'children': page, 'done': cursor_id is None}, room=sid, namespace=NAME_SPACE)
+    except Exception as e:
+        logger.error('failed to list the directory: %s', traceback.format_exc())
+        await sio.emit('list_dir_page', {'id': stream_id, 'children': [], 'done': True, 'error': str(e)}, room=sid, namespace=NAME_SPACE)
+    finally:
+        list_dir_cursors.pop(cursor_id, None)
+
 @sio.on('list_dir', namespace=NAME_SPACE)
 async def on_list_dir(sid, kwargs):
+    """
+    List a directory as a tree, in the thread pool.
+
+    With `page_size`, the entries of the tree are returned as a flat list of
+    at most `page_size` entries with their relative `path`, and a `cursor`
+    for getting the next page ({'cursor': cursor, 'page_size': ...}), which
+    is None on the last page. With `stream`, the pages are sent as
+    `list_dir_page` events with the `id` of the request instead.
+    `depth` limits the number of levels listed.
+    """
     if sid not in registered_sessions:
         logger.debug('client %s is not registered.', sid)
         return {'success': False, 'error': 'client has not been registered.'}
+    now = time.time()
+    for cursor_id in [k for k, v in list_dir_cursors.items() if now - v['time'] > LIST_DIR_CURSOR_TIMEOUT]:
+        del list_dir_cursors[cursor_id]
+    page_size = kwargs.get('page_size', None)
+    if page_size is None:
+        page_size = LIST_DIR_PAGE_SIZE
+    elif not isinstance(page_size, int) or isinstance(page_size, bool) or page_size <= 0:
+        return {'success': False, 'error': 'page_size must be a positive integer.'}
+    if kwargs.get('cursor', None) is not None:
+        # the cursors of other clients are not disclosed
+        if kwargs['cursor'] not in list_dir_cursors or list_dir_cursors[kwargs['cursor']]['sid'] != sid:
+            return {'success': False, 'error': 'the cursor does not exist or has expired.'}
+        page, cursor_id = await next_dir_page(kwargs['cursor'], page_size)
+        return {'success': True, 'children': page, 'cursor': cursor_id}
+
     path = kwargs.get('path', '~')
     type = kwargs.get('type', None)
     recursive = kwargs.get('recursive', False)
+    depth = kwargs.get('depth', None) if recursive else 1
     files_list = {'success': True}
     path = os.path.normpath(os.path.expanduser(path))
+    if not os.path.isdir(path):
+        return {'success': False, 'error': 'directory {} does not exist.'.format(path)}
     files_list['path'] = path
     files_list['name'] = os.path.basename(os.path.abspath(path))
     files_list['type'] = 'dir'
 
-    files_list['children'] = scandir(files_list['path'], type, recursive)
+    if kwargs.get('page_size', None) is None and not kwargs.get('stream', False):
+        files_list['children'] = await asyncio.get_event_loop().run_in_executor(None, scandir, path, type, recursive, depth)
+        return files_list
+    cursor_id = str(uuid.uuid4())
+    list_dir_cursors[cursor_id] = {'entries': walkDir(path, type, depth), 'lock': asyncio.Lock(), 'time': now, 'sid': sid}
+    if kwargs.get('stream', False):
+        files_list['id'] = kwargs.get('id', None) or cursor_id
+        asyncio.ensure_future(stream_dir(sid, files_list['id'], cursor_id, page_size))
+    else:
+        files_list['children'], files_list['cursor'] = await next_dir_page(cursor_id, page_size)
     return files_list
 
 generatedUrls = {}
 generatedUrlFiles = {}
-@streamer
-async def file_sender(writer, file_path=None):
+FILE_CORS_HEADERS = {'Access-Control-Allow-Origin': '*',
+                     'Access-Control-Allow-Headers': 'origin, range, if-none-match, if-modified-since',
+                     'Access-Control-Allow-Methods': 'GET, HEAD',
+                     'Access-Control-Expose-Headers': 'Content-Length, Content-Range, Accept-Ranges, ETag, Last-Modified'
+                    }
+
+def file_response(file_path, headers):
     """
-    This function will read large file chunk by chunk and send it through HTTP
-    without reading them into memory
+    Send a file with sendfile when available, without blocking the event loop.
+    Range requests, conditional requests (ETag, If-Modified-Since) and the
+    Content-Length header are handled by aiohttp.
     """
-    with open(file_path, 'rb') as f:
-        chunk = f.read(2 ** 16)
-        while chunk:
-            await writer.write(chunk)
-            chunk = f.read(2 ** 16)
+    return web.FileResponse(file_path, chunk_size=2 ** 20, headers=headers)
 
 async def download_file(request):
     # origin = request.headers.get(hdrs.ORIGIN)
@@ -566,10 +1148,7 @@ async def download_file(request):
         if password != fileInfo['password']:
             raise web.HTTPForbidden(text="Incorrect password for accessing this file.")
     headers = fileInfo.get('headers', None)
-    default_headers = {'Access-Control-Allow-Origin': '*',
-                       'Access-Control-Allow-Headers': 'origin',
-                       'Access-Control-Allow-Methods': 'GET'
-                      }
+    default_headers = FILE_CORS_HEADERS
     if fileInfo['type'] == 'dir':
         dirname = os.path.dirname(name)
         # list the folder
@@ -583,7 +1162,7 @@ async def download_file(request):
                     status=404
                 )
             else:
-                file_list = scandir(folder_path, 'file', False)
+                file_list = await asyncio.get_event_loop().run_in_executor(None, scandir, folder_path, 'file', False)
                 headers = headers or {'Content-Disposition': 'inline; filename="{filename}"'.format(filename=name)}
                 headers.update(default_headers)
                 return web.json_response(file_list, headers=headers)
@@ -597,7 +1176,7 @@ async def download_file(request):
                 )
             if os.path.isdir(file_path):
                 _, folder_name = os.path.split(file_path)
-                file_list = scandir(file_path, 'file', False)
+                file_list = await asyncio.get_event_loop().run_in_executor(None, scandir, file_path, 'file', False)
                 headers = headers or {'Content-Disposition': 'inline; filename="{filename}"'.format(filename=folder_name)}
                 headers.update(default_headers)
                 return web.json_response(file_list, headers=headers)
@@ -606,10 +1185,7 @@ async def download_file(request):
                 mime_type = MimeTypes().guess_type(file_name)[0] or 'application/octet-stream'
                 headers = headers or {'Content-Disposition': 'inline; filename="{filename}"'.format(filename=file_name), 'Content-Type': mime_type}
                 headers.update(default_headers)
-                return web.Response(
-                    body=file_sender(file_path=file_path),
-                    headers= headers
-                )
+                return file_response(file_path, headers)
     elif fileInfo['type'] == 'file':
         file_path = fileInfo['path']
         if name != fileInfo['name']:
@@ -623,14 +1199,70 @@ async def download_file(request):
         mime_type = MimeTypes().guess_type(file_name)[0] or 'application/octet-stream'
         headers = headers or {'Content-Disposition': 'inline; filename="{filename}"'.format(filename=file_name), 'Content-Type': mime_type}
         headers.update(default_headers)
-        return web.Response(
-            body=file_sender(file_path=file_path),
-            headers=headers
-        )
+        return file_response(file_path, headers)
     else:
         raise web.HTTPForbidden(text='Unsupported file type: '+ fileInfo['type'])
 
+async def download_file_preflight(request):
+    # range and conditional requests from other origins are preflighted
+    return web.Response(headers=FILE_CORS_HEADERS)
+
 app.router.add_get('/file/{urlid}', download_file)
+app.router.add_route('OPTIONS', '/file/{urlid}', download_file_preflight)
+
+tile_server = TileServer(os.path.join(WORKSPACE_DIR, '.tile_cache'), opt.tile_cache_size * 1024 * 1024, opt.tile_workers)
+
+def getTileFilePath(request):
+    """
+    Return the path of the image shared with a file url, the url of a folder
+    can be used with the name of a file in that folder.
+    """
+    urlid = request.match_info['urlid']
+    if urlid not in generatedUrls:
+        raise web.HTTPForbidden(text="Invalid URL")
+    fileInfo = generatedUrls[urlid]
+    if fileInfo.get('password', False):
+        password = request.rel_url.query.get('password', None)
+        if password != fileInfo['password']:
+            raise web.HTTPForbidden(text="Incorrect password for accessing this file.")
+    name = request.rel_url.query.get('name', fileInfo['name'])
+    if name.split('/')[0] != fileInfo['name']:
+        raise web.HTTPForbidden(text="File name does not match server record!")
+    if fileInfo['type'] == 'dir' and '/' in name:
+        file_path = os.path.realpath(os.path.join(fileInfo['path'], os.sep.join(name.split('/')[1:])))
+        if not file_path.startswith(os.path.realpath(fileInfo['path']) + os.sep):
+            raise web.HTTPForbidden(text="File is outside of the shared folder.")
+    else:
+        file_path = fileInfo['path']
+    if not os.path.exists(file_path):
+        raise web.HTTPNotFound(text='File <{}> does not exist'.format(name))
+    return file_path
+
+async def tile_response(coro):
+    try:
+        return await coro
+    except ImportError as e:
+        raise web.HTTPNotImplemented(text=str(e))
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+async def download_tile_info(request):
+    file_path = getTileFilePath(request)
+    info = await tile_response(tile_server.get_info(file_path))
+    return web.json_response(info, headers=FILE_CORS_HEADERS)
+
+async def download_tile(request):
+    file_path = getTileFilePath(request)
+    level, col, row = [int(request.match_info[k]) for k in ('level', 'col', 'row')]
+    data, content_type = await tile_response(tile_server.get_tile(file_path, level, col, row, request.match_info['format']))
+    headers = {'Content-Type': content_type, 'Cache-Control': 'max-age=3600'}
+    headers.update(FILE_CORS_HEADERS)
+    return web.Response(body=data, headers=headers)
+
+# tiles of the image shared with /file/{urlid}
+app.router.add_get('/tile/{urlid}/info.json', download_tile_info)
+app.router.add_get(r'/tile/{urlid}/{level:\d+}/{col:\d+}_{row:\d+}.{format:[a-z]+}', download_tile)
+app.router.add_route('OPTIONS', '/tile/{urlid}/{tail:.*}', download_file_preflight)
 
 @sio.on('get_file_url', namespace=NAME_SPACE)
 async def on_get_file_url(sid, kwargs):
@@ -679,70 +1311,266 @@ async def on_get_file_path(sid, kwargs):
     else:
         return {'success': False, 'error': 'url not found.' }
 
+@sio.on('get_plugin_log', namespace=NAME_SPACE)
+async def on_get_plugin_log(sid, kwargs):
+    if sid not in registered_sessions:
+        logger.debug('client %s is not registered.', sid)
+        return {'success': False, 'error': 'client has not been registered.'}
+    pid = kwargs['id']
+    client_id, session_id = registered_sessions[sid]
+    entry = plugin_logs.get(pid, None)
+    # only the client or the session which started the plugin can read it
+    if entry is None or (entry['client_id'] != client_id and entry['session_id'] != session_id):
+        return {'success': False, 'error': 'no output recorded for plugin {}.'.format(pid)}
+    data, start, end = entry['output'].read(kwargs.get('since', None))
+    return {'success': True, 'log': data.decode('utf-8', 'replace'), 'start': start, 'end': end}
+
+@sio.on('get_engine_status', namespace=NAME_SPACE)
+async def on_get_engine_status(sid, kwargs):
+    if sid not in registered_sessions:
+        logger.debug('client %s is not registered.', sid)
+        return {'success': False, 'error': 'client has not been registered.'}
+    return {'success': True, 'plugin_num': len(plugins), 'connection_num': len(connected_sids), 'setup_jobs': len(setup_jobs), 'routing': routing_stats}
+
 @sio.on('message', namespace=NAME_SPACE)
 async def on_message(sid, kwargs):
     logger.info("message recieved: %s", kwargs)
 
 @sio.on('disconnect', namespace=NAME_SPACE)
 async def disconnect(sid):
+    connected_sids.discard(sid)
+    client_features.pop(sid, None)
     tasks = disconnectClientSession(sid)
     tasks += disconnectPlugin(sid)
     asyncio.gather(*tasks)
     logger.info('disconnect %s', sid)
 
-def launch_plugin(pid, envs, requirements_cmd, args, work_dir, abort, name, plugin_env):
-    if abort.is_set():
-        logger.info('plugin aborting...')
-        return False
+async def run_process(pid, cmd, plugin_env, work_dir, shell=True):
+    if shell:
+        process = await asyncio.create_subprocess_shell(cmd, env=plugin_env, cwd=work_dir)
+    else:
+        process = await asyncio.create_subprocess_exec(*cmd.split(), env=plugin_env, cwd=work_dir)
+    setPluginPID(pid, process.pid)
+    return await process.wait()
+
+def getEnvLock(env_name):
+    if env_name not in env_locks:
+        env_locks[env_name] = asyncio.Lock()
+    return env_locks[env_name]
+
+async def schedule_setup_job(key, env_name, job):
+    """
+    Run a setup command at most once at a time, plugins requesting the same
+    command wait for the same future. Commands of one env run one after the
+    other, commands of different envs run concurrently within `--max_setup_jobs`
+    """
+    if key not in setup_jobs:
+        async def run():
+            try:
+                async with getEnvLock(env_name):
+                    # an equivalent command may have completed while waiting
+                    if isCmdCached(key):
+                        return
+                    async with setup_semaphore:
+                        return await job()
+            finally:
+                del setup_jobs[key]
+        setup_jobs[key] = asyncio.ensure_future(run())
+    else:
+        logger.debug('waiting for the running setup job: %s', key)
+    # cancelling one waiter should not cancel the job for the others
+    return await asyncio.shield(setup_jobs[key])
+
+async def run_env_command(pid, env_name, env, env_key, plugin_env, work_dir):
+    print('Running env command: ' + env)
+    logger.info('running env command: %s', env)
     try:
-        if envs is not None and len(envs)>0:
-            for env in envs:
-                print('Running env command: ' + env)
-                logger.info('running env command: %s', env)
-                if env not in cmd_history:
-                    process = subprocess.Popen(env.split(), shell=False, env=plugin_env, cwd=work_dir)
-                    setPluginPID(pid, process.pid)
-                    process.wait()
-                    cmd_history.append(env)
-                else:
-                    logger.debug('skip command: %s', env)
-
-                if abort.is_set():
-                    logger.info('plugin aborting...')
-                    return False
-
-        logger.info('Running requirements command: %s', requirements_cmd)
-        print('Running requirements command: ' + requirements_cmd)
-        if requirements_cmd is not None and requirements_cmd not in cmd_history:
-            process = subprocess.Popen(requirements_cmd, shell=True, env=plugin_env, cwd=work_dir)
-            setPluginPID(pid, process.pid)
-            ret = process.wait()
+        ret = await run_process(pid, env, plugin_env, work_dir, shell=False)
+    finally:
+        discardPoolWorkers(env_name)
+    # a failed command may leave a broken env behind, only cache successes so
+    # it is run again next time (`conda create` also fails if the env exists)
+    if ret == 0:
+        addCmdCache(env_key, env, env_name)
+    else:
+        logger.warning('env command exited with code %s: %s', ret, env)
+
+async def run_requirements_command(pid, env_name, requirements_cmd, requirements_key, plugin_env, work_dir):
+    try:
+        await install_requirements(pid, env_name, requirements_cmd, requirements_key, plugin_env, work_dir)
+    finally:
+        discardPoolWorkers(env_name)
+
+async def install_requirements(pid, env_name, requirements_cmd, requirements_key, plugin_env, work_dir):
+    print('Running requirements command: ' + requirements_cmd)
+    ret = await run_process(pid, requirements_cmd, plugin_env, work_dir)
+    if ret != 0:
+        git_cmd = ''
+        if shutil.which('git') is None:
+            git_cmd += " git"
+        if shutil.which('pip') is None:
+            git_cmd += " pip"
+        if git_cmd != '':
+            logger.info('pip command failed, trying to install git and pip...')
+            # try to install git and pip
+            git_cmd = "conda install -y" + git_cmd
+            ret = await run_process(pid, git_cmd, plugin_env, work_dir, shell=False)
             if ret != 0:
-                git_cmd = ''
-                if shutil.which('git') is None:
-                    git_cmd += " git"
-                if shutil.which('pip') is None:
-                    git_cmd += " pip"
-                if git_cmd != '':
-                    logger.info('pip command failed, trying to install git and pip...')
-                    # try to install git and pip
-                    git_cmd = "conda install -y" + git_cmd
-                    process = subprocess.Popen(git_cmd.split(), shell=False, env=plugin_env, cwd=work_dir)
-                    setPluginPID(pid, process.pid)
-                    ret = process.wait()
-                    if ret != 0:
-                        raise Exception('Failed to install git/pip and dependencies with exit code: '+str(ret))
-                    else:
-                        process = subprocess.Popen(requirements_cmd, shell=True, env=plugin_env, cwd=work_dir)
-                        setPluginPID(pid, process.pid)
-                        ret = process.wait()
-                        if ret != 0:
-                            raise Exception('Failed to install dependencies with exit code: '+str(ret))
-                else:
+                raise Exception('Failed to install git/pip and dependencies with exit code: '+str(ret))
+            else:
+                ret = await run_process(pid, requirements_cmd, plugin_env, work_dir)
+                if ret != 0:
                     raise Exception('Failed to install dependencies with exit code: '+str(ret))
-            cmd_history.append(requirements_cmd)
         else:
-            logger.debug('skip command: %s', requirements_cmd)
+            raise Exception('Failed to install dependencies with exit code: '+str(ret))
+    addCmdCache(requirements_key, requirements_cmd, env_name)
+
+async def setup_plugin_env(pid, env_name, envs, requirements_cmd, requirements_key, work_dir, abort, plugin_env):
+    loop = asyncio.get_event_loop()
+    if CONDA_AVAILABLE:
+        # `conda info` is slow, only run it once
+        await loop.run_in_executor(None, getCondaInfo)
+    if envs is not None and len(envs)>0:
+        for env in envs:
+            env_key = getCmdKey(env_name, shlex.split(env))
+            if not isCmdCached(env_key):
+                await schedule_setup_job(env_key, env_name, lambda: run_env_command(pid, env_name, env, env_key, plugin_env, work_dir))
+            else:
+                logger.debug('skip command: %s', env)
+
+            if abort.is_set():
+                logger.info('plugin aborting...')
+                return False
+
+    if not opt.freeze and CONDA_AVAILABLE:
+        # cached unless the env has changed since it was last resolved
+        try:
+            conda_env = await loop.run_in_executor(None, getCondaEnv, env_name)
+        except Exception as e:
+            logger.warning('failed to activate conda env %s: %s', env_name or '(default)', str(e))
+            conda_env = None
+        if conda_env is None and env_name:
+            # the requirements and the plugin would end up in the engine env
+            logger.error('conda env %s can not be activated, the plugin is not started.', env_name)
+            if pid in plugins:
+                await emitToPeers('message_from_plugin_'+plugins[pid]['secret'], {'type': 'executeFailure', 'error': 'conda env {} can not be activated.'.format(env_name)}, plugins[pid]['client_sids'])
+            return False
+        addCondaEnvVars(env_name, plugin_env)
+        requirements_cmd = getPipCommand(env_name, requirements_cmd)
+
+    logger.info('Running requirements command: %s', requirements_cmd)
+    if requirements_cmd is not None and not isCmdCached(requirements_key):
+        await schedule_setup_job(requirements_key, env_name, lambda: run_requirements_command(pid, env_name, requirements_cmd, requirements_key, plugin_env, work_dir))
+    else:
+        logger.debug('skip command: %s', requirements_cmd)
+    return True
+
+def getPluginCommand(env_name, cmd):
+    """Run the python of a resolved conda env directly instead of activating the env in a shell"""
+    conda_env = conda_envs.get(env_name, None)
+    if opt.freeze or not CONDA_AVAILABLE or conda_env is None:
+        return cmd
+    parts = cmd.split(' ', 1)
+    if parts[0] in ['python', 'python2', 'python3']:
+        parts[0] = '"{}"'.format(conda_env['python'])
+    return ' '.join(parts)
+
+def getPipCommand(env_name, requirements_cmd):
+    """Run pip with the python of a resolved conda env, the `pip` found in PATH may belong to another env"""
+    conda_env = conda_envs.get(env_name, None)
+    if requirements_cmd is None or conda_env is None or not requirements_cmd.startswith('pip '):
+        return requirements_cmd
+    return '"{}" -m {}'.format(conda_env['python'], requirements_cmd)
+
+def addCondaEnvVars(env_name, plugin_env):
+    """Add the cached activation variables of a conda env to `plugin_env`"""
+    if not opt.freeze and CONDA_AVAILABLE and env_name in conda_envs:
+        plugin_env.update(conda_envs[env_name]['vars'])
+    return plugin_env
+
+def spawnPoolWorker(cmd, worker_env, env_name=''):
+    secret = str(uuid.uuid4())
+    worker_id = 'worker-' + str(uuid.uuid4())
+    worker = {'id': worker_id, 'secret': secret, 'cmd': cmd, 'env': env_name, 'abort': threading.Event(), 'output': OutputBuffer(opt.plugin_log_size), 'sid': None}
+    pool_workers[worker_id] = worker
+
+    @sio.on('from_plugin_'+secret, namespace=NAME_SPACE)
+    async def message_from_worker(sid, kwargs):
+        if kwargs['type'] == 'workerReady' and worker_id in pool_workers:
+            worker['sid'] = sid
+            worker_pools.setdefault(cmd, []).append(worker)
+            logger.debug('worker %s is ready.', worker_id)
+
+    async def run_worker():
+        plugin_env = worker_env.copy()
+        plugin_env['WORK_DIR'] = WORKSPACE_DIR
+        args = '{} "{}" --id="{}" --host={} --port={} --secret="{}" --namespace={} --pooled'.format(cmd, template_script, worker_id, opt.host, opt.port, secret, NAME_SPACE) + getIPCArgs()
+        try:
+            return await run_plugin_process(worker_id, args, WORKSPACE_DIR, worker['abort'], worker_id, plugin_env, worker['output'])
+        finally:
+            removePoolWorker(worker)
+    worker['task'] = asyncio.ensure_future(run_worker())
+    return worker
+
+def removePoolWorker(worker):
+    pool_workers.pop(worker['id'], None)
+    if worker in worker_pools.get(worker['cmd'], []):
+        worker_pools[worker['cmd']].remove(worker)
+
+def fillWorkerPool(cmd, worker_env, env_name=''):
+    """Start idle workers until the pool of `cmd` reaches the configured size"""
+    count = len([w for w in pool_workers.values() if w['cmd'] == cmd])
+    for i in range(opt.worker_pool_size - count):
+        spawnPoolWorker(cmd, worker_env, env_name)
+
+def stopPoolWorker(worker):
+    worker['abort'].set()
+    if 'process_id' in worker:
+        killProcess(worker['process_id'])
+    removePoolWorker(worker)
+    return worker['task']
+
+def discardPoolWorkers(env_name):
+    """Stop the idle workers of an env after a command changed it, they
+    would run plugins with the packages they loaded before"""
+    for worker in list(pool_workers.values()):
+        if worker['env'] == env_name:
+            logger.info('discarding worker %s, its env has changed.', worker['id'])
+            stopPoolWorker(worker)
+    if env_name == '' and fork_server is not None:
+        asyncio.ensure_future(restart_fork_server())
+
+async def claim_pool_worker(pid, cmd, work_dir):
+    """Hand an idle worker started with `cmd` over to the plugin `pid`"""
+    while len(worker_pools.get(cmd, [])) > 0:
+        worker = worker_pools[cmd].pop(0)
+        if worker['id'] not in pool_workers or pid not in plugins:
+            continue
+        del pool_workers[worker['id']]
+        plugin_info = plugins[pid]
+        # the plugin takes over the process, its output and its abort event
+        plugin_info['process_id'] = worker['process_id']
+        plugin_info['abort'] = worker['abort']
+        addPluginLog(plugin_info, worker['output'])
+        await emitToPeers('to_plugin_'+worker['secret'], {'type': 'claim', 'id': pid, 'secret': plugin_info['secret'], 'work_dir': os.path.abspath(work_dir)}, [worker['sid']])
+        logger.info('plugin %s claimed worker %s.', pid, worker['id'])
+        return worker
+    return None
+
+async def kill_pool_workers():
+    tasks = []
+    for worker in list(pool_workers.values()):
+        tasks.append(stopPoolWorker(worker))
+    if len(tasks) > 0:
+        await asyncio.wait(tasks, timeout=FORCE_QUIT_TIMEOUT)
+
+async def launch_plugin(pid, env_name, envs, requirements_cmd, requirements_key, cmd, secret, work_dir, abort, name, plugin_env, output):
+    if abort.is_set():
+        logger.info('plugin aborting...')
+        return False
+    try:
+        if not await setup_plugin_env(pid, env_name, envs, requirements_cmd, requirements_key, work_dir, abort, plugin_env):
+            return False
     except Exception as e:
         # await sio.emit('message_from_plugin_'+pid,  {"type": "executeFailure", "error": "failed to install requirements."})
         logger.error('failed to execute plugin: %s', str(e))
@@ -750,6 +1578,22 @@ def launch_plugin(pid, envs, requirements_cmd, args, work_dir, abort, name, plug
     if abort.is_set():
         logger.info('plugin aborting...')
         return False
+
+    cmd = getPluginCommand(env_name, cmd)
+    if fork_server is not None and cmd == fork_server['cmd'] and os.path.exists(fork_server['socket']):
+        try:
+            return await fork_plugin_process(pid, secret, work_dir, abort, output)
+        except Exception as e:
+            logger.error('failed to fork plugin %s, starting a new process instead: %s', pid, str(e))
+    elif opt.worker_pool_size > 0:
+        worker = await claim_pool_worker(pid, cmd, work_dir)
+        fillWorkerPool(cmd, plugin_env, env_name)
+        if worker is not None:
+            return await worker['task']
+    args = '{} "{}" --id="{}" --host={} --port={} --secret="{}" --namespace={}'.format(cmd, template_script, pid, opt.host, opt.port, secret, NAME_SPACE) + getIPCArgs()
+    return await run_plugin_process(pid, args, work_dir, abort, name, plugin_env, output)
+
+async def run_plugin_process(pid, args, work_dir, abort, name, plugin_env, output):
     # env = os.environ.copy()
     if type(args) is str:
         args = args.split()
@@ -758,7 +1602,6 @@ def launch_plugin(pid, envs, requirements_cmd, args, work_dir, abort, name, plug
     # Convert them all to strings
     args = [str(x) for x in args if str(x) != '']
     logger.info('%s task started.', name)
-    unrecognized_output = []
     # env['PYTHONPATH'] = os.pathsep.join(
     #     ['.', work_dir, env.get('PYTHONPATH', '')] + sys.path)
 
@@ -771,27 +1614,16 @@ def launch_plugin(pid, envs, requirements_cmd, args, work_dir, abort, name, plug
     if sys.platform != "win32":
         kwargs.update(preexec_fn=os.setsid)
 
-    process = subprocess.Popen(args, bufsize=1, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-              shell=True, env=plugin_env, cwd=work_dir, **kwargs)
+    process = await asyncio.create_subprocess_shell(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                                    env=plugin_env, cwd=work_dir, **kwargs)
     setPluginPID(pid, process.pid)
-    # Poll process for new output until finished
-    stdfn = sys.stdout.fileno()
-    while True:
-        out = process.stdout.read(1)
-        if out == '' and process.poll() != None:
-            break
-        os.write(stdfn, out)
-        sys.stdout.flush()
-        if abort.is_set():
-            break
-        time.sleep(0)
+    await forward_output(process.stdout, output, abort)
 
     try:
         logger.info('Plugin aborting...')
         killProcess(process.pid)
         logger.info('plugin process is killed.')
-        output = process.communicate()[0]
-        exitCode = process.returncode
+        exitCode = await process.wait()
     except Exception as e:
         exitCode = 100
     finally:
@@ -801,7 +1633,119 @@ def launch_plugin(pid, envs, requirements_cmd, args, work_dir, abort, name, plug
             logger.info('Error occured during terminating a process.\ncommand: %s\n exit code: %s\n', str(args), str(exitCode))
             return False
 
+async def forward_output(stream, output, abort):
+    # Forward the output until the process exits, each read returns
+    # everything that is available up to the chunk size
+    stdfn = sys.stdout.fileno()
+    while True:
+        out = await stream.read(OUTPUT_CHUNK_SIZE)
+        if not out:
+            break
+        os.write(stdfn, out)
+        output.write(out)
+        if abort.is_set():
+            break
+
+def requestFork(socket_path, request, fd):
+    """Send a request with the output file descriptor to the fork server, return the plugin pid"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendmsg([json.dumps(request).encode('utf-8')], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))])
+        response = b''
+        while not response.endswith(b'\n'):
+            data = sock.recv(1024)
+            if not data:
+                raise Exception('fork server closed the connection.')
+            response += data
+    return json.loads(response.decode('utf-8'))['pid']
+
+async def fork_plugin_process(pid, secret, work_dir, abort, output):
+    loop = asyncio.get_event_loop()
+    read_fd, write_fd = os.pipe()
+    try:
+        request = {'id': pid, 'secret': secret, 'work_dir': os.path.abspath(work_dir)}
+        process_id = await loop.run_in_executor(None, requestFork, fork_server['socket'], request, write_fd)
+    except Exception:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    setPluginPID(pid, process_id)
+    logger.info('%s forked from the fork server, pid: %s', pid, process_id)
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(read_fd, 'rb', 0))
+    try:
+        await forward_output(reader, output, abort)
+    finally:
+        transport.close()
+    # the plugin is not a child of the engine, its exit code is not available
+    killProcess(process_id)
+    return True
+
+def startForkServer(cmd, server_env):
+    global fork_server
+    socket_path = os.path.join(tempfile.mkdtemp(prefix='imjoy-'), 'forkserver.sock')
+    server = {'cmd': cmd, 'env': server_env, 'socket': socket_path, 'abort': threading.Event(), 'output': OutputBuffer(opt.plugin_log_size)}
+    fork_server = server
+
+    async def run_fork_server():
+        global fork_server
+        args = '{} "{}" --socket="{}" --host={} --port={} --namespace={}'.format(cmd, fork_server_script, socket_path, opt.host, opt.port, NAME_SPACE) + getIPCArgs()
+        process = await asyncio.create_subprocess_shell(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=server_env, cwd=WORKSPACE_DIR, preexec_fn=os.setsid)
+        server['process_id'] = process.pid
+        await forward_output(process.stdout, server['output'], server['abort'])
+        logger.info('fork server exited with code %s', await process.wait())
+        # a new server may have been started meanwhile
+        if fork_server is server:
+            fork_server = None
+    server['task'] = asyncio.ensure_future(run_fork_server())
+
+async def stop_fork_server():
+    if fork_server is not None and 'process_id' in fork_server:
+        task = fork_server['task']
+        fork_server['abort'].set()
+        killProcess(fork_server['process_id'])
+        # the forked plugins run in their own session and outlive the fork server,
+        # they are killed with the other plugins by their pid or exit when the
+        # engine closes their connection
+        await asyncio.wait([task], timeout=FORCE_QUIT_TIMEOUT)
+
+async def restart_fork_server():
+    """Start a new fork server after a command changed the default env, the
+    running one would fork plugins with the modules it loaded before"""
+    if fork_server is None:
+        return
+    old = fork_server
+    logger.info('restarting the fork server, the default env has changed.')
+    await stop_fork_server()
+    if fork_server is not None and fork_server is not old:
+        # restarted by another command meanwhile
+        return
+    startForkServer(old['cmd'], old['env'])
+
 async def on_startup(app):
+    global setup_semaphore, ipc_socket
+    # before the executors of the loop start their threads
+    tile_server.start()
+    setup_semaphore = asyncio.Semaphore(opt.max_setup_jobs)
+    if not opt.disable_ipc and sys.platform != "win32":
+        # only the current user can access the temporary directory
+        ipc_socket = os.path.join(tempfile.mkdtemp(prefix='imjoy-'), 'engine.sock')
+        await asyncio.start_unix_server(handle_ipc_connection, path=ipc_socket)
+    if not opt.freeze and CONDA_AVAILABLE:
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, getCondaEnv, '')
+        except Exception as e:
+            logger.warning('failed to activate the default conda env: %s', str(e))
+    default_cmd = getPluginCommand('', 'python')
+    default_env = addCondaEnvVars('', os.environ.copy())
+    if opt.fork_server:
+        if sys.platform.startswith('linux'):
+            startForkServer(default_cmd, default_env)
+        else:
+            print('WARNING: the fork server is only supported on Linux.')
+    if opt.worker_pool_size > 0 and not (opt.fork_server and sys.platform.startswith('linux')):
+        fillWorkerPool(default_cmd, default_env)
     try:
         import pkg_resources  # part of setuptools
         version = pkg_resources.require("imjoy")[0].version
@@ -850,7 +1794,16 @@ async def on_shutdown(app):
     t.daemon = True # stop if the program exits
     t.start()
 
+    logger.info('Messages routed: %s, saved %s deliveries (~%s bytes) compared to broadcasting.', routing_stats['messages'], routing_stats['deliveries_saved'], routing_stats['bytes_saved'])
     print('Shutting down the plugins...', flush=True)
+    await kill_pool_workers()
+    await stop_fork_server()
+    tile_server.shutdown()
+    if ipc_socket is not None:
+        shutil.rmtree(os.path.dirname(ipc_socket), ignore_errors=True)
+    if SHM_DIR is not None:
+        # remove arrays shared but never received
+        shutil.rmtree(SHM_DIR, ignore_errors=True)
     killAllPlugins()
     # stopped.set()
     logger.info('Plugin engine exited.')
@@ -1,6 +1,6 @@
 from pkg_resources import get_distribution
 from .exceptions import ConnectionError, TimeoutError, PacketError
-from .heartbeats import HeartbeatThread
+from .heartbeats import Heartbeat
 from .logs import LoggingMixin
 from .namespaces import (
     EngineIONamespace, SocketIONamespace, LoggingSocketIONamespace,
@@ -42,11 +42,10 @@ class EngineIO(LoggingMixin):
     def __init__(
             self, host, port=None, Namespace=EngineIONamespace,
             wait_for_connection=True, transports=TRANSPORTS,
-            resource='engine.io', hurry_interval_in_seconds=1, **kw):
+            resource='engine.io', **kw):
         self._is_secure, self._url = parse_host(host, port, resource)
         self._wait_for_connection = wait_for_connection
         self._client_transports = transports
-        self._hurry_interval_in_seconds = hurry_interval_in_seconds
         self._http_session = prepare_http_session(kw)
 
         self._log_name = self._url
@@ -109,24 +108,14 @@ class EngineIO(LoggingMixin):
 
     def _reset_heartbeat(self):
         try:
-            self._heartbeat_thread.halt()
-            hurried = self._heartbeat_thread.hurried
+            self._heartbeat.halt()
         except AttributeError:
-            hurried = False
-        ping_interval = self._engineIO_session.ping_interval
-        if self.transport_name.endswith('-polling'):
-            # Use ping/pong to unblock recv for polling transport
-            hurry_interval_in_seconds = self._hurry_interval_in_seconds
-        else:
-            # Use timeout to unblock recv for websocket transport
-            hurry_interval_in_seconds = ping_interval
-        self._heartbeat_thread = HeartbeatThread(
+            pass
+        self._heartbeat = Heartbeat(
             send_heartbeat=self._ping,
-            relax_interval_in_seconds=ping_interval,
-            hurry_interval_in_seconds=hurry_interval_in_seconds)
-        self._heartbeat_thread.start()
-        if hurried:
-            self._heartbeat_thread.hurry()
+            interval_in_seconds=self._engineIO_session.ping_interval)
+        # Use a timer until the wait loop takes over the heartbeat
+        self._heartbeat.schedule()
         self._debug('[heartbeat reset]')
 
     def _connect_namespaces(self):
@@ -181,8 +170,7 @@ class EngineIO(LoggingMixin):
     def _close(self):
         self._wants_to_close = True
         try:
-            self._heartbeat_thread.halt()
-            self._heartbeat_thread.join()
+            self._heartbeat.halt()
         except AttributeError:
             pass
         if not hasattr(self, '_opened') or not self._opened:
@@ -209,9 +197,7 @@ class EngineIO(LoggingMixin):
 
     @retry
     def _message(self, engineIO_packet_data, with_transport_instance=False):
-        engineIO_packet_type = '4'
-        if isinstance(engineIO_packet_data, bytearray):
-            engineIO_packet_type = 'b' + engineIO_packet_type
+        engineIO_packet_type = 4
         if with_transport_instance:
             transport = self._transport_instance
         else:
@@ -231,18 +217,14 @@ class EngineIO(LoggingMixin):
 
     def wait(self, seconds=None, **kw):
         'Wait in a loop and react to events as defined in the namespaces'
-        # Use ping/pong to unblock recv for polling transport
-        self._heartbeat_thread.hurry()
-        # Use timeout to unblock recv for websocket transport
-        self._transport.set_timeout(seconds=1)
-        # Listen
         warning_screen = self._yield_warning_screen(seconds)
         for elapsed_time in warning_screen:
             if self._should_stop_waiting(**kw):
                 break
             try:
                 try:
-                    self._process_packets()
+                    self._wait_for_packets(
+                        None if seconds is None else seconds - elapsed_time)
                 except TimeoutError:
                     pass
             except ConnectionError as e:
@@ -257,8 +239,26 @@ class EngineIO(LoggingMixin):
                     namespace.on_disconnect()
                 except PacketError:
                     pass
-        self._heartbeat_thread.relax()
-        self._transport.set_timeout()
+        try:
+            self._heartbeat.schedule()
+        except AttributeError:
+            pass
+
+    def _wait_for_packets(self, seconds=None):
+        transport = self._transport
+        heartbeat = self._heartbeat
+        if self.transport_name.endswith('-polling'):
+            # The long poll blocks until the server sends packets, the
+            # heartbeat stays on its timer and unblocks it
+            self._process_packets()
+            return
+        # Sleep until the socket is readable or the next heartbeat is due
+        heartbeat.cancel()
+        timeout = heartbeat.poll()
+        if seconds is not None:
+            timeout = max(0, min(timeout, seconds))
+        if transport.wait_readable(timeout):
+            self._process_packets()
 
     def _should_stop_waiting(self):
         return self._wants_to_close
@@ -335,14 +335,14 @@ class SocketIO(EngineIO):
     def __init__(
             self, host, port=None, Namespace=SocketIONamespace,
             wait_for_connection=True, transports=TRANSPORTS,
-            resource='socket.io', hurry_interval_in_seconds=1, **kw):
+            resource='socket.io', **kw):
         self._namespace_by_path = {}
         self._callback_by_ack_id = {}
         self._ack_id = 0
         self.placeholder = None
         super(SocketIO, self).__init__(
             host, port, Namespace, wait_for_connection, transports,
-            resource, hurry_interval_in_seconds, **kw)
+            resource, **kw)
 
     # Connect
 
@@ -0,0 +1,246 @@
+"""socket.io client running in an asyncio event loop (Python 3 only).
+
+It connects with the websocket transport directly and has the part of the
+SocketIO interface used by the plugin workers: on(), emit() and wait(), with
+wait() being a coroutine. The handlers are called in the event loop.
+
+emit() may be called from any thread, the packets are formatted by the
+caller and sent in order by one task of the event loop. drain() waits until
+the packets waiting to be sent are below HIGH_WATER_MARK.
+
+The connection is closed when the server does not answer a heartbeat within
+its ping timeout.
+"""
+import asyncio
+import threading
+
+import aiohttp
+
+from .exceptions import ConnectionError, PacketError
+from .logs import LoggingMixin
+from .namespaces import find_callback
+from .parsers import (
+    parse_host, parse_engineIO_session, parse_socketIO_packet,
+    format_socketIO_packet_data, format_packet_binary)
+from .symmetries import encode_string
+from .transports import ENGINEIO_PROTOCOL
+
+HIGH_WATER_MARK = 2 ** 24
+
+
+class AsyncSocketIO(LoggingMixin):
+
+    def __init__(self, host, port=None, loop=None, resource='socket.io'):
+        self._is_secure, self._url = parse_host(host, port, resource)
+        self._log_name = self._url
+        self.loop = loop or asyncio.get_event_loop()
+        self._thread_id = threading.get_ident()
+        self._handlers = {}
+        self._callback_by_ack_id = {}
+        self._ack_id = 0
+        self._ack_lock = threading.Lock()
+        self._placeholder = None
+        self._outgoing = asyncio.Queue()
+        self._pending_bytes = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._pong = asyncio.Event()
+        self._closed = False
+        self._tasks = []
+        self.loop.run_until_complete(self._connect())
+
+    # Connect
+
+    async def _connect(self):
+        self._session = aiohttp.ClientSession()
+        ws_url = '%s://%s/?EIO=%s&transport=websocket' % (
+            'wss' if self._is_secure else 'ws', self._url, ENGINEIO_PROTOCOL)
+        try:
+            self._ws = await self._session.ws_connect(ws_url, autoping=True)
+            packet = await self._ws.receive_str()
+            if not packet.startswith('0'):
+                raise PacketError('unexpected engine.io packet (%s)' % packet)
+            self._engineIO_session = parse_engineIO_session(
+                encode_string(packet[1:]))
+            # the server connects the default namespace by itself
+            packet = await self._ws.receive_str()
+            if not packet.startswith('40'):
+                raise PacketError('unexpected socket.io packet (%s)' % packet)
+        except (aiohttp.ClientError, asyncio.TimeoutError, TypeError,
+                PacketError) as e:
+            await self._session.close()
+            raise ConnectionError(e)
+        self._tasks = [
+            self.loop.create_task(self._send_packets()),
+            self.loop.create_task(self._send_heartbeats())]
+        self._debug('[transport selected] websocket (asyncio)')
+
+    @property
+    def connected(self):
+        return not self._closed
+
+    # Define
+
+    def on(self, event, callback):
+        self._handlers[event] = callback
+
+    # Act
+
+    def emit(self, event, *args, **kw):
+        callback, args = find_callback(args, kw)
+        ack_id = self._set_ack_callback(callback) if callback else None
+        self._send_socketIO_packet(2, ack_id, [event] + list(args))
+
+    def _ack(self, ack_id, *args):
+        self._send_socketIO_packet(3, ack_id, list(args))
+
+    def _send_socketIO_packet(self, socketIO_packet_type, ack_id, args):
+        socketIO_packet_data, binary_packets = format_socketIO_packet_data(
+            '', ack_id, args)
+        if binary_packets:
+            socketIO_packet_type += 3
+        packets = ['4' + str(socketIO_packet_type) + socketIO_packet_data]
+        packets.extend(format_packet_binary(4, b) for b in binary_packets)
+        if threading.get_ident() == self._thread_id:
+            self._queue_packets(packets)
+        else:
+            self.loop.call_soon_threadsafe(self._queue_packets, packets)
+
+    def _queue_packets(self, packets):
+        if self._closed:
+            self._warn('[packet dropped] the connection is closed')
+            return
+        for packet in packets:
+            self._pending_bytes += len(packet)
+            self._outgoing.put_nowait(packet)
+        if self._pending_bytes > HIGH_WATER_MARK:
+            self._drained.clear()
+
+    async def _send_packets(self):
+        while True:
+            packet = await self._outgoing.get()
+            try:
+                if isinstance(packet, str):
+                    await self._ws.send_str(packet)
+                else:
+                    await self._ws.send_bytes(packet)
+            except Exception as e:
+                self._warn('[send error] %s', e)
+            self._pending_bytes -= len(packet)
+            if self._pending_bytes <= HIGH_WATER_MARK:
+                self._drained.set()
+
+    async def _send_heartbeats(self):
+        while True:
+            await asyncio.sleep(self._engineIO_session.ping_interval)
+            self._pong.clear()
+            self._queue_packets(['2'])
+            try:
+                await asyncio.wait_for(
+                    self._pong.wait(), self._engineIO_session.ping_timeout)
+            except asyncio.TimeoutError:
+                self._warn('[heartbeat timeout] no pong within %s seconds',
+                           self._engineIO_session.ping_timeout)
+                await self._ws.close()
+                return
+
+    async def drain(self):
+        'Wait until the packets waiting to be sent are below the high water mark'
+        if not self._closed:
+            await self._drained.wait()
+
+    async def disconnect(self):
+        if not self._closed:
+            self._queue_packets(['41'])
+        await self._ws.close()
+
+    # React
+
+    async def wait(self):
+        'Dispatch the received events until the connection is closed'
+        try:
+            async for message in self._ws:
+                try:
+                    if message.type == aiohttp.WSMsgType.TEXT:
+                        self._process_packet(message.data)
+                    elif message.type == aiohttp.WSMsgType.BINARY:
+                        self._process_binary_packet(message.data)
+                    elif message.type == aiohttp.WSMsgType.ERROR:
+                        self._warn('[connection error] %s', message.data)
+                        break
+                except PacketError as e:
+                    self._warn('[packet error] %s', e)
+        finally:
+            self._closed = True
+            self._drained.set()
+            for task in self._tasks:
+                task.cancel()
+            await self._session.close()
+            self._debug('[disconnected]')
+            if 'disconnect' in self._handlers:
+                self._handlers['disconnect']()
+
+    def _process_packet(self, packet):
+        engineIO_packet_type = packet[:1]
+        if engineIO_packet_type == '4':
+            self._on_message(encode_string(packet[1:]))
+        elif engineIO_packet_type == '2':
+            self._queue_packets(['3' + packet[1:]])
+        elif engineIO_packet_type == '3':
+            self._pong.set()
+        elif engineIO_packet_type == '1':
+            self.loop.create_task(self._ws.close())
+        elif engineIO_packet_type != '6':
+            raise PacketError(
+                'unexpected engine.io packet type (%s)' % engineIO_packet_type)
+
+    def _process_binary_packet(self, packet):
+        if self._placeholder is None:
+            raise PacketError('unexpected binary packet')
+        # drop the engine.io packet type
+        self._placeholder.add(memoryview(packet)[1:])
+        if self._placeholder.finished:
+            packet, self._placeholder = self._placeholder, None
+            packet.type -= 3
+            self._dispatch(packet)
+
+    def _on_message(self, engineIO_packet_data):
+        self._debug('[socket.io packet received] %s', engineIO_packet_data)
+        packet = parse_socketIO_packet(engineIO_packet_data)
+        if packet.type in (5, 6) and packet.attachments:
+            self._placeholder = packet
+        else:
+            if packet.type in (5, 6):
+                packet.type -= 3
+            self._dispatch(packet)
+
+    def _dispatch(self, packet):
+        if packet.type == 2:
+            args = packet.args
+            try:
+                event = args.pop(0)
+            except IndexError:
+                raise PacketError('missing event name')
+            if packet.ack_id is not None:
+                ack_id = packet.ack_id
+                args.append(lambda *a: self._ack(ack_id, *a))
+            handler = self._handlers.get(event)
+            if handler is None:
+                self._debug('[event ignored] %s', event)
+                return
+            handler(*args)
+        elif packet.type == 3:
+            with self._ack_lock:
+                callback = self._callback_by_ack_id.pop(packet.ack_id, None)
+            if callback is not None:
+                callback(*packet.args)
+        elif packet.type == 1:
+            self.loop.create_task(self._ws.close())
+        elif packet.type == 4:
+            self._warn('[socket.io error] %s', packet.args)
+
+    def _set_ack_callback(self, callback):
+        with self._ack_lock:
+            self._ack_id += 1
+            self._callback_by_ack_id[self._ack_id] = callback
+            return self._ack_id
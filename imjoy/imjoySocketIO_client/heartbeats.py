@@ -1,52 +1,67 @@
 import logging
-from threading import Thread, Event
+import time
+from threading import Timer, Lock
 
 from .exceptions import ConnectionError, TimeoutError
 
 
-class HeartbeatThread(Thread):
+class Heartbeat(object):
+    """Send a heartbeat every interval.
 
-    daemon = True
+    The heartbeat is a timer of the wait loop, which calls `poll` between
+    the packets. When nobody is waiting, or when the transport blocks while
+    receiving, `schedule` arms a one-shot timer for the next heartbeat.
+    """
 
-    def __init__(
-            self, send_heartbeat,
-            relax_interval_in_seconds,
-            hurry_interval_in_seconds):
-        super(HeartbeatThread, self).__init__()
+    def __init__(self, send_heartbeat, interval_in_seconds):
         self._send_heartbeat = send_heartbeat
-        self._relax_interval_in_seconds = relax_interval_in_seconds
-        self._hurry_interval_in_seconds = hurry_interval_in_seconds
-        self._adrenaline = Event()
-        self._rest = Event()
-        self._halt = Event()
-
-    def run(self):
-        try:
-            while not self._halt.is_set():
-                try:
-                    self._send_heartbeat()
-                except TimeoutError:
-                    pass
-                if self._adrenaline.is_set():
-                    interval_in_seconds = self._hurry_interval_in_seconds
-                else:
-                    interval_in_seconds = self._relax_interval_in_seconds
-                self._rest.wait(interval_in_seconds)
-        except ConnectionError:
-            logging.debug('[heartbeat connection error]')
-
-    def relax(self):
-        self._adrenaline.clear()
-
-    def hurry(self):
-        self._adrenaline.set()
-        self._rest.set()
-        self._rest.clear()
-
-    @property
-    def hurried(self):
-        return self._adrenaline.is_set()
+        self._interval_in_seconds = interval_in_seconds
+        self._deadline = time.time() + interval_in_seconds
+        self._lock = Lock()
+        self._timer = None
+        self._halted = False
+
+    def poll(self):
+        'Send the heartbeat if it is due, return the seconds to the next one'
+        with self._lock:
+            now = time.time()
+            if now >= self._deadline:
+                self._deadline = now + self._interval_in_seconds
+                send = not self._halted
+            else:
+                send = False
+            seconds = self._deadline - now
+        if send:
+            try:
+                self._send_heartbeat()
+            except TimeoutError:
+                pass
+            except ConnectionError:
+                logging.debug('[heartbeat connection error]')
+        return seconds
+
+    def schedule(self):
+        with self._lock:
+            if self._halted or self._timer is not None:
+                return
+            seconds = max(0, self._deadline - time.time())
+            self._timer = timer = Timer(seconds, self._on_timer)
+            timer.daemon = True
+            timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+        self.poll()
+        self.schedule()
+
+    def cancel(self):
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
 
     def halt(self):
-        self._rest.set()
-        self._halt.set()
+        with self._lock:
+            self._halted = True
+        self.cancel()
@@ -2,12 +2,16 @@ import six
 import json
 from collections import namedtuple
 from base64 import b64encode
-from copy import deepcopy
 
 from .symmetries import (
-    decode_string, encode_string, get_byte, get_character, get_int, parse_url)
+    decode_string, encode_string, get_byte, get_int, parse_url,
+    get_buffer, memoryview)
 
 
+# Payload lengths are written with one byte per decimal digit, other bytes
+# become a character int() rejects
+_LENGTH_DIGIT_TABLE = bytes(bytearray(range(48, 58)) + bytearray(b'x' * 246))
+
 EngineIOSession = namedtuple('EngineIOSession', [
     'id', 'ping_interval', 'ping_timeout', 'transport_upgrades'])
 
@@ -42,25 +46,40 @@ class SocketIOPacket():
                 return False
 
         def fn(obj):
-            return bytearray(self.binary_packets[obj['num']])
+            num = obj['num']
+            data = self.binary_packets[num]
+            if not isinstance(data, bytearray):
+                # drop the received packet as soon as it is converted
+                data = self.binary_packets[num] = bytearray(data)
+            return data
+
+        # args were parsed from this packet alone, update them in place
+        self.args = traverse(self.args, predicate, fn, in_place=True)
 
-        self.args = traverse(deepcopy(self.args), predicate, fn)
 
+def traverse(obj, predicate, fn, in_place=False):
+    """Return obj with every item matching predicate replaced by fn(item).
 
-def traverse(obj, predicate, fn):
+    obj is left untouched unless in_place is set: containers are copied
+    only along the paths leading to replaced items, everything else is
+    shared with obj."""
     if predicate(obj):
         return fn(obj)
     elif isinstance(obj, dict):
-        for key, value in six.iteritems(obj):
-            obj[key] = traverse(value, predicate, fn)
-        return obj
+        items = six.iteritems(obj)
     elif isinstance(obj, (tuple, list)):
-        obj = list(obj)
-        for i, value in enumerate(obj):
-            obj[i] = traverse(value, predicate, fn)
-        return obj
+        items = enumerate(obj)
     else:
         return obj
+    # replacing existing keys does not disturb the iteration
+    copied = obj if in_place and not isinstance(obj, tuple) else None
+    for key, value in items:
+        new_value = traverse(value, predicate, fn, in_place)
+        if new_value is not value:
+            if copied is None:
+                copied = dict(obj) if isinstance(obj, dict) else list(obj)
+            copied[key] = new_value
+    return obj if copied is None else copied
 
 
 def parse_host(host, port, resource):
@@ -94,30 +113,40 @@ def decode_engineIO_content(content):
     content_index = 0
     content_length = len(content)
     while content_index < content_length:
-        content_index, packet_length = _read_packet_length(
-            content, content_index)
-        content_index, packet_text = _read_packet_text(
-            content, content_index, packet_length)
-        engineIO_packet_type, engineIO_packet_data = parse_packet_text(
-            packet_text)
-        yield engineIO_packet_type, engineIO_packet_data
+        # Look for the separators with find and slice the packets, bytes
+        # are only read one by one in malformed payloads
+        while get_byte(content, content_index) not in (0, 1):
+            content_index += 1
+        length_end = content.find(b'\xff', content_index + 1)
+        if length_end == -1:
+            raise IndexError('unterminated packet length')
+        digits = content[content_index + 1:length_end]
+        try:
+            packet_length = int(digits.translate(_LENGTH_DIGIT_TABLE))
+        except ValueError:
+            # Other bytes count with all their decimal digits
+            packet_length = int(''.join(str(b) for b in bytearray(digits)))
+        content_index = length_end + 1
+        while get_byte(content, content_index) == 255:
+            content_index += 1
+        packet_text = content[content_index:content_index + packet_length]
+        content_index += packet_length
+        yield parse_packet_text(packet_text)
 
 
 def format_socketIO_packet_data(path=None, ack_id=None, args=None):
     binary_packets = []
 
     def predicate(obj):
-        return isinstance(obj, bytearray)
+        return is_binary_packet_data(obj)
 
     def fn(data):
-        binary_packets.append(bytearray(b64encode(six.binary_type(data))))
+        # the transport decides how to frame it (binary or base64)
+        binary_packets.append(data)
         return {'_placeholder': True, 'num': len(binary_packets) - 1}
 
-    args = traverse(
-        deepcopy(args),
-        predicate,
-        fn
-    )
+    # copy-on-write: the caller's args are never modified
+    args = traverse(args, predicate, fn)
     socketIO_packet_data = json.dumps(args, ensure_ascii=False) if args else ''
     if ack_id is not None:
         socketIO_packet_data = str(ack_id) + socketIO_packet_data
@@ -168,13 +197,32 @@ def parse_socketIO_packet(socketIO_packet):
 
 
 def format_packet_text(packet_type, packet_data):
-    if isinstance(packet_data, bytearray):
-        packet_data = packet_data.decode('utf-8')
+    if is_binary_packet_data(packet_data):
+        # Engine.IO text framing for binary data is base64 with a 'b' prefix
+        return encode_string('b' + str(packet_type)) + b64encode(
+            get_buffer(packet_data))
     return encode_string(str(packet_type) + packet_data)
 
 
+def format_packet_binary(packet_type, packet_data):
+    'Frame binary data as the packet type byte followed by the raw data'
+    packet = bytearray([int(packet_type)])
+    packet.extend(get_buffer(packet_data))
+    return packet
+
+
+def is_binary_packet_data(packet_data):
+    if six.PY3 and isinstance(packet_data, bytes):
+        # bytes are text in python 2
+        return True
+    return isinstance(packet_data, (bytearray, memoryview))
+
+
 def parse_packet_text(packet_text):
-    packet_type = get_int(packet_text, 0)
+    packet_type = get_byte(packet_text, 0)
+    if 48 <= packet_type <= 57:
+        # The type is a digit in text packets, a raw byte in binary ones
+        packet_type -= 48
     packet_data = packet_text[1:]
     return packet_type, packet_data
 
@@ -182,14 +230,12 @@ def parse_packet_text(packet_text):
 def get_namespace_path(socketIO_packet_data):
     if not socketIO_packet_data.startswith(b'/'):
         return ''
-    # Loop incrementally in case there is binary data
-    parts = []
-    for i in range(len(socketIO_packet_data)):
-        character = get_character(socketIO_packet_data, i)
-        if ',' == character:
-            break
-        parts.append(character)
-    return ''.join(parts)
+    # Stop at the first comma, the rest may be binary data
+    path_end = socketIO_packet_data.find(b',')
+    if path_end == -1:
+        path_end = len(socketIO_packet_data)
+    path = socketIO_packet_data[:path_end]
+    return path.decode('latin-1') if six.PY3 else bytes(path)
 
 
 def _make_packet_prefix(packet):
@@ -199,23 +245,3 @@ def _make_packet_prefix(packet):
         header_digits.append(ord(length_string[i]) - 48)
     header_digits.append(255)
     return header_digits
-
-
-def _read_packet_length(content, content_index):
-    while get_byte(content, content_index) not in [0, 1]:
-        content_index += 1
-    content_index += 1
-    packet_length_string = ''
-    byte = get_byte(content, content_index)
-    while byte != 255:
-        packet_length_string += str(byte)
-        content_index += 1
-        byte = get_byte(content, content_index)
-    return content_index, int(packet_length_string)
-
-
-def _read_packet_text(content, content_index, packet_length):
-    while get_byte(content, content_index) == 255:
-        content_index += 1
-    packet_text = content[content_index:content_index + packet_length]
-    return content_index + packet_length, packet_text
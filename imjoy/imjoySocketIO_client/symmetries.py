@@ -36,6 +36,15 @@ def get_byte(x, index):
     return six.indexbytes(x, index)
 
 
+def get_buffer(x):
+    'Return an object exposing the bytes of x without copying if possible'
+    if six.PY3:
+        return x
+    if isinstance(x, memoryview):
+        return x.tobytes()
+    return six.binary_type(x)
+
+
 def encode_string(x):
     return x.encode('utf-8')
 
@@ -0,0 +1,168 @@
+"""Benchmark socket.io packet formatting and parsing.
+
+Measures the time spent on the emit side (format_socketIO_packet_data and
+framing every packet for the selected transport) and on the receive side
+(parse_socketIO_packet and placeholder replacement) for payloads shaped like
+plugin calls: a tree of small RPC dicts plus an array split into chunks.
+
+With --payloads, compares the decoding of xhr-polling payloads (many small
+RPC packets, base64 or binary attachments) with the byte by byte parser.
+
+    python -m imjoy.imjoySocketIO_client.tests.benchmark_parsers
+    python -m imjoy.imjoySocketIO_client.tests.benchmark_parsers \\
+        --max-size 100MB --transport xhr-polling
+    python -m imjoy.imjoySocketIO_client.tests.benchmark_parsers --payloads \\
+        --payload-size 100MB
+"""
+import argparse
+import json
+import timeit
+
+from ..parsers import (
+    decode_engineIO_content, encode_engineIO_content, get_namespace_path,
+    format_packet_binary, format_packet_text, format_socketIO_packet_data,
+    is_binary_packet_data, parse_packet_text, parse_socketIO_packet)
+from . import reference_parsers
+
+CHUNK_SIZE = 1000000
+UNITS = {'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for unit, factor in UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+
+def format_size(size):
+    for unit in ('GB', 'MB', 'KB'):
+        if size >= UNITS[unit]:
+            return '%g%s' % (size / float(UNITS[unit]), unit)
+    return '%dB' % size
+
+
+def make_args(size, num_items):
+    data = bytearray(size)
+    view = memoryview(data)
+    chunks = [view[i:i + CHUNK_SIZE] for i in range(0, size, CHUNK_SIZE)]
+    items = [{'__jailed_type__': 'argument', '__value__': i}
+             for i in range(num_items)]
+    return ['from_plugin_benchmark', {
+        'type': 'method', 'name': 'run', 'pid': None,
+        'args': {'args': [items, {
+            '__jailed_type__': 'ndarray', '__value__': chunks,
+            '__shape__': [size], '__dtype__': 'uint8'}]},
+        'promise': {'args': [
+            {'__jailed_type__': 'callback', '__value__': 'f', 'num': 'a'},
+            {'__jailed_type__': 'callback', '__value__': 'f', 'num': 'b'}],
+            'callbackId': 1}}]
+
+
+def emit(args, transport):
+    packet_data, binary_packets = format_socketIO_packet_data('', None, args)
+    packets = [format_packet_text(5, packet_data)]
+    for packet in binary_packets:
+        if transport == 'websocket' and is_binary_packet_data(packet):
+            packets.append(format_packet_binary(4, packet))
+        else:
+            packets.append(format_packet_text(4, packet))
+    return packets
+
+
+def receive(packets):
+    _, packet_data = parse_packet_text(packets[0])
+    packet = parse_socketIO_packet(packet_data)
+    for binary_packet in packets[1:]:
+        _, data = parse_packet_text(binary_packet)
+        packet.add(data)
+    return packet
+
+
+def measure(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def make_payloads(num_items, size):
+    'Return xhr-polling payloads shaped like batched plugin messages'
+    rpc = [(4, '2' + json.dumps(['from_plugin_benchmark', {
+        'type': 'method', 'name': 'run',
+        'args': {'args': [{'__jailed_type__': 'argument', '__value__': i}]},
+        'promise': {'callbackId': i}}])) for i in range(num_items)]
+    chunks = [bytearray(CHUNK_SIZE) for i in range(size // CHUNK_SIZE)]
+    binary = bytearray(encode_engineIO_content(rpc[:1]))
+    for chunk in chunks:
+        # binary packets of a payload are framed by 1 instead of 0
+        binary.append(1)
+        binary.extend(int(x) for x in str(len(chunk) + 1))
+        binary.append(255)
+        binary.append(4)
+        binary.extend(chunk)
+    return [
+        ('rpc x%d' % num_items, bytes(encode_engineIO_content(rpc))),
+        ('rpc + base64 %s' % format_size(size),
+         bytes(encode_engineIO_content(rpc + [(4, c) for c in chunks]))),
+        ('rpc + binary %s' % format_size(size), bytes(binary)),
+    ]
+
+
+def benchmark_payloads(num_items, size):
+    print('%24s %14s %14s %8s' % ('payload', 'reference (ms)', 'decode (ms)',
+                                  'speedup'))
+    for name, content in make_payloads(num_items, size):
+        reference_time = measure(
+            lambda: list(reference_parsers.decode_engineIO_content(content)),
+            5)
+        decode_time = measure(
+            lambda: list(decode_engineIO_content(content)), 5)
+        print('%24s %14.3f %14.3f %8.1f' % (
+            name, reference_time * 1000, decode_time * 1000,
+            reference_time / decode_time))
+    # the namespace is looked for in binary data without comma
+    data = b'/chat' + bytes(bytearray(size))
+    reference_time = measure(
+        lambda: reference_parsers.get_namespace_path(data), 1)
+    path_time = measure(lambda: get_namespace_path(data), 5)
+    print('%24s %14.3f %14.3f %8.1f' % (
+        'namespace %s' % format_size(size), reference_time * 1000,
+        path_time * 1000, reference_time / path_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--min-size', default='1KB')
+    parser.add_argument('--max-size', default='1GB')
+    parser.add_argument('--num-items', type=int, default=1000,
+                        help='small RPC dicts in each payload')
+    parser.add_argument('--transport', default='websocket',
+                        choices=['websocket', 'xhr-polling'])
+    parser.add_argument('--payloads', action='store_true',
+                        help='benchmark the decoding of polling payloads')
+    parser.add_argument('--payload-size', default='10MB',
+                        help='size of the attachments in the payloads')
+    opt = parser.parse_args()
+    if opt.payloads:
+        benchmark_payloads(opt.num_items, parse_size(opt.payload_size))
+        return
+
+    print('%10s %12s %12s %12s' % ('size', 'emit (ms)', 'receive (ms)',
+                                   'MB/s'))
+    size = parse_size(opt.min_size)
+    max_size = parse_size(opt.max_size)
+    while size <= max_size:
+        args = make_args(size, opt.num_items)
+        repeat = 5 if size < 100 * UNITS['MB'] else 1
+        packets = emit(args, opt.transport)
+        emit_time = measure(lambda: emit(args, opt.transport), repeat)
+        receive_time = measure(lambda: receive(packets), repeat)
+        del packets
+        throughput = size / UNITS['MB'] / (emit_time + receive_time)
+        print('%10s %12.3f %12.3f %12.1f' % (
+            format_size(size), emit_time * 1000, receive_time * 1000,
+            throughput))
+        size *= 10
+
+
+if __name__ == '__main__':
+    main()
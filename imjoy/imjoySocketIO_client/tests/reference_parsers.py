@@ -0,0 +1,56 @@
+"""The byte by byte payload parser, kept as the reference of the tests and
+the benchmark of parsers.decode_engineIO_content, parse_packet_text and
+get_namespace_path."""
+from ..symmetries import get_byte, get_character, get_int
+
+
+def decode_engineIO_content(content):
+    content_index = 0
+    content_length = len(content)
+    while content_index < content_length:
+        content_index, packet_length = _read_packet_length(
+            content, content_index)
+        content_index, packet_text = _read_packet_text(
+            content, content_index, packet_length)
+        engineIO_packet_type, engineIO_packet_data = parse_packet_text(
+            packet_text)
+        yield engineIO_packet_type, engineIO_packet_data
+
+
+def parse_packet_text(packet_text):
+    packet_type = get_int(packet_text, 0)
+    packet_data = packet_text[1:]
+    return packet_type, packet_data
+
+
+def get_namespace_path(socketIO_packet_data):
+    if not socketIO_packet_data.startswith(b'/'):
+        return ''
+    # Loop incrementally in case there is binary data
+    parts = []
+    for i in range(len(socketIO_packet_data)):
+        character = get_character(socketIO_packet_data, i)
+        if ',' == character:
+            break
+        parts.append(character)
+    return ''.join(parts)
+
+
+def _read_packet_length(content, content_index):
+    while get_byte(content, content_index) not in [0, 1]:
+        content_index += 1
+    content_index += 1
+    packet_length_string = ''
+    byte = get_byte(content, content_index)
+    while byte != 255:
+        packet_length_string += str(byte)
+        content_index += 1
+        byte = get_byte(content, content_index)
+    return content_index, int(packet_length_string)
+
+
+def _read_packet_text(content, content_index, packet_length):
+    while get_byte(content, content_index) == 255:
+        content_index += 1
+    packet_text = content[content_index:content_index + packet_length]
+    return content_index + packet_length, packet_text
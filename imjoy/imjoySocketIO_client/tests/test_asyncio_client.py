@@ -0,0 +1,142 @@
+import asyncio
+import json
+import re
+import threading
+import time
+from unittest import TestCase
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from ..asyncio_client import AsyncSocketIO
+
+
+class ServerTestCase(TestCase):
+    'Connect a client to a socket.io server with the websocket transport'
+    # in milliseconds, like the engine.io handshake
+    ping_interval = 25000
+    ping_timeout = 60000
+    pong = True
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.received = asyncio.Queue()
+        app = web.Application()
+        app.router.add_get('/socket.io/', self.handler)
+        self.server = TestServer(app, host='127.0.0.1')
+        self.loop.run_until_complete(self.server.start_server())
+        self.client = AsyncSocketIO('127.0.0.1', self.server.port, self.loop)
+        self.disconnected = False
+        self.client.on('disconnect', self.on_disconnect)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.client.disconnect())
+        self.loop.run_until_complete(self.server.close())
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def on_disconnect(self):
+        self.disconnected = True
+
+    async def handler(self, request):
+        self.ws = web.WebSocketResponse()
+        await self.ws.prepare(request)
+        await self.ws.send_str('0' + json.dumps({
+            'sid': 'sid', 'upgrades': [], 'pingInterval': self.ping_interval,
+            'pingTimeout': self.ping_timeout}))
+        await self.ws.send_str('40')
+        async for message in self.ws:
+            if message.data == '2':
+                if self.pong:
+                    await self.ws.send_str('3')
+            else:
+                await self.received.put(message.data)
+        return self.ws
+
+    def dispatch(self, coroutine, timeout=5):
+        'Run coroutine while the client dispatches the received packets'
+        async def main():
+            waiting = self.loop.create_task(self.client.wait())
+            try:
+                return await coroutine
+            finally:
+                waiting.cancel()
+        return self.loop.run_until_complete(asyncio.wait_for(main(), timeout))
+
+
+class Test_AsyncSocketIO(ServerTestCase):
+
+    def test_binary_attachments(self):
+        'Replace the placeholders with the binary packets which follow'
+        events = asyncio.Queue()
+        self.client.on('event', lambda *args: events.put_nowait(args))
+        async def main():
+            await self.ws.send_str(
+                '452-["event",{"a":{"_placeholder":true,"num":0}},'
+                '[{"_placeholder":true,"num":1}]]')
+            await self.ws.send_bytes(b'\x04\x00\x01')
+            await self.ws.send_bytes(b'\x04' + b'\xff' * 100000)
+            first = await events.get()
+            await self.ws.send_str('42["event","text"]')
+            second = await events.get()
+            # an empty attachment, with an acknowledgement
+            await self.ws.send_str('451-2["event",{"_placeholder":true,"num":0}]')
+            await self.ws.send_bytes(b'\x04')
+            third = await events.get()
+            third[1]('ok')
+            return first, second, third, await self.received.get()
+        first, second, third, ack = self.dispatch(main())
+        self.assertEqual(first, ({'a': bytearray(b'\x00\x01')}, [bytearray(b'\xff' * 100000)]))
+        self.assertEqual(second, ('text',))
+        self.assertEqual(third[0], bytearray())
+        self.assertEqual(ack, '432["ok"]')
+
+    def test_emit_from_threads(self):
+        'Send the events emitted by other threads and call their callbacks'
+        replies = []
+        def emit(thread):
+            for i in range(50):
+                self.client.emit('event', thread, i, bytearray([i]), lambda *args: replies.append(args))
+        async def main():
+            threads = [threading.Thread(target=emit, args=(t,)) for t in range(4)]
+            for thread in threads:
+                thread.start()
+            sent = []
+            while len(sent) < 200:
+                packet = await self.received.get()
+                ack_id, thread, i = [int(x) for x in re.match(r'451-(\d+)\["event", (\d+), (\d+),', packet).groups()]
+                # the binary attachment follows its event
+                self.assertEqual(await self.received.get(), bytes([4, i]))
+                sent.append((ack_id, thread, i))
+                await self.ws.send_str('43{}[{},{}]'.format(ack_id, thread, i))
+            while len(replies) < 200:
+                await asyncio.sleep(0.01)
+            return sent
+        sent = self.dispatch(main())
+        self.assertEqual(len(set(ack_id for ack_id, _, _ in sent)), 200)
+        for t in range(4):
+            # the events of each thread are sent in order
+            self.assertEqual([i for _, thread, i in sent if thread == t], list(range(50)))
+        self.assertEqual(sorted(replies), sorted((t, i) for t in range(4) for i in range(50)))
+
+
+class Test_Heartbeat(ServerTestCase):
+    ping_interval = 100
+    ping_timeout = 200
+
+    def test_pong(self):
+        'Stay connected while the server answers the heartbeats'
+        async def main():
+            await asyncio.sleep(1)
+            return self.client.connected
+        self.assertTrue(self.dispatch(main()))
+
+    def test_pong_timeout(self):
+        'Close the connection when the server does not answer a heartbeat'
+        self.pong = False
+        start = time.time()
+        self.loop.run_until_complete(asyncio.wait_for(self.client.wait(), 5))
+        self.assertTrue(self.disconnected)
+        self.assertFalse(self.client.connected)
+        self.assertLess(time.time() - start, 2)
@@ -0,0 +1,81 @@
+import threading
+import time
+from unittest import TestCase
+
+from ..exceptions import ConnectionError
+from ..heartbeats import Heartbeat
+
+
+class Test_Heartbeat(TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.heartbeat = Heartbeat(lambda: self.sent.append(time.time()), 0.1)
+
+    def tearDown(self):
+        self.heartbeat.halt()
+
+    def timers(self, armed=True):
+        'Return the timers of the heartbeat which are armed, or still running'
+        return [t for t in threading.enumerate()
+                if isinstance(t, threading.Timer) and t.function == self.heartbeat._on_timer
+                and not (armed and t.finished.is_set())]
+
+    def test_poll(self):
+        'Send the heartbeat when it is due'
+        self.assertAlmostEqual(self.heartbeat.poll(), 0.1, delta=0.05)
+        self.assertEqual(self.sent, [])
+        time.sleep(0.1)
+        self.assertAlmostEqual(self.heartbeat.poll(), 0.1, delta=0.05)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_schedule(self):
+        'Send a heartbeat every interval'
+        start = time.time()
+        self.heartbeat.schedule()
+        time.sleep(0.45)
+        self.assertIn(len(self.sent), (3, 4))
+        intervals = [b - a for a, b in zip([start] + self.sent, self.sent)]
+        for interval in intervals:
+            self.assertGreaterEqual(interval, 0.09)
+        self.assertEqual(len(self.timers()), 1)
+
+    def test_halt(self):
+        'Stop sending after the disconnection'
+        self.heartbeat.schedule()
+        time.sleep(0.15)
+        self.heartbeat.halt()
+        count = len(self.sent)
+        self.heartbeat.schedule()
+        time.sleep(0.25)
+        self.heartbeat.poll()
+        self.assertEqual(len(self.sent), count)
+        self.assertEqual(self.timers(armed=False), [])
+
+    def test_cancel(self):
+        'Leave no timers behind when the wait loop takes the heartbeat over'
+        for i in range(20):
+            self.heartbeat.schedule()
+            self.heartbeat.schedule()
+            self.assertEqual(len(self.timers()), 1)
+            self.heartbeat.cancel()
+            self.heartbeat.poll()
+        time.sleep(0.05)
+        self.assertEqual(self.timers(armed=False), [])
+        self.assertIsNone(self.heartbeat._timer)
+        # the heartbeat which fell due meanwhile is sent right away
+        time.sleep(0.1)
+        self.heartbeat.schedule()
+        time.sleep(0.05)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_connection_error(self):
+        'Keep sending after a failed heartbeat'
+        def send():
+            self.sent.append(time.time())
+            raise ConnectionError('closed')
+        self.heartbeat = Heartbeat(send, 0.1)
+        self.heartbeat.schedule()
+        time.sleep(0.25)
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(len(self.timers()), 1)
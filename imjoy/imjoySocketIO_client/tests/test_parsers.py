@@ -0,0 +1,141 @@
+import random
+from base64 import b64decode
+from unittest import TestCase
+
+from ..parsers import (
+    encode_engineIO_content, decode_engineIO_content,
+    format_packet_binary, format_packet_text, format_socketIO_packet_data,
+    get_namespace_path, parse_packet_text, parse_socketIO_packet)
+from . import reference_parsers
+
+
+def random_bytes(rng, size):
+    return bytes(bytearray(rng.randint(0, 255) for i in range(size)))
+
+
+def random_payload(rng):
+    'Return a payload mixing text, base64 and binary packets'
+    content = bytearray()
+    for i in range(rng.randint(1, 20)):
+        kind = rng.choice(['text', 'base64', 'binary'])
+        if kind == 'binary':
+            packet = bytearray([1])
+            packet_text = random_bytes(rng, rng.randint(1, 300))
+            packet.extend(int(x) for x in str(len(packet_text)))
+            packet.append(255)
+            content.extend(packet + packet_text)
+        else:
+            if kind == 'text':
+                data = u'2["event",{"x":"%s\u00e9"}]' % (
+                    'a' * rng.randint(0, 300))
+            else:
+                data = bytearray(random_bytes(rng, rng.randint(0, 300)))
+            content.extend(encode_engineIO_content([
+                (rng.choice([2, 3, 4, 6]), data)]))
+    return content
+
+
+def decode_outcome(decode, content):
+    try:
+        return list(decode(content))
+    except Exception as e:
+        return type(e)
+
+
+class Test_Parsers(TestCase):
+
+    def test_format_binary_attachments(self):
+        'Keep binary attachments raw until the transport frames them'
+        data = bytearray(b'\x00\x01\x02')
+        view = memoryview(bytearray(b'\xff' * 8))[2:5]
+        packet_data, binary_packets = format_socketIO_packet_data(
+            '', None, ['event', {'data': data, 'array': [view]}])
+        self.assertEqual(binary_packets, [data, view])
+        self.assertIs(binary_packets[1], view)
+        self.assertTrue(packet_data.startswith('2-'))
+
+    def test_format_does_not_modify_args(self):
+        'Copy only the containers leading to binary attachments'
+        data = bytearray(b'\x00')
+        meta = {'shape': [1], 'dtype': 'uint8'}
+        args = ['event', {'value': data, 'meta': meta}]
+        packet_data, binary_packets = format_socketIO_packet_data(
+            '', None, args)
+        self.assertIs(args[1]['value'], data)
+        self.assertEqual(binary_packets, [data])
+        self.assertIn('"_placeholder": true', packet_data)
+
+    def test_parse_binary_packet(self):
+        'Replace placeholders with the received attachments'
+        packet = parse_socketIO_packet(
+            b'52-["event",{"a":{"_placeholder":true,"num":0},'
+            b'"b":[{"_placeholder":true,"num":1}],"c":"text"}]')
+        self.assertFalse(packet.finished)
+        packet.add(b'\x01\x02')
+        packet.add(b'\x03')
+        self.assertTrue(packet.finished)
+        self.assertEqual(packet.args, ['event', {
+            'a': bytearray(b'\x01\x02'), 'b': [bytearray(b'\x03')],
+            'c': 'text'}])
+        self.assertIsInstance(packet.args[1]['a'], bytearray)
+
+    def test_format_packet_binary(self):
+        'Frame binary data as a type byte followed by the raw bytes'
+        view = memoryview(bytearray(b'\x00\x01\xff'))
+        packet = format_packet_binary(4, view)
+        self.assertEqual(packet, bytearray(b'\x04\x00\x01\xff'))
+        self.assertEqual(parse_packet_text(bytes(packet)), (4, b'\x00\x01\xff'))
+
+    def test_format_packet_text_with_binary(self):
+        'Fall back to base64 when binary data is sent as text'
+        packet = format_packet_text(4, bytearray(b'\x00\x01\xff'))
+        self.assertEqual(packet[:2], b'b4')
+        self.assertEqual(b64decode(packet[2:]), b'\x00\x01\xff')
+
+    def test_engineIO_content_round_trip(self):
+        'Decode what encode_engineIO_content produced'
+        content = encode_engineIO_content([(2, 'probe'), (4, '2["event"]')])
+        self.assertEqual(list(decode_engineIO_content(bytes(content))), [
+            (2, b'probe'), (4, b'2["event"]')])
+
+    def test_decode_engineIO_content_matches_reference(self):
+        'Decode payloads like the byte by byte parser'
+        rng = random.Random(0)
+        for i in range(300):
+            content = random_payload(rng)
+            for c in (bytes(content), content):
+                self.assertEqual(
+                    list(decode_engineIO_content(c)),
+                    list(reference_parsers.decode_engineIO_content(c)))
+
+    def test_decode_malformed_engineIO_content_matches_reference(self):
+        'Fail or succeed on damaged payloads like the byte by byte parser'
+        rng = random.Random(1)
+        for i in range(1000):
+            content = random_payload(rng)
+            for j in range(rng.randint(1, 4)):
+                index = rng.randrange(len(content))
+                content[index] = rng.choice([0, 1, 9, 12, 48, 255])
+            content = bytes(content[:rng.randint(1, len(content))])
+            self.assertEqual(
+                decode_outcome(decode_engineIO_content, content),
+                decode_outcome(
+                    reference_parsers.decode_engineIO_content, content))
+
+    def test_parse_packet_text_matches_reference(self):
+        'Read the packet type of text and binary packets'
+        for byte in range(256):
+            packet_text = bytes(bytearray([byte])) + b'data'
+            self.assertEqual(
+                parse_packet_text(packet_text),
+                reference_parsers.parse_packet_text(packet_text))
+
+    def test_get_namespace_path_matches_reference(self):
+        'Read the namespace up to the first comma'
+        rng = random.Random(2)
+        for i in range(1000):
+            data = rng.choice([b'', b'/', b'/chat']) + random_bytes(
+                rng, rng.randint(0, 20)) + rng.choice([b'', b',', b',[1]'])
+            self.assertEqual(
+                get_namespace_path(data),
+                reference_parsers.get_namespace_path(data))
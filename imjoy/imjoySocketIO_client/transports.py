@@ -1,4 +1,6 @@
+import errno
 import requests
+import select
 import six
 import socket
 import ssl
@@ -10,7 +12,8 @@ import websocket
 from .exceptions import ConnectionError, TimeoutError
 from .parsers import (
     encode_engineIO_content, decode_engineIO_content,
-    format_packet_text, parse_packet_text)
+    format_packet_text, format_packet_binary, is_binary_packet_data,
+    parse_packet_text)
 from .symmetries import format_query, memoryview, parse_url
 
 # From https://github.com/invisibleroads/socketIO-client/pull/139#issuecomment-265124962
@@ -53,6 +56,10 @@ class AbstractTransport(object):
     def set_timeout(self, seconds=None):
         pass
 
+    def wait_readable(self, seconds=None):
+        'Return True when a packet can be received without blocking'
+        return True
+
     def close(self):
         pass
 
@@ -169,9 +176,17 @@ class WebsocketTransport(AbstractTransport):
         yield engineIO_packet_type, engineIO_packet_data
 
     def send_packet(self, engineIO_packet_type, engineIO_packet_data=''):
-        packet = format_packet_text(engineIO_packet_type, engineIO_packet_data)
+        if is_binary_packet_data(engineIO_packet_data):
+            # Send attachments as binary frames instead of base64 text
+            packet = format_packet_binary(
+                engineIO_packet_type, engineIO_packet_data)
+            opcode = websocket.ABNF.OPCODE_BINARY
+        else:
+            packet = format_packet_text(
+                engineIO_packet_type, engineIO_packet_data)
+            opcode = websocket.ABNF.OPCODE_TEXT
         try:
-            self._connection.send(packet)
+            self._connection.send(packet, opcode)
         except websocket.WebSocketTimeoutException as e:
             raise TimeoutError('send timed out (%s)' % e)
         except socket.error as e:
@@ -182,6 +197,21 @@ class WebsocketTransport(AbstractTransport):
     def set_timeout(self, seconds=None):
         self._connection.settimeout(seconds or self._timeout)
 
+    def wait_readable(self, seconds=None):
+        sock = self._connection.sock
+        if sock is None:
+            raise ConnectionError('recv disconnected (socket closed)')
+        # SSL sockets may hold decrypted data that select does not see
+        if hasattr(sock, 'pending') and sock.pending():
+            return True
+        try:
+            readable, _, _ = select.select([sock], [], [], seconds)
+        except (select.error, socket.error, ValueError) as e:
+            if getattr(e, 'args', None) and e.args[0] == errno.EINTR:
+                return False
+            raise ConnectionError('recv disconnected (%s)' % e)
+        return bool(readable)
+
     def close(self):
         self._connection.close()
 
@@ -0,0 +1,335 @@
+"""
+Image tiles for the files shared through generated urls.
+
+Level 0 is the full resolution image, every following level is half the size
+of the previous one, down to a level which fits in one tile. Levels stored in
+the file (pyramidal TIFF/OME-TIFF, multiscale zarr) are read directly, the
+other levels are generated from the four tiles below them, so every tile is
+computed once. Tiles are cached as .npy files and the least recently used
+ones are removed when the cache is full.
+
+Only the region of a tile is read from the file. Tiles are read and encoded
+by a process pool (a thread pool where fork is not available), each process
+keeps the files it opened. The processes are forked by TileServer.start(),
+which the engine calls before it starts any thread.
+
+The last two axes of an image are y and x, or y, x and the samples of a RGB(A)
+image. The first plane of any other axis is served.
+"""
+import asyncio
+import collections
+import hashlib
+import io
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger('ImJoyTileServer')
+
+TILE_SIZE = 256
+TIFF_EXTENSIONS = ('.tif', '.tiff', '.svs', '.ndpi', '.scn')
+FORMATS = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'npy': 'application/octet-stream'}
+
+# images opened by the current process
+_images = {}
+
+
+class TiledImage(object):
+    """The zoom levels of an image, read lazily"""
+    def __init__(self, path):
+        self.path = path
+        stored = self._open(path)
+        base = stored[0]
+        self.rgb = base.ndim >= 3 and base.shape[-1] in (3, 4)
+        self.dtype = np.dtype(base.dtype)
+        self.height, self.width = self._size(base)
+        self.levels = max(0, int(math.ceil(math.log(max(self.height, self.width) / float(TILE_SIZE), 2)))) + 1
+        # zoom level -> array stored with the size of that level
+        self.stored = {}
+        for array in stored:
+            height, width = self._size(array)
+            level = int(round(math.log(self.width / float(width), 2)))
+            if level < self.levels and (height, width) == self.levelSize(level):
+                self.stored.setdefault(level, array)
+
+    def _open(self, path):
+        if os.path.isdir(path):
+            if zarr is None:
+                raise ImportError('zarr is required to serve tiles of zarr files.')
+            z = zarr.open(path, mode='r')
+            if isinstance(z, zarr.Array):
+                return [z]
+            # OME-NGFF multiscales, or the arrays of the group
+            multiscales = z.attrs.get('multiscales', None)
+            if multiscales:
+                return [z[d['path']] for d in multiscales[0]['datasets']]
+            arrays = [a for _, a in z.arrays()]
+            if not arrays:
+                raise ValueError('no array found in {}.'.format(path))
+            return sorted(arrays, key=lambda a: -a.size)
+        elif path.lower().endswith(TIFF_EXTENSIONS):
+            if tifffile is None or zarr is None:
+                raise ImportError('tifffile and zarr are required to serve tiles of TIFF files.')
+            with tifffile.TiffFile(path) as tif:
+                series = tif.series[0]
+                levels = len(series.levels)
+            return [zarr.open(tifffile.imread(path, aszarr=True, series=0, level=level), mode='r') for level in range(levels)]
+        elif path.lower().endswith('.npy'):
+            return [np.load(path, mmap_mode='r')]
+        raise ValueError('unsupported image file: {}'.format(os.path.basename(path)))
+
+    def _size(self, array):
+        if self.rgb:
+            return array.shape[-3], array.shape[-2]
+        return array.shape[-2], array.shape[-1]
+
+    def levelSize(self, level):
+        scale = 2 ** level
+        return (self.height + scale - 1) // scale, (self.width + scale - 1) // scale
+
+    def info(self):
+        return {'width': self.width, 'height': self.height, 'levels': self.levels,
+                'tile_size': TILE_SIZE, 'dtype': str(self.dtype),
+                'samples': self.stored[0].shape[-1] if self.rgb else 1,
+                'stored_levels': sorted(self.stored.keys())}
+
+    def read(self, level, y0, y1, x0, x1):
+        array = self.stored[level]
+        lead = array.ndim - (3 if self.rgb else 2)
+        index = (0,) * lead + (slice(y0, y1), slice(x0, x1))
+        return np.asarray(array[index])
+
+
+def open_image(path):
+    mtime = os.path.getmtime(path)
+    image = _images.get(path, None)
+    if image is None or image[0] != mtime:
+        image = (mtime, TiledImage(path))
+        _images[path] = image
+    return image[1]
+
+
+def tile_path(cache_dir, level, col, row):
+    return os.path.join(cache_dir, str(level), '{}_{}.npy'.format(col, row))
+
+
+def downsample(tile, dtype):
+    'Halve the size of a tile by averaging 2x2 pixels'
+    height, width = tile.shape[:2]
+    # repeat the last row/column of odd sized tiles
+    tile = np.pad(tile, [(0, height % 2), (0, width % 2)] + [(0, 0)] * (tile.ndim - 2), mode='edge')
+    tile = tile.reshape((tile.shape[0] // 2, 2, tile.shape[1] // 2, 2) + tile.shape[2:])
+    tile = tile.mean(axis=(1, 3))
+    if dtype.kind in 'iub':
+        tile = np.rint(tile)
+    return tile.astype(dtype)
+
+
+def get_tile(image, cache_dir, level, col, row, written):
+    height, width = image.levelSize(level)
+    y0, x0 = row * TILE_SIZE, col * TILE_SIZE
+    if level < 0 or level >= image.levels or y0 >= height or x0 >= width or y0 < 0 or x0 < 0:
+        raise ValueError('tile {}/{}_{} is out of the image.'.format(level, col, row))
+    path = tile_path(cache_dir, level, col, row)
+    try:
+        return np.load(path)
+    except (IOError, OSError, ValueError):
+        # not cached, being removed from the cache or incomplete
+        pass
+    if level in image.stored:
+        tile = image.read(level, y0, min(y0 + TILE_SIZE, height), x0, min(x0 + TILE_SIZE, width))
+    else:
+        children = [[get_tile(image, cache_dir, level - 1, 2 * col + i, 2 * row + j, written)
+                     for i in range(2) if (2 * col + i) * TILE_SIZE < image.levelSize(level - 1)[1]]
+                    for j in range(2) if (2 * row + j) * TILE_SIZE < image.levelSize(level - 1)[0]]
+        tile = downsample(np.concatenate([np.concatenate(r, axis=1) for r in children], axis=0), image.dtype)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write a temporary file first, other processes may read the tile
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb') as f:
+        np.save(f, tile)
+    os.replace(tmp_path, path)
+    written.append((path, os.path.getsize(path)))
+    return tile
+
+
+def encode_tile(tile, format):
+    if format == 'npy':
+        buf = io.BytesIO()
+        np.save(buf, tile)
+        return buf.getvalue()
+    if Image is None:
+        raise ImportError('Pillow is required to encode tiles as {}.'.format(format))
+    if format == 'png' and tile.ndim == 2 and tile.dtype == np.uint16:
+        img = Image.fromarray(tile)
+    elif tile.dtype == np.uint8:
+        img = Image.fromarray(tile)
+    else:
+        raise ValueError('{} tiles can not be encoded as {}, use npy instead.'.format(tile.dtype, format))
+    buf = io.BytesIO()
+    img.save(buf, format='PNG' if format == 'png' else 'JPEG')
+    return buf.getvalue()
+
+
+def read_info(path):
+    return open_image(path).info()
+
+
+def read_tile(path, cache_dir, level, col, row, format):
+    'Return the encoded tile and the files added to the cache'
+    written = []
+    tile = get_tile(open_image(path), cache_dir, level, col, row, written)
+    return encode_tile(tile, format), written
+
+
+class TileCache(object):
+    """Cached tiles by order of use, the least recently used are removed when
+    the cache is larger than `max_size`"""
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.files = collections.OrderedDict()
+        self.size = 0
+        # the modification time records the last use across restarts
+        found = []
+        for dirpath, _, files in os.walk(root):
+            for name in files:
+                path = os.path.join(dirpath, name)
+                try:
+                    if name.endswith('.tmp'):
+                        os.remove(path)
+                        continue
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(found):
+            self.files[path] = size
+            self.size += size
+        self.evict()
+
+    def getDir(self, path):
+        stat = os.stat(path)
+        key = '{}:{}:{}'.format(os.path.abspath(path), stat.st_mtime, stat.st_size)
+        return os.path.join(self.root, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+    def add(self, path, size):
+        self.size += size - self.files.pop(path, 0)
+        self.files[path] = size
+
+    def touch(self, path):
+        if path in self.files:
+            self.files.move_to_end(path)
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+
+    def evict(self):
+        while self.size > self.max_size and self.files:
+            path, size = self.files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class TileServer(object):
+    def __init__(self, cache_dir, cache_size, workers):
+        self.cache = None
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.workers = workers
+        self.executor = None
+        # the scan of the cache directory, shared by the first requests
+        self.cache_job = None
+        # requests for the same tile share one job
+        self.jobs = {}
+
+    def start(self):
+        """Fork the processes reading the tiles, it must be called before any
+        thread is started: a lock held by another thread while forking would
+        stay locked in the processes"""
+        if self.executor is None and sys.platform.startswith('linux'):
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'))
+            # the pool forks all its processes with the first job
+            self.executor.submit(int).result()
+
+    def getExecutor(self):
+        if self.executor is None:
+            # spawned processes would start another engine
+            self.executor = ThreadPoolExecutor(self.workers)
+        return self.executor
+
+    async def get_cache(self):
+        if self.cache is None:
+            # walking the cache directory may take a while
+            if self.cache_job is None:
+                loop = asyncio.get_event_loop()
+                self.cache_job = loop.run_in_executor(None, TileCache, self.cache_dir, self.cache_size)
+            self.cache = await asyncio.shield(self.cache_job)
+        return self.cache
+
+    async def run(self, func, *args):
+        'Run func in the pool, the pool is forked again if one of its processes died'
+        loop = asyncio.get_event_loop()
+        executor = self.getExecutor()
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            if self.executor is executor:
+                logger.warning('A tile process died, starting new tile processes.')
+                executor.shutdown(wait=False)
+                # the engine threads are running by now, but a dead process
+                # must not fail every following request
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'))
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    async def get_info(self, path):
+        return await self.run(read_info, path)
+
+    async def get_tile(self, path, level, col, row, format):
+        if format not in FORMATS:
+            raise ValueError('unsupported tile format: {}'.format(format))
+        cache = await self.get_cache()
+        loop = asyncio.get_event_loop()
+        cache_dir = await loop.run_in_executor(None, cache.getDir, path)
+        key = (cache_dir, level, col, row, format)
+        if key not in self.jobs:
+            self.jobs[key] = asyncio.ensure_future(self.run(read_tile, path, cache_dir, level, col, row, format))
+            self.jobs[key].add_done_callback(lambda f: self.jobs.pop(key, None))
+        data, written = await asyncio.shield(self.jobs[key])
+        for file_path, size in written:
+            self.cache.add(file_path, size)
+        self.cache.touch(tile_path(cache_dir, level, col, row))
+        self.cache.evict()
+        return data, FORMATS[format]
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
@@ -35,6 +35,20 @@ def setInterval(interval):
     return decorator
 
 
+EXECUTORS = ['loop', 'thread', 'process']
+
+def executor(policy):
+    """Decorator choosing where a synchronous plugin method runs (python 3):
+    'loop' (default) in the event loop, 'thread' in a thread pool or 'process'
+    in a process pool (Linux only, the arguments and the result are pickled).
+    """
+    if policy not in EXECUTORS:
+        raise ValueError('executor must be one of {}.'.format(', '.join(EXECUTORS)))
+    def decorator(function):
+        function.__imjoy_executor__ = policy
+        return function
+    return decorator
+
 class dotdict(dict):
     """dot.notation access to dictionary attributes"""
     __getattr__ = dict.get
@@ -58,18 +72,20 @@ class ReferenceStore():
         return id
 
     def _releaseId(self, id):
+        # self._indices holds the released ids, in order, followed by the
+        # last id given out
+        if id == self._indices[-1]:
+            # shrink the sequence tail
+            self._indices[-1] -= 1
+            while len(self._indices) > 1 and self._indices[-2] == self._indices[-1]:
+                self._indices.pop(-2)
+                self._indices[-1] -= 1
+            return
         for i in range(len(self._indices)):
             if id < self._indices[i]:
                 self._indices.insert(i, id)
                 break
 
-        # cleaning-up the sequence tail
-        for i in reversed(range(len(self._indices))):
-            if self._indices[i]-1 == self._indices[i-1]:
-                self._indices.pop()
-            else:
-                break
-
     def put(self, obj):
         id = self._genId()
         self._store[id] = obj
@@ -2,9 +2,73 @@ import asyncio
 import sys
 import traceback
 import inspect
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from imjoyUtils import Promise
+
+# methods run in the process pool, the forked processes find them by key
+_process_methods = {}
+
+def _call_process_method(key, args):
+    return _process_methods[key](*args)
+
+def get_executor(self, policy, logger):
+    if policy == 'process' and not sys.platform.startswith('linux'):
+        # spawned processes can not find the methods of the plugin
+        logger.warning('process executors are only supported on Linux, using threads.')
+        policy = 'thread'
+    if policy not in self._executors:
+        if policy == 'thread':
+            self._executors[policy] = ThreadPoolExecutor()
+        else:
+            self._executors[policy] = ProcessPoolExecutor(mp_context=multiprocessing.get_context('fork'))
+    return self._executors[policy], policy
+
+async def call_method(self, method, args, logger):
+    """Call an interface method or a callback with the executor declared with
+    api.utils.executor, async methods always run in the event loop"""
+    policy = getattr(method, '__imjoy_executor__', 'loop')
+    if policy == 'loop' or inspect.iscoroutinefunction(method):
+        result = method(*args)
+    else:
+        loop = asyncio.get_event_loop()
+        executor, policy = get_executor(self, policy, logger)
+        if policy == 'thread':
+            result = await loop.run_in_executor(executor, functools.partial(method, *args))
+        else:
+            key = id(method)
+            if _process_methods.get(key, None) is not method:
+                _process_methods[key] = method
+                # the processes forked before do not know this method
+                executor.shutdown(wait=False)
+                del self._executors[policy]
+                executor, policy = get_executor(self, policy, logger)
+            result = await loop.run_in_executor(executor, _call_process_method, key, args)
+    if result is not None and inspect.isawaitable(result):
+        result = await result
+    return result
+
+def has_stream(aObject):
+    if isinstance(aObject, dict):
+        if aObject.get('__jailed_type__') == 'ndarray_stream':
+            return True
+        return any(has_stream(v) for v in aObject.values())
+    if isinstance(aObject, list):
+        return any(has_stream(v) for v in aObject)
+    return False
+
+async def unwrap_args(self, args):
+    """Decode the arguments of a call, received streams block until all
+    their chunks arrived which must not happen in the loop receiving them"""
+    if getattr(self.socketIO, 'loop', None) is asyncio.get_event_loop() and has_stream(args):
+        return await asyncio.get_event_loop().run_in_executor(None, self._unwrap, args, True)
+    return self._unwrap(args, True)
+
 async def task_worker(self, async_q, logger, abort=None):
+    # wait for the sent messages when the connection supports it
+    drain = getattr(self.socketIO, 'drain', None)
     while True:
         if abort is not None and abort.is_set():
             break
@@ -35,28 +99,27 @@ async def task_worker(self, async_q, logger, abort=None):
                         logger.info('error during execution: %s', traceback.format_exc())
                         self.emit({'type':'executeFailure', 'error': repr(e)})
             elif d['type'] == 'method':
-                if d['name'] in self._interface:
+                interface = self._interface
+                if 'pid' in d and d['pid'] is not None:
+                    interface = self._plugin_interfaces[d['pid']]
+                if d['name'] in interface:
                     if 'promise' in d:
                         try:
                             resolve, reject = self._unwrap(d['promise'], False)
-                            method = self._interface[d['name']]
-                            args = self._unwrap(d['args'], True)
+                            method = interface[d['name']]
+                            args = await unwrap_args(self, d['args'])
                             # args.append({'id': self.id})
-                            result = method(*args)
-                            if result is not None and inspect.isawaitable(result):
-                                result = await result
+                            result = await call_method(self, method, args, logger)
                             resolve(result)
                         except Exception as e:
                             logger.error('error in method %s: %s', d['name'], traceback.format_exc())
                             reject(e)
                     else:
                         try:
-                            method = self._interface[d['name']]
-                            args = self._unwrap(d['args'], True)
+                            method = interface[d['name']]
+                            args = await unwrap_args(self, d['args'])
                             # args.append({'id': self.id})
-                            result = method(*args)
-                            if result is not None and inspect.isawaitable(result):
-                                await result
+                            await call_method(self, method, args, logger)
                         except Exception as e:
                             logger.error('error in method %s: %s', d['name'], traceback.format_exc())
                 else:
@@ -66,11 +129,9 @@ async def task_worker(self, async_q, logger, abort=None):
                     try:
                         resolve, reject = self._unwrap(d['promise'], False)
                         method = self._store.fetch(d['id'])[d['num']]
-                        args = self._unwrap(d['args'], True)
+                        args = await unwrap_args(self, d['args'])
                         # args.append({'id': self.id})
-                        result = method(*args)
-                        if result is not None and inspect.isawaitable(result):
-                            result = await result
+                        result = await call_method(self, method, args, logger)
                         resolve(result)
                     except Exception as e:
                         logger.error('error in method %s: %s', d['id'], traceback.format_exc())
@@ -78,13 +139,13 @@ async def task_worker(self, async_q, logger, abort=None):
                 else:
                     try:
                         method = self._store.fetch(d['id'])[d['num']]
-                        args = self._unwrap(d['args'], True)
+                        args = await unwrap_args(self, d['args'])
                         # args.append({'id': self.id})
-                        result = method(*args)
-                        if result is not None and inspect.isawaitable(result):
-                            await reresultt
+                        await call_method(self, method, args, logger)
                     except Exception as e:
                         logger.error('error in method %s: %s', d['id'], traceback.format_exc())
+            if drain is not None:
+                await drain()
         except Exception as e:
             print('error occured in the loop.', e)
         finally:
@@ -93,23 +154,31 @@ async def task_worker(self, async_q, logger, abort=None):
 
 
 class FuturePromise(Promise, asyncio.Future):
+    """A promise which can be awaited in the event loop of the plugin, it may
+    be created and settled from other threads, e.g. in methods running with
+    the thread executor or by the thread receiving the messages"""
     def __init__(self, pfunc, loop):
         self.loop = loop
+        # bind the loop first, `pfunc` may settle the promise right away
+        asyncio.Future.__init__(self, loop=loop)
         Promise.__init__(self, pfunc)
-        asyncio.Future.__init__(self)
 
     def resolve(self, result):
         if self._resolve_handler or self._finally_handler:
             Promise.resolve(self, result)
         else:
-            self.loop.call_soon(self.set_result, result)
-
+            self.loop.call_soon_threadsafe(self._settle, self.set_result, result)
 
     def reject(self, error):
         if self._catch_handler or self._finally_handler:
             Promise.reject(self, error)
         else:
             if error:
-                self.loop.call_soon(self.set_exception, Exception())
+                self.loop.call_soon_threadsafe(self._settle, self.set_exception, Exception())
             else:
-                self.loop.call_soon(self.set_exception, Exception(str(error)))
+                self.loop.call_soon_threadsafe(self._settle, self.set_exception, Exception(str(error)))
+
+    def _settle(self, setter, value):
+        # the future may have been cancelled by the awaiting task
+        if not self.done():
+            setter(value)
@@ -7,17 +7,23 @@ import random
 import math
 import traceback
 import uuid
-from functools import reduce
 import inspect
 import threading
 import copy
+import tempfile
+import itertools
 from imjoySocketIO_client import SocketIO, LoggingNamespace, find_callback
-from imjoyUtils import debounce, setInterval, dotdict, ReferenceStore
+from imjoyUtils import debounce, setInterval, executor, dotdict, ReferenceStore
+from imjoyIPC import IPCClient
 
 if sys.version_info >= (3, 0):
     import asyncio
     import janus
     from imjoyUtils3 import task_worker, FuturePromise
+    try:
+        from imjoySocketIO_client.asyncio_client import AsyncSocketIO
+    except ImportError:
+        AsyncSocketIO = None
     PYTHON3 = True
 else:
     from imjoyUtils import task_worker, Promise
@@ -28,12 +34,73 @@ try:
 except ImportError:
     import Queue as queue
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import zlib
+# codecs for compressing arrays, in order of preference
+CODECS = {}
+try:
+    import zstandard
+    CODECS['zstd'] = (zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress)
+except ImportError:
+    pass
+try:
+    import lz4.frame
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+CODECS['zlib'] = (lambda data: zlib.compress(data, 1), zlib.decompress)
+CODEC_PREFERENCE = ['zstd', 'lz4', 'zlib']
+
 logging.basicConfig(stream=sys.stdout)
 logger = logging.getLogger('plugin')
 logger.setLevel(logging.INFO)
 # import logging
 # logging.basicConfig(level=logging.DEBUG)
 ARRAY_CHUNK = 1000000
+# arrays larger than this are streamed to peers supporting it
+STREAM_THRESHOLD = 64 * ARRAY_CHUNK
+# number of chunks sent ahead of the receiver's acknowledgements
+STREAM_WINDOW = 8
+# received streams larger than this are stored in a memory-mapped temporary file
+STREAM_MEMMAP_THRESHOLD = 1024 * ARRAY_CHUNK
+STREAM_TIMEOUT = 600
+FEATURES = ['ndarray_stream', 'ndarray_list', 'batch']
+# remote calls made within BATCH_WINDOW seconds of the previous message are
+# sent together, only the last pending call to COALESCED_METHODS is sent
+BATCH_WINDOW = 0.01
+COALESCED_METHODS = ['showProgress', 'showStatus']
+# lists of numbers with at least this many items are sent as arrays
+VECTORIZE_THRESHOLD = 64
+# arguments are packed with msgpack for peers supporting it, values which are
+# not native msgpack types are tagged with these ext type codes
+EXT_CALLBACK = 1
+EXT_INTERFACE = 2
+EXT_NDARRAY = 4
+EXT_ERROR = 5
+# arrays larger than ARRAY_CHUNK are sent beside the packed value with the
+# json encoding, in chunks, compressed or streamed, and referred to by index
+EXT_ARRAY_REF = 6
+# str and bytes can not be told apart in python 2
+if msgpack is not None and sys.version_info >= (3, 0):
+    FEATURES.append('msgpack')
+# arrays larger than this are compressed with the best codec supported by
+# both sides, if a sample compresses below COMPRESS_RATIO
+COMPRESS_THRESHOLD = ARRAY_CHUNK
+COMPRESS_SAMPLE_SIZE = 65536
+COMPRESS_RATIO = 0.8
+if sys.version_info >= (3, 0):
+    FEATURES.extend('compress:' + c for c in CODEC_PREFERENCE if c in CODECS)
+# set by the engine, plugins of the same engine exchange arrays through files
+# in SHM_DIR (a tmpfs when available) instead of sending them
+ENGINE_ID = os.environ.get('IMJOY_ENGINE_ID', None)
+SHM_DIR = os.environ.get('IMJOY_SHM_DIR', None)
+SHM_THRESHOLD = ARRAY_CHUNK
+# the sender removes the shared files which were not mapped within this time
+SHM_TIMEOUT = 600
 
 if '' not in sys.path:
     sys.path.insert(0, '')
@@ -42,6 +109,15 @@ imjoy_path = os.path.dirname(os.path.normpath(__file__))
 if imjoy_path not in sys.path:
     sys.path.insert(0, imjoy_path)
 
+if PYTHON3:
+    NUMBER_TYPES = set([int, float, bool])
+else:
+    NUMBER_TYPES = set([int, long, float, bool])
+# the dtype kinds which convert back to numbers of the same type
+NUMBER_KINDS = {int: 'iu', float: 'f', bool: 'b'}
+if not PYTHON3:
+    NUMBER_KINDS[long] = 'iu'
+
 def kill(proc_pid):
     import psutil
     process = psutil.Process(proc_pid)
@@ -49,6 +125,228 @@ def kill(proc_pid):
         proc.kill()
     process.kill()
 
+def array_buffer(np, v):
+    """Return a flat byte memoryview over the data of `v`.
+
+    No copy is made unless the array is not C-contiguous.
+    """
+    v = np.ascontiguousarray(v)
+    return memoryview(v.reshape(-1).view(np.uint8))
+
+def join_chunks(chunks):
+    """Assemble binary chunks into one preallocated bytearray.
+
+    Each chunk is released as soon as it has been copied, so the peak memory
+    stays close to the size of the assembled buffer.
+    """
+    if not isinstance(chunks, list):
+        chunks = list(chunks)
+    buf = bytearray(sum(len(c) for c in chunks))
+    view = memoryview(buf)
+    offset = 0
+    for i in range(len(chunks)):
+        size = len(chunks[i])
+        view[offset:offset + size] = chunks[i]
+        offset += size
+        chunks[i] = None
+    return buf
+
+def get_numpy():
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+def vectorize_list(np, v):
+    """Convert a list of numbers, or a list of equal-length sequences of
+    numbers, to an array which converts back to the same list.
+
+    Return None for any other list.
+    """
+    if type(v[0]) in (list, tuple):
+        if not set(map(type, v)) <= set([list, tuple]) or len(set(map(len, v))) != 1:
+            return None
+        types = set(map(type, itertools.chain.from_iterable(v)))
+    else:
+        types = set(map(type, v))
+    # mixed types would not convert back to the same values
+    if len(types) != 1 or not types <= NUMBER_TYPES:
+        return None
+    try:
+        array = np.array(v)
+    except (ValueError, OverflowError):
+        return None
+    # integers which do not fit in int64 or uint64 give object or float
+    # arrays, the values would not convert back
+    if array.dtype.kind not in NUMBER_KINDS[types.pop()]:
+        return None
+    return array
+
+def shuffle_bytes(np, v):
+    """Group the n-th bytes of all the items together, which makes typed
+    arrays of small values far more compressible."""
+    flat = np.ascontiguousarray(v).reshape(-1).view(np.uint8)
+    if v.dtype.itemsize == 1:
+        return flat
+    return np.ascontiguousarray(flat.reshape(-1, v.dtype.itemsize).T)
+
+def unshuffle_bytes(np, buf, dtype, shape):
+    dtype = np.dtype(dtype)
+    flat = np.frombuffer(buf, dtype=np.uint8)
+    if dtype.itemsize > 1:
+        flat = np.ascontiguousarray(flat.reshape(dtype.itemsize, -1).T)
+    else:
+        # copy into a writable buffer like the uncompressed arrays
+        flat = flat.copy()
+    return flat.view(dtype).reshape(shape)
+
+def compress_array(np, v, codec):
+    """Return the shuffled and compressed data of `v`, or None if it does
+    not compress well"""
+    compress = CODECS[codec][0]
+    # test on the first items before compressing everything
+    count = max(1, COMPRESS_SAMPLE_SIZE // max(1, v.dtype.itemsize))
+    sample = shuffle_bytes(np, np.ascontiguousarray(v).reshape(-1)[:count])
+    if len(compress(memoryview(sample))) > COMPRESS_RATIO * sample.nbytes:
+        return None
+    data = compress(memoryview(shuffle_bytes(np, v)))
+    if len(data) > COMPRESS_RATIO * v.nbytes:
+        return None
+    return data
+
+def decompress_array(np, data, codec, dtype, shape):
+    if codec not in CODECS:
+        raise Exception('Unsupported codec: {}'.format(codec))
+    return unshuffle_bytes(np, CODECS[codec][1](data), dtype, tuple(shape))
+
+def share_array(np, v):
+    """Copy an array into a new file in SHM_DIR and return its descriptor"""
+    fd, path = tempfile.mkstemp(dir=SHM_DIR, suffix='.bin')
+    os.close(fd)
+    try:
+        shared = np.memmap(path, dtype=v.dtype, mode='r+', shape=v.shape)
+        shared[...] = v
+        shared.flush()
+        del shared
+    except Exception:
+        os.remove(path)
+        raise
+    return {'__jailed_type__': 'ndarray_shm', '__value__': os.path.basename(path), '__shape__': v.shape, '__dtype__': str(v.dtype)}
+
+def map_shared_array(np, desc):
+    """Map an array shared by another plugin, the file is removed once mapped"""
+    path = os.path.join(SHM_DIR, os.path.basename(desc['__value__']))
+    # copy-on-write, changes made by the receiver stay private
+    array = np.memmap(path, dtype=desc['__dtype__'], mode='c', shape=tuple(desc['__shape__']))
+    # the data is freed when the last mapping is closed
+    os.remove(path)
+    return array
+
+class ArrayStream(object):
+    """Send an array (or a np.memmap) in chunks which are only read when sent.
+
+    The receiver pulls the data: nothing is sent before its first
+    acknowledgement, and at most `window` chunks are sent ahead of the last
+    chunk it acknowledged. A stream which is not pulled within
+    STREAM_TIMEOUT is cancelled.
+    """
+    def __init__(self, np, array, chunk_size=ARRAY_CHUNK, window=STREAM_WINDOW):
+        self.id = str(uuid.uuid4())
+        self.np = np
+        self.array = array
+        self.window = window
+        # chunks are slices of the flat bytes of the array, whatever its shape
+        self.chunk_size = chunk_size
+        self.count = max(1, int(math.ceil(array.nbytes / float(chunk_size))))
+        self.acked = None
+        self.cancelled = False
+        self._cond = threading.Condition()
+
+    def descriptor(self):
+        return {'__jailed_type__': 'ndarray_stream', '__value__': self.id, '__shape__': self.array.shape,
+                '__dtype__': str(self.array.dtype), '__chunks__': self.count, '__size__': self.array.nbytes}
+
+    def ack(self, index):
+        """Return True when the first acknowledgement is received"""
+        with self._cond:
+            started = self.acked is None
+            if self.acked is None or index > self.acked:
+                self.acked = index
+            self._cond.notify()
+        return started
+
+    def cancel(self):
+        with self._cond:
+            self.cancelled = True
+            self._cond.notify()
+
+    def finished(self):
+        return self.cancelled or (self.acked is not None and self.acked >= self.count - 1)
+
+    def send(self, emit):
+        # only copied here if the array is not contiguous, a np.memmap is
+        # read from the disk one chunk at a time
+        buffer = array_buffer(self.np, self.array)
+        self.array = None
+        for i in range(self.count):
+            with self._cond:
+                while not self.cancelled and i > self.acked + self.window:
+                    if not self._cond.wait(STREAM_TIMEOUT) and i > self.acked + self.window:
+                        logger.error('stream %s timed out.', self.id)
+                        self.cancelled = True
+                if self.cancelled:
+                    break
+            chunk = buffer[i * self.chunk_size:(i + 1) * self.chunk_size]
+            emit({'type': 'streamChunk', 'id': self.id, 'index': i, 'data': chunk})
+
+class ArrayStreamReceiver(object):
+    """Assemble a streamed array in place as its chunks arrive"""
+    def __init__(self, np, desc, work_dir=None):
+        self.id = desc['__value__']
+        self.count = desc['__chunks__']
+        shape = tuple(desc['__shape__'])
+        if desc.get('__size__', 0) > STREAM_MEMMAP_THRESHOLD:
+            # the file is removed once the array is released
+            self.array = np.memmap(tempfile.TemporaryFile(dir=work_dir), dtype=desc['__dtype__'], mode='w+', shape=shape)
+        else:
+            self.array = np.empty(shape, dtype=desc['__dtype__'])
+        self._view = array_buffer(np, self.array)
+        self._offset = 0
+        self.received = -1
+        self.error = None
+        self._done = threading.Event()
+
+    def add(self, index, data):
+        if index <= self.received:
+            # sent again, already assembled
+            return
+        if index != self.received + 1:
+            self.error = 'chunk {} received out of order, expected {}'.format(index, self.received + 1)
+            self._done.set()
+            return
+        self._view[self._offset:self._offset + len(data)] = data
+        self._offset += len(data)
+        self.received = index
+        if index >= self.count - 1:
+            self._done.set()
+
+    def cancel(self, error):
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=STREAM_TIMEOUT):
+        # wait as long as chunks keep arriving
+        received = self.received
+        while not self._done.wait(timeout):
+            if self.received == received:
+                raise Exception('stream {} timed out.'.format(self.id))
+            received = self.received
+        self._view = None
+        if self.error is not None:
+            raise Exception(self.error)
+        return self.array
+
 def ndarray(typedArray, shape, dtype):
     _dtype = type(typedArray)
     if dtype and dtype != _dtype:
@@ -56,10 +354,10 @@ def ndarray(typedArray, shape, dtype):
     shape = shape or (len(typedArray), )
     return {"__jailed_type__": 'ndarray', "__value__" : typedArray, "__shape__": shape, "__dtype__": _dtype}
 
-api_utils = dotdict(ndarray=ndarray, kill=kill, debounce=debounce, setInterval=setInterval)
+api_utils = dotdict(ndarray=ndarray, kill=kill, debounce=debounce, setInterval=setInterval, executor=executor)
 
 class PluginConnection():
-    def __init__(self, pid, secret, protocol='http', host='127.0.0.1', port=8080, queue=None, loop=None, worker=None, namespace='/', work_dir=None, daemon=False, api=None):
+    def __init__(self, pid, secret, protocol='http', host='127.0.0.1', port=8080, queue=None, loop=None, worker=None, namespace='/', work_dir=None, daemon=False, api=None, pooled=False, ipc=None):
         if work_dir is None or work_dir == '' or work_dir == '.':
             self.work_dir = os.getcwd()
         else:
@@ -67,15 +365,39 @@ class PluginConnection():
             if not os.path.exists(self.work_dir):
                 os.makedirs(self.work_dir)
             os.chdir(self.work_dir)
-        socketIO = SocketIO(host, port, LoggingNamespace)
+        socketIO = None
+        if ipc is not None:
+            try:
+                socketIO = IPCClient(ipc)
+            except Exception as e:
+                logger.warning('failed to connect to %s, using socket.io instead: %s', ipc, e)
+        # the blocking client reconnects by itself, daemons keep using it
+        if socketIO is None and PYTHON3 and AsyncSocketIO is not None and loop is not None and not daemon:
+            try:
+                socketIO = AsyncSocketIO(host, port, loop)
+            except Exception as e:
+                logger.warning('failed to connect with the asyncio client, using the blocking client instead: %s', e)
+        if socketIO is None:
+            socketIO = SocketIO(host, port, LoggingNamespace)
         self.socketIO = socketIO
         self._init = False
         self.secret = secret
         self.id = pid
         self.daemon = daemon
 
+        self._batch = []
+        self._batch_lock = threading.RLock()
+        self._batch_timer = None
+        self._batch_time = 0
+        def send(msg):
+            socketIO.emit('from_plugin_'+ self.secret, msg)
         def emit(msg):
-            socketIO.emit('from_plugin_'+ secret, msg)
+            with self._batch_lock:
+                # keep the order of the messages
+                if self._batch:
+                    self._flushBatch()
+                send(msg)
+        self._send = send
         self.emit = emit
 
         self._local = {}
@@ -85,6 +407,20 @@ class PluginConnection():
         self._plugin_interfaces = {}
         self._remote_set = False
         self._store = ReferenceStore()
+        self._streams = {}
+        self._incoming_streams = {}
+        # files of the arrays shared with plugins of this engine and the time
+        # they are removed at if the receiver did not map them
+        self._shared_files = {}
+        self._shared_lock = threading.Lock()
+        self._shared_timer = None
+        self._peer_features = set()
+        # codec used to compress large arrays, negotiated with the peer
+        self._codec = None
+        # decode the lists sent as arrays to numpy arrays instead of lists
+        self._lists_as_arrays = False
+        # pools running the methods declared with api.utils.executor
+        self._executors = {}
         self._executed = False
         self.queue = queue
         self.loop = loop
@@ -92,8 +428,13 @@ class PluginConnection():
         self._init = False
         sys.stdout.flush()
         socketIO.on('to_plugin_'+secret, self.sio_plugin_message)
-        self.emit({"type": "initialized", "dedicatedThread": True})
-        print('Plugin "{}" Initialized.'.format(pid))
+        if pooled:
+            # wait in the pool until the engine assigns a plugin to this worker
+            self.emit({"type": "workerReady"})
+            print('Worker "{}" is ready.'.format(pid))
+        else:
+            self.emit({"type": "initialized", "dedicatedThread": True, "features": FEATURES})
+            print('Plugin "{}" Initialized.'.format(pid))
         def on_disconnect():
             if not self.daemon:
                 self.exit(1)
@@ -102,21 +443,43 @@ class PluginConnection():
         self.worker = worker
 
 
+    def claim(self, pid, secret, work_dir):
+        self.id = pid
+        self.secret = secret
+        if work_dir is not None and work_dir != '':
+            if not os.path.exists(work_dir):
+                os.makedirs(work_dir)
+            os.chdir(work_dir)
+            self.work_dir = work_dir
+            os.environ['WORK_DIR'] = work_dir
+            self._setLocalAPI(self._local['api'])
+        self.socketIO.on('to_plugin_'+secret, self.sio_plugin_message)
+        self.emit({"type": "initialized", "dedicatedThread": True, "features": FEATURES})
+        print('Plugin "{}" Initialized.'.format(pid))
+
     def wait_forever(self):
-        if PYTHON3:
-            self.sync_q = self.queue.sync_q
+        if PYTHON3 and AsyncSocketIO is not None and isinstance(self.socketIO, AsyncSocketIO):
+            # messages are received in the event loop, no thread in between
+            async_q = asyncio.Queue()
+            self._enqueue = async_q.put_nowait
+            t = [self.worker(self, async_q, logger, self.abort) for i in range(10)]
+            self.loop.run_until_complete(asyncio.gather(self.socketIO.wait(), *t))
+        elif PYTHON3:
+            self._enqueue = self.queue.sync_q.put
             fut = self.loop.run_in_executor(None, self.socketIO.wait)
             t = [self.worker(self, self.queue.async_q, logger, self.abort) for i in range(10)]
             self.loop.run_until_complete(asyncio.gather(*t))
             self.loop.run_until_complete(fut)
         else:
-            self.sync_q = queue.Queue()
+            sync_q = queue.Queue()
+            self._enqueue = sync_q.put
             t = threading.Thread(target=self.socketIO.wait)
             t.daemon = True
             t.start()
-            self.worker(self, self.sync_q, logger, self.abort)
+            self.worker(self, sync_q, logger, self.abort)
 
     def exit(self, code):
+        self._releaseFiles()
         if 'exit' in self._interface:
             try:
                 self._interface['exit']()
@@ -129,7 +492,7 @@ class PluginConnection():
         else:
             sys.exit(0)
 
-    def _encode(self, aObject, callbacks):
+    def _encode(self, aObject, callbacks, local=False, shared=None):
         if aObject is None:
             return aObject
         if type(aObject) is tuple:
@@ -146,7 +509,7 @@ class PluginConnection():
             for k in aObject.keys():
                 v = aObject[k]
                 if callable(v):
-                    bObject[k] = {'__jailed_type__': 'plugin_interface', '__plugin_id__':aObject['__id__'], '__value__' : k, 'num': None}
+                    bObject[k] = {'__jailed_type__': 'plugin_interface', '__plugin_id__':aObject['__id__'], '__value__' : k, 'num': None, '__host__': self._hostOf(v, aObject.get('__host__', ENGINE_ID))}
                     encoded_interface[k] = v
             self._plugin_interfaces[aObject['__id__']] = encoded_interface
             return bObject
@@ -159,6 +522,11 @@ class PluginConnection():
                 basestring
             except NameError:
                 basestring = str
+            vectorized = None
+            if type(v) in (list, tuple) and len(v) >= VECTORIZE_THRESHOLD and (local or 'ndarray_list' in self._peer_features):
+                np = self._local.get('np') or get_numpy()
+                if np is not None:
+                    vectorized = vectorize_list(np, v)
             if callable(v):
                 interfaceFuncName = None
                 for name in self._interface:
@@ -168,27 +536,46 @@ class PluginConnection():
                 if interfaceFuncName is None:
                     cid = str(uuid.uuid4())
                     callbacks[cid] = v
-                    vObj = {'__jailed_type__': 'callback', '__value__' : 'f', 'num': cid}
+                    vObj = {'__jailed_type__': 'callback', '__value__' : 'f', 'num': cid, '__host__': self._hostOf(v)}
                 else:
                     vObj = {'__jailed_type__': 'interface', '__value__' : interfaceFuncName}
 
           # // send objects supported by structure clone algorithm
           # // https://developer.mozilla.org/en-US/docs/Web/API/Web_Workers_API/Structured_clone_algorithm
             #if(v !== Object(v) || v instanceof Boolean || v instanceof String || v instanceof Date || v instanceof RegExp || v instanceof Blob || v instanceof File || v instanceof FileList || v instanceof ArrayBuffer || v instanceof ArrayBufferView || v instanceof ImageData){
+            elif 'np' in self._local and isinstance(v, self._local['np'].ndarray) and v.ndim > 0 and v.nbytes > STREAM_THRESHOLD and 'ndarray_stream' in self._peer_features:
+                # only a descriptor is sent, the receiver pulls the chunks
+                stream = ArrayStream(self._local['np'], v)
+                self._addStream(stream)
+                vObj = stream.descriptor()
+            elif local and 'np' in self._local and isinstance(v, self._local['np'].ndarray) and v.ndim > 0 and v.nbytes > SHM_THRESHOLD:
+                # the receiver runs on the same host, only send the file name
+                vObj = share_array(self._local['np'], v)
+                self._ownFile(os.path.join(SHM_DIR, vObj['__value__']), shared)
             elif 'np' in self._local and isinstance(v, (self._local['np'].ndarray, self._local['np'].generic)):
-                vb = bytearray(v.tobytes())
+                compressed = None
+                if not local and self._codec is not None and v.nbytes > COMPRESS_THRESHOLD:
+                    compressed = compress_array(self._local['np'], v, self._codec)
+                if compressed is not None:
+                    vb = memoryview(compressed)
+                else:
+                    # slice the array's own buffer instead of copying it
+                    vb = array_buffer(self._local['np'], v)
                 if len(vb)>ARRAY_CHUNK:
-                    vl = int(math.ceil(1.0*len(vb)/ARRAY_CHUNK))
-                    v_bytes = []
-                    for i in range(vl):
-                        v_bytes.append(vb[i*ARRAY_CHUNK:(i+1)*ARRAY_CHUNK])
+                    v_bytes = [vb[i:i+ARRAY_CHUNK] for i in range(0, len(vb), ARRAY_CHUNK)]
                 else:
                     v_bytes = vb
                 vObj = {'__jailed_type__': 'ndarray', '__value__' : v_bytes, '__shape__': v.shape, '__dtype__': str(v.dtype)}
+                if compressed is not None:
+                    vObj['__codec__'] = self._codec
+                    vObj['__filter__'] = 'shuffle'
+            elif vectorized is not None:
+                # one typed buffer instead of a dict for every number
+                vObj = {'__jailed_type__': 'ndarray', '__value__' : array_buffer(np, vectorized), '__shape__': vectorized.shape, '__dtype__': str(vectorized.dtype), '__list__': True}
             elif type(v) is dict or type(v) is list:
-                vObj = self._encode(v, callbacks)
+                vObj = self._encode(v, callbacks, local, shared)
             elif not isinstance(v, basestring) and type(v) is bytes:
-                vObj = v.decode() # covert python3 bytes to str
+                vObj = {'__jailed_type__': 'argument', '__value__' : v.decode()} # covert python3 bytes to str
             elif isinstance(v, Exception):
                 vObj = {'__jailed_type__': 'error', '__value__' : str(v)}
             else:
@@ -206,7 +593,7 @@ class PluginConnection():
             return aObject
         if '__jailed_type__' in aObject and '__value__' in aObject:
             if aObject['__jailed_type__'] == 'callback':
-                bObject = self._genRemoteCallback(callbackId, aObject['num'], withPromise)
+                bObject = self._genRemoteCallback(callbackId, aObject['num'], withPromise, aObject.get('__host__', None))
             elif aObject['__jailed_type__'] == 'interface':
                 name = aObject['__value__']
                 if name in self._remote:
@@ -214,22 +601,33 @@ class PluginConnection():
                 else:
                     bObject = self._genRemoteMethod(name)
             elif aObject['__jailed_type__'] == 'plugin_interface':
-                bObject = self._genRemoteMethod(aObject['__value__'], aObject['__plugin_id__'])
+                bObject = self._genRemoteMethod(aObject['__value__'], aObject['__plugin_id__'], aObject.get('__host__', None))
             elif aObject['__jailed_type__'] == 'ndarray':
                 # create build array/tensor if used in the plugin
                 try:
-                    np = self._local['np']
-                    if isinstance(aObject['__value__'], bytearray):
+                    np = self._local.get('np') or get_numpy()
+                    if isinstance(aObject['__value__'], (bytearray, bytes, memoryview)):
                         aObject['__value__'] = aObject['__value__']
                     elif isinstance(aObject['__value__'], list) or isinstance(aObject['__value__'], tuple):
-                        aObject['__value__'] = reduce((lambda x, y: x + y), aObject['__value__'])
+                        aObject['__value__'] = join_chunks(aObject['__value__'])
                     else:
                         raise Exception('Unsupported data type: ', type(aObject['__value__']), aObject['__value__'])
-                    bObject = np.frombuffer(aObject['__value__'], dtype=aObject['__dtype__']).reshape(tuple(aObject['__shape__']))
+                    if '__codec__' in aObject:
+                        bObject = decompress_array(np, aObject['__value__'], aObject['__codec__'], aObject['__dtype__'], aObject['__shape__'])
+                    else:
+                        bObject = np.frombuffer(aObject['__value__'], dtype=aObject['__dtype__']).reshape(tuple(aObject['__shape__']))
+                    if aObject.get('__list__', False) and not self._lists_as_arrays:
+                        bObject = bObject.tolist()
                 except Exception as e:
                     logger.debug('Error in converting: %s', e)
                     bObject = aObject
                     raise e
+            elif aObject['__jailed_type__'] == 'ndarray_shm':
+                bObject = map_shared_array(self._local['np'], aObject)
+            elif aObject['__jailed_type__'] == 'ndarray_stream':
+                bObject = self._receiveStream(aObject)
+            elif aObject['__jailed_type__'] == 'packed':
+                bObject = self._unpack(aObject, callbackId, withPromise)
             elif aObject['__jailed_type__'] == 'error':
                 bObject = Exception(aObject['__value__'])
             elif aObject['__jailed_type__'] == 'argument':
@@ -253,9 +651,89 @@ class PluginConnection():
                             bObject[k] = self._decode(v, callbackId, withPromise)
             return bObject
 
-    def _wrap(self, args):
+    def _pack(self, aObject, callbacks):
+        np = self._local.get('np', None)
+        arrays = []
+        def texts(v):
+            # bytes are sent as str, like the json encoding does
+            if type(v) is bytes:
+                return v.decode()
+            if isinstance(v, dict):
+                return {k: texts(x) for k, x in v.items()}
+            if isinstance(v, (list, tuple)):
+                return [texts(x) for x in v]
+            return v
+        def default(v):
+            if callable(v):
+                for name in self._interface:
+                    if self._interface[name] == v:
+                        return msgpack.ExtType(EXT_INTERFACE, name.encode('utf-8'))
+                cid = str(uuid.uuid4())
+                callbacks[cid] = v
+                return msgpack.ExtType(EXT_CALLBACK, cid.encode('utf-8'))
+            elif np is not None and isinstance(v, (np.ndarray, np.generic)):
+                if v.nbytes > ARRAY_CHUNK:
+                    arrays.append(v)
+                    return msgpack.ExtType(EXT_ARRAY_REF, str(len(arrays) - 1).encode('utf-8'))
+                data = [list(v.shape), str(v.dtype), array_buffer(np, v)]
+                return msgpack.ExtType(EXT_NDARRAY, msgpack.packb(data, use_bin_type=True))
+            elif isinstance(v, Exception):
+                return msgpack.ExtType(EXT_ERROR, str(v).encode('utf-8'))
+            raise TypeError('can not pack {}'.format(type(v)))
+        data = msgpack.packb(texts(aObject), default=default, use_bin_type=True)
+        packed = {'__jailed_type__': 'packed', '__format__': 'msgpack', '__value__': data}
+        if arrays:
+            packed['__arrays__'] = self._encode(arrays, callbacks)
+        return packed
+
+    def _unpack(self, aObject, callbackId, withPromise):
+        if msgpack is None or aObject.get('__format__') != 'msgpack':
+            raise Exception('Unsupported format: {}'.format(aObject.get('__format__')))
+        arrays = self._decode(aObject.get('__arrays__', []), callbackId, withPromise)
+        def ext_hook(code, data):
+            if code == EXT_CALLBACK:
+                return self._genRemoteCallback(callbackId, data.decode('utf-8'), withPromise)
+            elif code == EXT_INTERFACE:
+                name = data.decode('utf-8')
+                if name in self._remote:
+                    return self._remote[name]
+                return self._genRemoteMethod(name)
+            elif code == EXT_NDARRAY:
+                shape, dtype, buf = msgpack.unpackb(data, raw=False)
+                np = self._local.get('np') or get_numpy()
+                # copy into a writable buffer like the json decoding
+                return np.frombuffer(bytearray(buf), dtype=dtype).reshape(tuple(shape))
+            elif code == EXT_ARRAY_REF:
+                return arrays[int(data.decode('utf-8'))]
+            elif code == EXT_ERROR:
+                return Exception(data.decode('utf-8'))
+            return msgpack.ExtType(code, data)
+        return msgpack.unpackb(bytes(aObject['__value__']), ext_hook=ext_hook, object_hook=dotdict, raw=False)
+
+    def _canPack(self, args):
+        if msgpack is None or 'msgpack' not in FEATURES or 'msgpack' not in self._peer_features:
+            return False
+        # interfaces and already encoded values need the json encoding,
+        # wherever they are nested
+        def encoded(v):
+            if isinstance(v, dict):
+                return '__jailed_type__' in v or any(encoded(x) for x in v.values())
+            if isinstance(v, (list, tuple)):
+                return any(encoded(x) for x in v)
+            return False
+        return not encoded(args)
+
+    def _wrap(self, args, local=False, shared=None):
         callbacks = {}
-        wrapped = self._encode(args, callbacks)
+        wrapped = None
+        if not local and self._canPack(args):
+            try:
+                wrapped = self._pack(list(args), callbacks)
+            except (TypeError, ValueError, OverflowError) as e:
+                logger.debug('falling back to json encoding: %s', e)
+                callbacks = {}
+        if wrapped is None:
+            wrapped = self._encode(args, callbacks, local, shared)
         result = {'args': wrapped}
         if len(callbacks.keys()) > 0:
             result['callbackId'] = self._store.put(callbacks)
@@ -269,6 +747,9 @@ class PluginConnection():
         result = self._decode(args["args"], args["callbackId"], withPromise)
         return result
 
+    def decodeListsAsArrays(self, enable=True):
+        self._lists_as_arrays = enable
+
     def setInterface(self, api):
         if inspect.isclass(type(api)):
             api = {a:getattr(api, a) for a in dir(api) if not a.startswith('_')}
@@ -294,43 +775,159 @@ class PluginConnection():
                   names.append({"name":name, "data": data})
         self.emit({'type':'setInterface', 'api': names})
 
-    def _genRemoteMethod(self, name, plugin_id=None):
+    def _isLocal(self, host):
+        return host is not None and host == ENGINE_ID and SHM_DIR is not None and os.path.isdir(SHM_DIR)
+
+    def _hostOf(self, v, host=ENGINE_ID):
+        """Return the host to tag an encoded function with, the calls are
+        decoded by this plugin so it is only tagged with this engine when the
+        function does not come from another one"""
+        host = getattr(v, '__imjoy_host__', host)
+        return host if host == ENGINE_ID else None
+
+    def _ownFile(self, path, shared=None):
+        with self._shared_lock:
+            self._shared_files[path] = time.time() + SHM_TIMEOUT
+            if self._shared_timer is None:
+                self._shared_timer = threading.Timer(SHM_TIMEOUT, self._expireFiles)
+                self._shared_timer.daemon = True
+                self._shared_timer.start()
+        if shared is not None:
+            shared.append(path)
+
+    def _releaseFiles(self, paths=None):
+        """Remove the shared files which were not mapped by the receiver"""
+        with self._shared_lock:
+            if paths is None:
+                paths = list(self._shared_files.keys())
+            for path in paths:
+                self._shared_files.pop(path, None)
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                # mapped and removed by the receiver
+                pass
+
+    def _expireFiles(self):
+        with self._shared_lock:
+            self._shared_timer = None
+            now = time.time()
+            expired = [path for path, deadline in self._shared_files.items() if deadline <= now]
+            remaining = [deadline for deadline in self._shared_files.values() if deadline > now]
+            if remaining:
+                self._shared_timer = threading.Timer(min(remaining) - now, self._expireFiles)
+                self._shared_timer.daemon = True
+                self._shared_timer.start()
+        if expired:
+            logger.warning('removing %s shared arrays which were not received.', len(expired))
+            self._releaseFiles(expired)
+
+    def _releaseOnSettle(self, shared, resolve, reject):
+        """Remove the files shared with a call once it returned or failed, the
+        receiver has mapped them by then"""
+        if not shared:
+            return resolve, reject
+        def _resolve(result):
+            self._releaseFiles(shared)
+            resolve(result)
+        def _reject(error):
+            self._releaseFiles(shared)
+            reject(error)
+        return _resolve, _reject
+
+    def _batchCall(self, msg, resolve):
+        with self._batch_lock:
+            now = time.time()
+            if not self._batch and now - self._batch_time > BATCH_WINDOW:
+                self._batch_time = now
+                self._send(msg)
+                return
+            if msg['name'] in COALESCED_METHODS:
+                for i, (pending, pending_resolve) in enumerate(self._batch):
+                    if pending['name'] == msg['name'] and pending['pid'] == msg['pid']:
+                        # superseded, release its callbacks and resolve it
+                        del self._batch[i]
+                        for wrapped in (pending['args'], pending['promise']):
+                            if 'callbackId' in wrapped:
+                                self._store.fetch(wrapped['callbackId'])
+                        pending_resolve(None)
+                        break
+            self._batch.append((msg, resolve))
+            if self._batch_timer is None:
+                self._batch_timer = threading.Timer(BATCH_WINDOW, self._flushBatch)
+                self._batch_timer.daemon = True
+                self._batch_timer.start()
+
+    def _flushBatch(self):
+        with self._batch_lock:
+            if self._batch_timer is not None:
+                self._batch_timer.cancel()
+                self._batch_timer = None
+            batch, self._batch = self._batch, []
+            if len(batch) == 0:
+                return
+            self._batch_time = time.time()
+            if len(batch) == 1:
+                self._send(batch[0][0])
+            else:
+                self._send({'type': 'batch', 'messages': [msg for msg, _ in batch]})
+
+    def _genRemoteMethod(self, name, plugin_id=None, host=None):
+        local = self._isLocal(host)
         def remoteMethod(*arguments, **kwargs):
             # wrap keywords to a dictionary and pass to the first argument
             if len(arguments) == 0 and len(kwargs) > 0:
                 arguments = [kwargs]
             def p(resolve, reject):
-                call_func = {
-                    'type': 'method',
-                    'name': name,
-                    'pid': plugin_id,
-                    'args': self._wrap(arguments),
-                    # 'pid'  : self.id,
-                    'promise': self._wrap([resolve, reject])
-                }
-                self.emit(call_func)
+                shared = []
+                try:
+                    args = self._wrap(arguments, local, shared)
+                    resolve, reject = self._releaseOnSettle(shared, resolve, reject)
+                    call_func = {
+                        'type': 'method',
+                        'name': name,
+                        'pid': plugin_id,
+                        'args': args,
+                        # 'pid'  : self.id,
+                        'promise': self._wrap([resolve, reject])
+                    }
+                    self._batchCall(call_func, resolve)
+                except Exception:
+                    self._releaseFiles(shared)
+                    raise
             if PYTHON3:
                 return FuturePromise(p, self.loop)
             else:
                 return Promise(p)
 
+        if host is not None:
+            remoteMethod.__imjoy_host__ = host
         return remoteMethod
 
-    def _genRemoteCallback(self, id, argNum, withPromise):
+    def _genRemoteCallback(self, id, argNum, withPromise, host=None):
+        local = self._isLocal(host)
         if withPromise:
             def remoteCallback(*arguments, **kwargs):
                 # wrap keywords to a dictionary and pass to the first argument
                 if len(arguments) == 0 and len(kwargs) > 0:
                     arguments = [kwargs]
                 def p(resolve, reject):
-                    self.emit({
-                        'type' : 'callback',
-                        'id'   : id,
-                        'num'  : argNum,
-                        # 'pid'  : self.id,
-                        'args' : self._wrap(arguments),
-                        'promise': self._wrap([resolve, reject])
-                    })
+                    shared = []
+                    try:
+                        args = self._wrap(arguments, local, shared)
+                        resolve, reject = self._releaseOnSettle(shared, resolve, reject)
+                        self.emit({
+                            'type' : 'callback',
+                            'id'   : id,
+                            'num'  : argNum,
+                            # 'pid'  : self.id,
+                            'args' : args,
+                            'promise': self._wrap([resolve, reject])
+                        })
+                    except Exception:
+                        self._releaseFiles(shared)
+                        raise
                 if PYTHON3:
                     return FuturePromise(p, self.loop)
                 else:
@@ -341,14 +938,21 @@ class PluginConnection():
                 # wrap keywords to a dictionary and pass to the first argument
                 if len(arguments) == 0 and len(kwargs) > 0:
                     arguments = [kwargs]
-                ret = self.emit({
-                    'type' : 'callback',
-                    'id'   : id,
-                    'num'  : argNum,
-                    # 'pid'  : self.id,
-                    'args' : self._wrap(arguments)
-                })
+                shared = []
+                try:
+                    ret = self.emit({
+                        'type' : 'callback',
+                        'id'   : id,
+                        'num'  : argNum,
+                        # 'pid'  : self.id,
+                        'args' : self._wrap(arguments, local, shared)
+                    })
+                except Exception:
+                    self._releaseFiles(shared)
+                    raise
                 return ret
+        if host is not None:
+            remoteCallback.__imjoy_host__ = host
         return remoteCallback
 
     def _setRemote(self, api):
@@ -377,16 +981,89 @@ class PluginConnection():
 
     def _setLocalAPI(self, _remote):
         _remote["export"] = self.setInterface
-        _remote["utils"] = api_utils
+        _remote["utils"] = dotdict(api_utils, decodeListsAsArrays=self.decodeListsAsArrays)
         _remote["WORK_DIR"] = self.work_dir
         self._local["api"] = _remote
 
+    def _receiveStream(self, desc):
+        receiver = ArrayStreamReceiver(self._local['np'], desc, self.work_dir)
+        self._incoming_streams[receiver.id] = receiver
+        try:
+            self.emit({'type': 'streamAck', 'id': receiver.id, 'index': -1})
+            return receiver.wait()
+        except Exception as e:
+            self.emit({'type': 'streamCancel', 'id': receiver.id, 'error': str(e)})
+            raise
+        finally:
+            del self._incoming_streams[receiver.id]
+
+    def _addStream(self, stream):
+        self._streams[stream.id] = stream
+        timer = threading.Timer(STREAM_TIMEOUT, self._expireStream, [stream])
+        timer.daemon = True
+        timer.start()
+
+    def _expireStream(self, stream):
+        # the receiver never pulled the stream, release the array
+        if stream.acked is None and self._streams.pop(stream.id, None) is not None:
+            logger.error('stream %s was not received.', stream.id)
+            stream.cancel()
+
+    def _sendStream(self, stream):
+        try:
+            stream.send(self.emit)
+        except Exception as e:
+            logger.error('failed to send stream %s: %s', stream.id, traceback.format_exc())
+            self.emit({'type': 'streamCancel', 'id': stream.id, 'error': str(e)})
+            stream.cancel()
+        if stream.cancelled:
+            self._streams.pop(stream.id, None)
+
+    def _streamMessage(self, data):
+        # stream messages are handled as they arrive instead of being queued,
+        # the task waiting for a stream would otherwise block them
+        if data['type'] == 'streamAck':
+            stream = self._streams.get(data['id'])
+            if stream is None:
+                return
+            if stream.ack(data['index']):
+                t = threading.Thread(target=self._sendStream, args=(stream,))
+                t.daemon = True
+                t.start()
+            if stream.finished():
+                self._streams.pop(stream.id, None)
+        elif data['type'] == 'streamChunk':
+            receiver = self._incoming_streams.get(data['id'])
+            if receiver is None:
+                return
+            receiver.add(data['index'], data['data'])
+            self.emit({'type': 'streamAck', 'id': data['id'], 'index': data['index']})
+        elif data['type'] == 'streamCancel':
+            if data['id'] in self._streams:
+                self._streams.pop(data['id']).cancel()
+            elif data['id'] in self._incoming_streams:
+                self._incoming_streams[data['id']].cancel(data.get('error', 'stream cancelled.'))
+
     def sio_plugin_message(self, *args):
         data = args[0]
-        if data['type']== 'import':
+        if data['type'] in ['streamAck', 'streamChunk', 'streamCancel']:
+            self._streamMessage(data)
+        elif data['type'] == 'features':
+            self._peer_features = set(data.get('features', []))
+            self._codec = None
+            for codec in CODEC_PREFERENCE:
+                if 'compress:' + codec in FEATURES and 'compress:' + codec in self._peer_features:
+                    self._codec = codec
+                    break
+        elif data['type']== 'import':
             self.emit({'type':'importSuccess', 'url': data['url']})
         elif data['type']== 'disconnect':
+            self._flushBatch()
             self.abort.set()
+            for stream in list(self._streams.values()):
+                stream.cancel()
+            self._streams.clear()
+            self._releaseFiles()
             callback, args = find_callback(args)
             try:
                 if 'exit' in self._interface and callable(self._interface['exit']):
@@ -395,15 +1072,21 @@ class PluginConnection():
                 logger.error('Error when exiting: %s', e)
             if callback:
                 callback(*args)
+        elif data['type'] == 'claim':
+            self.claim(data['id'], data['secret'], data.get('work_dir', None))
         elif data['type'] == 'execute':
             if not self._executed:
-                self.sync_q.put(data)
+                self._enqueue(data)
             else:
                 logger.debug('skip execution.')
                 self.emit({'type':'executeSuccess'})
         elif data['type'] == 'message':
             d = data['data']
-            self.sync_q.put(d)
+            if d['type'] == 'batch':
+                for msg in d['messages']:
+                    self._enqueue(msg)
+            else:
+                self._enqueue(d)
             logger.debug('added task to the queue')
         sys.stdout.flush()
 
@@ -416,6 +1099,8 @@ if __name__ == "__main__":
     parser.add_argument('--host', type=str, default='127.0.0.1', help='socketio host')
     parser.add_argument('--port', type=str, default='8080', help='socketio port')
     parser.add_argument('--daemon', action="store_true", help='daemon mode')
+    parser.add_argument('--ipc', type=str, default=None, help='unix socket of the engine, used instead of socket.io')
+    parser.add_argument('--pooled', action="store_true", help='start as an idle worker waiting to be claimed by a plugin')
     parser.add_argument('--debug', action="store_true", help='debug mode')
 
     opt = parser.parse_args()
@@ -429,5 +1114,5 @@ if __name__ == "__main__":
         loop = None
         q = None
 
-    pc = PluginConnection(opt.id, opt.secret, host=opt.host, port=int(opt.port), work_dir=opt.work_dir, queue=q, loop=loop, worker=task_worker)
+    pc = PluginConnection(opt.id, opt.secret, host=opt.host, port=int(opt.port), work_dir=opt.work_dir, queue=q, loop=loop, worker=task_worker, pooled=opt.pooled, ipc=opt.ipc)
     pc.wait_forever()
@@ -0,0 +1,111 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+# the worker modules import each other from the imjoy directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imjoyIPC import HEADER, IPCClient, pack_frame, reconstruct, unpack_header  # noqa: E402
+
+
+def recv_exactly(sock, size):
+    buf = b''
+    while len(buf) < size:
+        data = sock.recv(size - len(buf))
+        if not data:
+            raise EOFError('connection closed')
+        buf += data
+    return buf
+
+
+def read_frame(sock):
+    'Read a frame like the engine does'
+    size = HEADER.unpack(recv_exactly(sock, HEADER.size))[0]
+    header = unpack_header(recv_exactly(sock, size))
+    attachments = [recv_exactly(sock, n) for n in header['attachments']]
+    return header, reconstruct(header['data'], attachments)
+
+
+class Test_IPCClient(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'engine.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+        self.client = IPCClient(path)
+        self.engine = listener.accept()[0]
+        listener.close()
+        self.received = []
+        self.disconnected = threading.Event()
+        self.client.on('to_plugin', lambda data, *args: self.received.append((data,) + args))
+        self.client.on('disconnect', self.disconnected.set)
+        self.thread = threading.Thread(target=self.client.wait)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.engine.close()
+        self.thread.join(1)
+        shutil.rmtree(self.dir)
+
+    def wait_received(self, count):
+        deadline = time.time() + 5
+        while len(self.received) < count and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.received), count)
+
+    def test_attachments(self):
+        'Send a message with several binary attachments both ways'
+        large = bytearray(os.urandom(3000000))
+        message = {'a': b'123', 'b': [b'', memoryview(large), {'c': bytearray(b'4')}], 'd': 'text'}
+        # the frame is larger than the socket buffer
+        sender = threading.Thread(target=self.client.emit, args=('from_plugin', message))
+        sender.start()
+        header, data = read_frame(self.engine)
+        sender.join()
+        self.assertEqual(header['event'], 'from_plugin')
+        self.assertEqual(header['attachments'], [3, 0, len(large), 1])
+        self.assertEqual(data, {'a': b'123', 'b': [b'', bytes(large), {'c': b'4'}], 'd': 'text'})
+        for buf in pack_frame({'event': 'to_plugin'}, message):
+            self.engine.sendall(buf)
+        self.wait_received(1)
+        self.assertEqual(self.received[0][0], data)
+
+    def test_split_frame(self):
+        'Reassemble a frame received in small pieces'
+        frame = b''.join(bytes(buf) for buf in pack_frame({'event': 'to_plugin'}, [b'\x00' * 1000, 'x', b'y']))
+        for i in range(0, len(frame), 7):
+            self.engine.sendall(frame[i:i + 7])
+            if i < 100:
+                # let the client read the header length and header in parts
+                time.sleep(0.005)
+        self.wait_received(1)
+        self.assertEqual(self.received[0][0], [bytearray(1000), 'x', bytearray(b'y')])
+
+    def test_ack(self):
+        'Answer the acknowledgements in both directions'
+        replies = []
+        self.client.emit('from_plugin', {'a': 1}, lambda *args: replies.append(args))
+        header, data = read_frame(self.engine)
+        for buf in pack_frame({'reply': header['ack']}, ['ok', b'z']):
+            self.engine.sendall(buf)
+        for buf in pack_frame({'event': 'to_plugin', 'ack': 7}, {'b': 2}):
+            self.engine.sendall(buf)
+        self.wait_received(1)
+        self.assertEqual(replies, [('ok', b'z')])
+        data, callback = self.received[0]
+        callback('done')
+        header, data = read_frame(self.engine)
+        self.assertEqual((header['reply'], data), (7, ['done']))
+
+    def test_disconnect(self):
+        'Stop when the engine closes the connection'
+        self.engine.close()
+        self.assertTrue(self.disconnected.wait(1))
@@ -0,0 +1,41 @@
+import os
+import random
+import sys
+from unittest import TestCase
+
+# the worker modules import each other from the imjoy directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imjoyUtils import ReferenceStore  # noqa: E402
+
+
+class Test_ReferenceStore(TestCase):
+
+    def test_reuse(self):
+        'Give out the released ids again, lowest first'
+        store = ReferenceStore()
+        self.assertEqual([store.put(i) for i in range(5)], [1, 2, 3, 4, 5])
+        self.assertEqual(store.fetch(4), 3)
+        self.assertEqual(store.fetch(2), 1)
+        self.assertEqual([store.put(i) for i in range(3)], [2, 4, 6])
+
+    def test_release(self):
+        'Release every id whatever the order of the fetches'
+        store = ReferenceStore()
+        rand = random.Random(0)
+        live = set()
+        for _ in range(2000):
+            if live and rand.random() < 0.5:
+                id = rand.choice(sorted(live))
+                store.fetch(id)
+                live.remove(id)
+            else:
+                id = store.put(None)
+                self.assertNotIn(id, live)
+                live.add(id)
+                # released ids are reused before new ones are given out
+                self.assertEqual(id, min(set(range(1, len(live) + 1)) - (live - set([id]))))
+        for id in live:
+            store.fetch(id)
+        self.assertEqual(store._store, {})
+        self.assertEqual(store._indices, [0])
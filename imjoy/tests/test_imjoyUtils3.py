@@ -0,0 +1,86 @@
+import asyncio
+import os
+import sys
+import threading
+from unittest import TestCase
+
+# the worker modules import each other from the imjoy directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imjoyUtils import executor  # noqa: E402
+from imjoyUtils3 import call_method, FuturePromise  # noqa: E402
+
+
+class Connection(object):
+    'The part of the plugin connection used by call_method'
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._executors = {}
+
+    def remote_method(self, result=None, error=None):
+        'Return a remote method like api.*, the reply arrives in another thread'
+        def remoteMethod(*args):
+            def p(resolve, reject):
+                if error is None:
+                    reply = threading.Timer(0.01, resolve, [result])
+                else:
+                    reply = threading.Timer(0.01, reject, [error])
+                reply.start()
+            return FuturePromise(p, self.loop)
+        return remoteMethod
+
+
+class Test_FuturePromise(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.connection = Connection(self.loop)
+
+    def tearDown(self):
+        for e in self.connection._executors.values():
+            e.shutdown()
+        self.loop.close()
+
+    def call(self, method, *args):
+        return self.loop.run_until_complete(asyncio.wait_for(
+            call_method(self.connection, method, list(args), None), 5))
+
+    def test_resolve_from_thread_method(self):
+        'Await an api call made by a method running in the thread executor'
+        getConfig = self.connection.remote_method(result=42)
+
+        @executor('thread')
+        def run(x):
+            return getConfig(x)
+        self.assertEqual(self.call(run, 'x'), 42)
+
+    def test_reject_from_thread_method(self):
+        'Raise the rejection of an api call made in the thread executor'
+        getConfig = self.connection.remote_method(error='failed')
+
+        @executor('thread')
+        def run():
+            return getConfig()
+        self.assertRaises(Exception, self.call, run)
+
+    def test_then_from_thread_method(self):
+        'Call the handlers of an api call made in the thread executor'
+        getConfig = self.connection.remote_method(result=42)
+        results = []
+        done = threading.Event()
+
+        @executor('thread')
+        def run():
+            getConfig().then(results.append).finally_(done.set)
+            done.wait(5)
+        self.call(run)
+        self.assertEqual(results, [42])
+
+    def test_resolve_in_loop(self):
+        'Await an api call made in the event loop'
+        getConfig = self.connection.remote_method(result=42)
+
+        async def run():
+            return await getConfig()
+        self.assertEqual(self.call(run), 42)
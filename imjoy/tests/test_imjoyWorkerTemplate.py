@@ -0,0 +1,390 @@
+import os
+import sys
+import threading
+import time
+from unittest import TestCase, mock, skipIf
+
+import numpy as np
+
+# the worker modules import each other from the imjoy directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imjoyUtils import ReferenceStore, dotdict  # noqa: E402
+import imjoyWorkerTemplate  # noqa: E402
+from imjoyWorkerTemplate import (  # noqa: E402
+    ARRAY_CHUNK, BATCH_WINDOW, CODECS, COMPRESS_SAMPLE_SIZE, ArrayStream, ArrayStreamReceiver, PluginConnection, compress_array,
+    decompress_array, msgpack, shuffle_bytes, vectorize_list)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class Test_VectorizeList(TestCase):
+
+    def assertRoundTrip(self, v):
+        array = vectorize_list(np, v)
+        self.assertIsNotNone(array)
+        converted = array.tolist()
+        self.assertEqual(converted, v)
+        self.assertEqual(
+            [type(x) for x in np.ravel(np.array(converted, dtype=object))],
+            [type(x) for x in np.ravel(np.array(v, dtype=object))])
+
+    def test_numbers(self):
+        'Vectorize lists of numbers of one type'
+        self.assertRoundTrip([1, -2, 3] * 40)
+        self.assertRoundTrip([0.5, -1.25, 1e300] * 40)
+        self.assertRoundTrip([True, False] * 40)
+        self.assertRoundTrip([2 ** 63 + 1, 2 ** 64 - 1] * 40)
+
+    def test_nested(self):
+        'Vectorize lists of equal-length lists of numbers'
+        self.assertRoundTrip([[1, 2, 3], [4, 5, 6]] * 40)
+        self.assertIsNone(vectorize_list(np, [[1, 2], [3]] * 40))
+
+    def test_mixed(self):
+        'Keep the lists mixing types'
+        self.assertIsNone(vectorize_list(np, [1, 2.5] * 40))
+        self.assertIsNone(vectorize_list(np, [1, True] * 40))
+        self.assertIsNone(vectorize_list(np, [1, 'a'] * 40))
+
+    def test_large_integers(self):
+        'Keep the integers which do not fit in a 64 bit dtype'
+        self.assertIsNone(vectorize_list(np, [-1, 2 ** 63 + 1] * 40))
+        self.assertIsNone(vectorize_list(np, [2 ** 63 + 1, 0] * 40))
+        self.assertIsNone(vectorize_list(np, [2 ** 64] * 40))
+        self.assertIsNone(vectorize_list(np, [[-1, 2 ** 63 + 1]] * 40))
+
+
+@skipIf(msgpack is None, 'msgpack is not installed')
+class Test_CanPack(TestCase):
+
+    def setUp(self):
+        self.connection = PluginConnection.__new__(PluginConnection)
+        self.connection._peer_features = set(['msgpack'])
+
+    def test_plain(self):
+        'Pack plain values'
+        self.assertTrue(self.connection._canPack([1, 'a', {'b': [2.5, None]}]))
+
+    def test_encoded(self):
+        'Keep the json encoding for encoded values at any depth'
+        encoded = {'__jailed_type__': 'plugin_api', '__id__': 'p'}
+        self.assertFalse(self.connection._canPack([encoded]))
+        self.assertFalse(self.connection._canPack([{'a': [encoded]}]))
+        self.assertFalse(self.connection._canPack([[(1, encoded)]]))
+
+
+class Test_RoundTrip(TestCase):
+    packed = False
+
+    def setUp(self):
+        self.connection = PluginConnection.__new__(PluginConnection)
+        self.connection._peer_features = set(['msgpack'] if self.packed else [])
+        self.connection._local = {'np': np}
+        self.connection._codec = None
+        self.connection._interface = {}
+        self.connection._remote = dotdict()
+        self.connection._store = ReferenceStore()
+        self.connection._lists_as_arrays = False
+        self.sent = []
+        self.connection.emit = self.sent.append
+
+    def roundTrip(self, args):
+        wrapped = self.connection._wrap(args)
+        self.assertEqual(wrapped['args'].get('__jailed_type__') == 'packed' if self.packed else False, self.packed)
+        return self.connection._unwrap(wrapped, False), wrapped
+
+    def test_nested(self):
+        'Send nested dicts and lists'
+        args = [{'a': [1, 2.5, None, {'b': 'c'}], 'd': {'e': [True, []]}}, 'f']
+        self.assertEqual(self.roundTrip(args)[0], args)
+
+    def test_ndarray(self):
+        'Send small and chunked arrays'
+        small = np.arange(12, dtype='int16').reshape(3, 4)
+        large = np.linspace(0, 1, ARRAY_CHUNK // 4).astype('float64')
+        if self.packed:
+            # the large array is sent in chunks beside the packed value
+            wrapped = self.connection._wrap([{'small': small, 'large': [large]}])['args']
+            self.assertLess(len(wrapped['__value__']), ARRAY_CHUNK)
+            self.assertEqual(len(wrapped['__arrays__'][0]['__value__']), 2)
+        result = self.roundTrip([{'small': small, 'large': [large]}])[0]
+        self.assertEqual(result[0]['small'].dtype, small.dtype)
+        self.assertTrue((result[0]['small'] == small).all())
+        self.assertTrue((result[0]['large'][0] == large).all())
+
+    def test_bytes(self):
+        'Send bytes as str'
+        self.assertEqual(self.roundTrip([b'abc', {'d': [b'e']}])[0], ['abc', {'d': ['e']}])
+
+    def test_callback(self):
+        'Call a callback sent in a nested value'
+        def callback(x):
+            return x
+        result, wrapped = self.roundTrip([{'a': [callback]}])
+        result[0]['a'][0](1)
+        message = self.sent[-1]
+        self.assertEqual(message['id'], wrapped['callbackId'])
+        callbacks = self.connection._store.fetch(wrapped['callbackId'])
+        self.assertIs(callbacks[message['num']], callback)
+
+
+@skipIf(msgpack is None, 'msgpack is not installed')
+class Test_PackedRoundTrip(Test_RoundTrip):
+    packed = True
+
+
+class Test_Compression(TestCase):
+
+    def assertRoundTrip(self, v, codec):
+        data = compress_array(np, v, codec)
+        self.assertIsNotNone(data)
+        self.assertLess(len(data), v.nbytes)
+        result = decompress_array(np, data, codec, str(v.dtype), list(v.shape))
+        self.assertEqual(result.dtype, v.dtype)
+        self.assertEqual(result.shape, v.shape)
+        self.assertTrue((result == v).all())
+        # like the uncompressed arrays, the result can be changed
+        result[...] = 0
+
+    def test_codecs(self):
+        'Compress and decompress with every available codec'
+        self.assertIn('zlib', CODECS)
+        for codec in CODECS:
+            with self.subTest(codec=codec):
+                self.assertRoundTrip(np.arange(ARRAY_CHUNK, dtype='uint8'), codec)
+                self.assertRoundTrip(np.arange(ARRAY_CHUNK).reshape(1000, -1), codec)
+
+    def test_shuffle(self):
+        'Group the bytes of the items of any layout by position'
+        for dtype in ('uint16', '>i4', 'float64', 'complex64'):
+            v = np.arange(24).astype(dtype).reshape(4, 6)
+            for view in (v, v[::2, ::3], v.T, np.asfortranarray(v)):
+                with self.subTest(dtype=dtype, strides=view.strides):
+                    expected = np.ascontiguousarray(view).reshape(-1).view(np.uint8).reshape(-1, view.dtype.itemsize)
+                    self.assertEqual(shuffle_bytes(np, view).tobytes(), expected.T.tobytes())
+
+    def test_non_contiguous(self):
+        'Compress views of multi-byte items'
+        v = np.arange(2 * ARRAY_CHUNK, dtype='int32').reshape(2000, -1)
+        for codec in CODECS:
+            with self.subTest(codec=codec):
+                self.assertRoundTrip(v[::2, 1::3], codec)
+                self.assertRoundTrip(v.T, codec)
+                self.assertRoundTrip(v.astype('float64')[:, ::2], codec)
+
+    def test_incompressible(self):
+        'Send random data uncompressed'
+        random = np.random.RandomState(0).randint(0, 256, ARRAY_CHUNK, dtype='uint8')
+        self.assertIsNone(compress_array(np, random, 'zlib'))
+        # the sample compresses but the rest of the array does not
+        random[:2 * COMPRESS_SAMPLE_SIZE] = 0
+        self.assertIsNone(compress_array(np, random, 'zlib'))
+
+    def test_negotiation(self):
+        'Only compress with a codec the peer supports'
+        connection = PluginConnection.__new__(PluginConnection)
+        connection._local = {'np': np}
+        v = np.zeros(2 * ARRAY_CHUNK, dtype='uint8')
+        connection.sio_plugin_message({'type': 'features', 'features': ['compress:unknown']})
+        self.assertIsNone(connection._codec)
+        self.assertNotIn('__codec__', connection._encode([v], {})[0])
+        connection.sio_plugin_message({'type': 'features', 'features': ['compress:zlib']})
+        self.assertEqual(connection._codec, 'zlib')
+        self.assertEqual(connection._encode([v], {})[0]['__codec__'], 'zlib')
+        with self.assertRaises(Exception):
+            decompress_array(np, b'', 'unknown', 'uint8', [0])
+
+
+class Test_ArrayStream(TestCase):
+
+    def transfer(self, array, **kwargs):
+        stream = ArrayStream(np, array, **kwargs)
+        receiver = ArrayStreamReceiver(np, stream.descriptor())
+        def emit(message):
+            receiver.add(message['index'], message['data'])
+            stream.ack(message['index'])
+        stream.ack(-1)
+        stream.send(emit)
+        self.assertTrue(stream.finished())
+        return receiver.wait(1)
+
+    def test_reassembly(self):
+        'Reassemble items split across chunks'
+        # 3 byte items, ARRAY_CHUNK is not a multiple of the item size
+        v = (np.arange(3 * ARRAY_CHUNK) % 251).astype('uint8').view('S3')
+        result = self.transfer(v)
+        self.assertEqual(result.dtype, v.dtype)
+        self.assertEqual(result.tobytes(), v.tobytes())
+        view = np.arange(3000, dtype='float64').reshape(100, 30)[::3, 1::2]
+        result = self.transfer(view, chunk_size=1001)
+        self.assertTrue((result == view).all())
+
+    def test_order(self):
+        'Fail on chunks received out of order, ignore repeated chunks'
+        v = np.arange(30, dtype='uint8')
+        stream = ArrayStream(np, v, chunk_size=10)
+        receiver = ArrayStreamReceiver(np, stream.descriptor())
+        receiver.add(0, v[:10].tobytes())
+        receiver.add(0, b'\0' * 10)
+        receiver.add(1, v[10:20].tobytes())
+        receiver.add(2, v[20:].tobytes())
+        self.assertTrue((receiver.wait(1) == v).all())
+        receiver = ArrayStreamReceiver(np, stream.descriptor())
+        receiver.add(1, v[10:20].tobytes())
+        with self.assertRaises(Exception):
+            receiver.wait(1)
+
+    def test_window(self):
+        'Stop sending until the next chunk is acknowledged'
+        stream = ArrayStream(np, np.arange(60, dtype='uint8'), chunk_size=10, window=2)
+        sent = []
+        thread = threading.Thread(target=stream.send, args=(sent.append,))
+        thread.daemon = True
+        stream.ack(-1)
+        thread.start()
+        self.assertTrue(wait_for(lambda: len(sent) == 2))
+        time.sleep(0.1)
+        self.assertEqual([m['index'] for m in sent], [0, 1])
+        stream.ack(1)
+        self.assertTrue(wait_for(lambda: len(sent) == 4))
+        time.sleep(0.1)
+        self.assertEqual(len(sent), 4)
+        stream.ack(3)
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([m['index'] for m in sent], list(range(6)))
+
+
+class Test_StreamCleanup(TestCase):
+
+    def setUp(self):
+        self.connection = PluginConnection.__new__(PluginConnection)
+        self.connection._local = {'np': np}
+        self.connection._streams = {}
+        self.connection._incoming_streams = {}
+        self.connection.work_dir = None
+        self.sent = []
+        self.connection.emit = self.sent.append
+
+    def test_cancel_sending(self):
+        'Release a stream cancelled by the receiver'
+        stream = ArrayStream(np, np.arange(60, dtype='uint8'), chunk_size=10, window=1)
+        self.connection._addStream(stream)
+        self.connection._streamMessage({'type': 'streamAck', 'id': stream.id, 'index': -1})
+        self.assertTrue(wait_for(lambda: len(self.sent) == 1))
+        self.connection._streamMessage({'type': 'streamCancel', 'id': stream.id})
+        self.assertNotIn(stream.id, self.connection._streams)
+        self.assertTrue(wait_for(lambda: stream.array is None))
+        time.sleep(0.1)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_cancel_receiving(self):
+        'Stop waiting for a stream cancelled by the sender'
+        stream = ArrayStream(np, np.arange(60, dtype='uint8'), chunk_size=10)
+        errors = []
+        def receive():
+            try:
+                self.connection._receiveStream(stream.descriptor())
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=receive)
+        thread.daemon = True
+        thread.start()
+        self.assertTrue(wait_for(lambda: stream.id in self.connection._incoming_streams))
+        self.connection._streamMessage({'type': 'streamCancel', 'id': stream.id, 'error': 'cancelled'})
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(str(errors[0]), 'cancelled')
+        self.assertEqual(self.connection._incoming_streams, {})
+
+    def test_timeout(self):
+        'Cancel the streams which are not pulled or acknowledged in time'
+        with mock.patch.object(imjoyWorkerTemplate, 'STREAM_TIMEOUT', 0.1):
+            pulled = ArrayStream(np, np.arange(60, dtype='uint8'), chunk_size=10, window=1)
+            not_pulled = ArrayStream(np, np.arange(60, dtype='uint8'), chunk_size=10)
+            self.connection._addStream(pulled)
+            self.connection._addStream(not_pulled)
+            self.connection._streamMessage({'type': 'streamAck', 'id': pulled.id, 'index': -1})
+            self.assertTrue(wait_for(lambda: self.connection._streams == {}, 2))
+        self.assertTrue(pulled.cancelled)
+        self.assertTrue(not_pulled.cancelled)
+        self.assertEqual(len(self.sent), 1)
+        receiver = ArrayStreamReceiver(np, not_pulled.descriptor())
+        receiver.add(0, b'\0' * 10)
+        with self.assertRaises(Exception):
+            receiver.wait(0.1)
+
+
+class Test_Batch(TestCase):
+
+    def setUp(self):
+        self.connection = PluginConnection.__new__(PluginConnection)
+        self.connection._batch = []
+        self.connection._batch_lock = threading.RLock()
+        self.connection._batch_timer = None
+        self.connection._batch_time = 0
+        self.connection._store = ReferenceStore()
+        self.connection._interface = {}
+        self.connection._peer_features = set()
+        self.connection._local = {}
+        self.sent = []
+        self.connection._send = self.sent.append
+        self.resolved = []
+
+    def call(self, name, value, pid=None):
+        'Make a remote call like remoteMethod does'
+        def resolve(result):
+            self.resolved.append((name, value, result))
+        def reject(error):
+            pass
+        msg = {'type': 'method', 'name': name, 'pid': pid, 'args': self.connection._wrap([value]),
+               'promise': self.connection._wrap([resolve, reject])}
+        self.connection._batchCall(msg, resolve)
+
+    def batch(self):
+        'Return the messages of the batch sent by the timer'
+        self.assertTrue(wait_for(lambda: len(self.sent) == 2, 1))
+        self.assertIsNone(self.connection._batch_timer)
+        self.assertEqual(self.sent[1]['type'], 'batch')
+        return self.sent[1]['messages']
+
+    def test_order(self):
+        'Send the calls made within the window together, in order'
+        for i in range(5):
+            self.call('f', i)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual([m['args']['args'][0]['__value__'] for m in [self.sent[0]] + self.batch()], list(range(5)))
+        # the window is over, the next call is sent right away
+        time.sleep(2 * BATCH_WINDOW)
+        self.call('f', 5)
+        self.assertEqual(len(self.sent), 3)
+
+    def test_coalesce(self):
+        'Only send the last pending call to a coalesced method'
+        self.call('f', 0)
+        self.call('showProgress', 1)
+        self.call('g', 2)
+        self.call('showProgress', 3)
+        self.call('showProgress', 4, pid='other')
+        self.call('showProgress', 5)
+        calls = [(m['name'], m['args']['args'][0]['__value__']) for m in self.batch()]
+        self.assertEqual(calls, [('g', 2), ('showProgress', 4), ('showProgress', 5)])
+        # the superseded calls are resolved and their callbacks released
+        self.assertEqual(self.resolved, [('showProgress', 1, None), ('showProgress', 3, None)])
+        self.assertEqual(len(self.connection._store._store), 4)
+
+    def test_resolve(self):
+        'Resolve every call of a batch'
+        for i in range(3):
+            self.call('f', i)
+        for msg in [self.sent[0]] + self.batch():
+            callbacks = self.connection._store.fetch(msg['promise']['callbackId'])
+            callbacks[msg['promise']['args'][0]['num']]('done')
+        self.assertEqual(self.resolved, [('f', i, 'done') for i in range(3)])
+        self.assertEqual(self.connection._store._store, {})